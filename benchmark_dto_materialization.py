@@ -0,0 +1,139 @@
+"""
+SmartHealth - Micro-benchmark de materialización de DTOs
+========================================================
+Ejecutar: python benchmark_dto_materialization.py [n_filas]
+
+Compara, sobre filas sintéticas con la misma forma que devuelve la BD:
+1. Ruta anterior: dict por fila + validación Pydantic completa (DTO(**dict))
+2. Ruta rápida: RowDTO.from_rows (construcción directa, sin validación)
+
+No requiere base de datos ni variables de entorno.
+"""
+
+import sys
+import timeit
+from collections import namedtuple
+from datetime import date, time, datetime, timedelta
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from app.schemas.clinical import AppointmentDTO, PrescriptionDTO, DiagnosisDTO
+from app.schemas.rag import SimilarChunk
+
+
+_ROW_TYPES = {}
+
+
+def FakeRow(mapping: dict):
+    """Imita un Row de SQLAlchemy: tupla con _fields y acceso por atributo."""
+    keys = tuple(mapping)
+    row_type = _ROW_TYPES.get(keys)
+    if row_type is None:
+        row_type = _ROW_TYPES[keys] = namedtuple("Row", keys)
+    return row_type(**mapping)
+
+
+def make_appointment_rows(n: int) -> list:
+    base = date(2020, 1, 1)
+    return [
+        FakeRow({
+            "appointment_id": i,
+            "patient_id": 1,
+            "doctor_id": i % 40,
+            "room_id": i % 12,
+            "appointment_date": base + timedelta(days=i % 1800),
+            "start_time": time(8 + i % 9, 0),
+            "end_time": time(9 + i % 9, 0),
+            "appointment_type": "Consulta",
+            "status": "Completada",
+            "reason": f"Control de rutina número {i}",
+            "creation_date": datetime(2019, 12, 1),
+            "doctor_name": "Ana Pérez",
+            "specialty_name": "Medicina Interna",
+            "medical_license_number": "MP-12345",
+        })
+        for i in range(n)
+    ]
+
+
+def make_prescription_rows(n: int) -> list:
+    return [
+        FakeRow({
+            "prescription_id": i,
+            "medical_record_id": i // 3,
+            "medication_id": i % 200,
+            "dosage": "500 mg",
+            "frequency": "Cada 8 horas",
+            "duration": "7 días",
+            "instruction": "Tomar después de las comidas",
+            "prescription_date": date(2023, 5, 1),
+            "alert_generated": False,
+            "medication_name": "Acetaminofén",
+            "active_ingredient": "Paracetamol",
+            "pharmaceutical_form": "Tableta",
+        })
+        for i in range(n)
+    ]
+
+
+def make_diagnosis_rows(n: int) -> list:
+    return [
+        FakeRow({
+            "record_diagnosis_id": i,
+            "diagnosis_id": i % 300,
+            "icd_code": "I10",
+            "description": "Hipertensión esencial (primaria)",
+            "diagnosis_type": "Principal",
+            "note": None,
+            "diagnosis_date": datetime(2022, 3, 4, 10, 30),
+        })
+        for i in range(n)
+    ]
+
+
+def make_chunk_rows(n: int) -> list:
+    return [
+        FakeRow({
+            "source_type": "medical_record",
+            "source_id": i,
+            "patient_id": 1,
+            "chunk_text": "Paciente refiere cefalea intermitente",
+            "date": datetime(2024, 1, 1),
+            "relevance_score": 0.87,
+        })
+        for i in range(n)
+    ]
+
+
+def validated(dto_cls, rows: list) -> list:
+    """Ruta anterior: dict explícito + validación completa por fila."""
+    return [dto_cls(**row._asdict()) for row in rows]
+
+
+def run(n_rows: int, repeat: int = 5):
+    datasets = [
+        ("AppointmentDTO", AppointmentDTO, make_appointment_rows(n_rows)),
+        ("PrescriptionDTO", PrescriptionDTO, make_prescription_rows(n_rows)),
+        ("DiagnosisDTO", DiagnosisDTO, make_diagnosis_rows(n_rows)),
+        ("SimilarChunk", SimilarChunk, make_chunk_rows(n_rows)),
+    ]
+
+    print(f"\nFilas por DTO: {n_rows} | repeticiones: {repeat} (mejor tiempo)\n")
+    print(f"{'DTO':<18}{'validación (ms)':>18}{'from_rows (ms)':>18}{'speedup':>10}")
+    print("-" * 64)
+
+    for name, dto_cls, rows in datasets:
+        # Sanidad: ambas rutas deben producir los mismos valores
+        assert validated(dto_cls, rows[:5])[0].model_dump() == dto_cls.from_rows(rows[:5])[0].model_dump()
+
+        slow = min(timeit.repeat(lambda: validated(dto_cls, rows), number=1, repeat=repeat))
+        fast = min(timeit.repeat(lambda: dto_cls.from_rows(rows), number=1, repeat=repeat))
+        print(f"{name:<18}{slow * 1000:>18.2f}{fast * 1000:>18.2f}{slow / fast:>9.1f}x")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    run(n)
@@ -0,0 +1,269 @@
+"""
+SmartHealth - Benchmark de Particionamiento por Fecha
+=====================================================
+Ejecutar: python benchmark_partitioning.py [--rows 3000000] [--runs 5] [--keep]
+
+Genera un dataset sintético de citas (20 años de historia) en dos esquemas
+de prueba de la BD configurada en .env:
+- bench_plain.appointments: tabla normal, como antes de la migración 0003
+- bench_part.appointments: la misma tabla convertida con
+  app.database.partitioning.convert_to_partitioned
+
+y compara los tiempos de las queries calientes (filtro `>= NOW() - INTERVAL
+'5 years'` de vector_search), la cantidad de particiones leídas, y el costo
+de la historia completa antes y después de archivar las particiones viejas.
+
+Los esquemas de prueba se borran al final salvo con --keep.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from datetime import date
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from sqlalchemy import text
+
+from app.database.database import engine
+from app.database.partitioning import PartitionSpec, archive_old_partitions, convert_to_partitioned
+
+PLAIN_SCHEMA = "bench_plain"
+PARTITIONED_SCHEMA = "bench_part"
+ARCHIVE_SCHEMA = "bench_archive"
+SPEC = PartitionSpec("appointments", "appointment_date", "appointment_id")
+
+HISTORY_YEARS = 20
+PATIENTS = 50000
+
+# (nombre, sql, años hacia atrás que puede leer; None = sin filtro de fecha)
+QUERIES = [
+    (
+        "Ventana caliente (5 años)",
+        "SELECT COUNT(*), MAX(LENGTH(reason)) FROM {schema}.appointments "
+        "WHERE appointment_date >= NOW() - INTERVAL '5 years'",
+        5
+    ),
+    (
+        "Paciente, ventana 5 años",
+        "SELECT appointment_id, appointment_date, reason FROM {schema}.appointments "
+        "WHERE patient_id = 4242 AND appointment_date >= NOW() - INTERVAL '5 years' "
+        "ORDER BY appointment_date DESC LIMIT 20",
+        5
+    ),
+    (
+        "Último año",
+        "SELECT status, COUNT(*) FROM {schema}.appointments "
+        "WHERE appointment_date >= CURRENT_DATE - 365 GROUP BY status",
+        1
+    ),
+    (
+        "Historia completa",
+        "SELECT COUNT(*) FROM {schema}.appointments",
+        None
+    ),
+]
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# DATASET
+# ============================================================
+
+def drop_schemas(conn) -> None:
+    for schema in (PLAIN_SCHEMA, PARTITIONED_SCHEMA, ARCHIVE_SCHEMA):
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+
+
+def build_dataset(rows: int) -> None:
+    print_test(f"Dataset sintético: {rows:,} citas en {HISTORY_YEARS} años")
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        drop_schemas(conn)
+        conn.execute(text(f"CREATE SCHEMA {PLAIN_SCHEMA}"))
+        conn.execute(text(f"""
+            CREATE TABLE {PLAIN_SCHEMA}.appointments (
+                appointment_id SERIAL PRIMARY KEY,
+                patient_id INTEGER NOT NULL,
+                doctor_id INTEGER NOT NULL,
+                appointment_date DATE NOT NULL,
+                status VARCHAR(20) NOT NULL,
+                reason TEXT
+            )
+        """))
+        conn.execute(text(f"""
+            INSERT INTO {PLAIN_SCHEMA}.appointments (patient_id, doctor_id, appointment_date, status, reason)
+            SELECT (random() * ({PATIENTS} - 1))::int + 1,
+                   (random() * 499)::int + 1,
+                   CURRENT_DATE - (random() * 365 * {HISTORY_YEARS})::int,
+                   (ARRAY['Completada', 'Cancelada', 'Programada'])[1 + (random() * 2)::int],
+                   'Motivo de consulta ' || g
+            FROM generate_series(1, :rows) AS g
+        """), {"rows": rows})
+        conn.execute(text(
+            f"CREATE INDEX ix_bench_appointments_patient_date "
+            f"ON {PLAIN_SCHEMA}.appointments (patient_id, appointment_date)"
+        ))
+    print_info(f"Tabla normal lista en {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {PARTITIONED_SCHEMA}"))
+        conn.execute(text(
+            f"CREATE TABLE {PARTITIONED_SCHEMA}.appointments "
+            f"(LIKE {PLAIN_SCHEMA}.appointments INCLUDING ALL)"
+        ))
+        conn.execute(text(
+            f"INSERT INTO {PARTITIONED_SCHEMA}.appointments SELECT * FROM {PLAIN_SCHEMA}.appointments"
+        ))
+        convert_to_partitioned(conn, SPEC, schema=PARTITIONED_SCHEMA)
+    print_info(f"Copia particionada con convert_to_partitioned en {time.perf_counter() - start:.1f}s")
+
+    # VACUUM fuera de transacción: deja el visibility map al día en ambas
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"VACUUM ANALYZE {PLAIN_SCHEMA}.appointments"))
+        conn.execute(text(f"VACUUM ANALYZE {PARTITIONED_SCHEMA}.appointments"))
+
+
+# ============================================================
+# MEDICIÓN
+# ============================================================
+
+def scanned_relations(plan: dict) -> set:
+    """Tablas/particiones que el plan realmente ejecutó."""
+    relations = set()
+    if "Relation Name" in plan and plan.get("Actual Loops", 0) > 0:
+        relations.add(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        relations |= scanned_relations(child)
+    return relations
+
+
+def measure(sql: str, runs: int) -> tuple:
+    """(mediana en ms, relaciones leídas)."""
+    with engine.connect() as conn:
+        conn.execute(text(sql)).fetchall()  # calentar cache
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            conn.execute(text(sql)).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        plan = conn.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}")).scalar()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return statistics.median(timings), scanned_relations(plan[0]["Plan"])
+
+
+def partition_years(relations: set) -> list:
+    """Años de las particiones <tabla>_yYYYY leídas."""
+    suffixes = [relation.rsplit("_y", 1)[-1] for relation in relations]
+    return sorted(int(suffix) for suffix in suffixes if suffix.isdigit())
+
+
+def compare(runs: int) -> bool:
+    print_test(f"Tabla normal vs particionada (mediana de {runs} corridas)")
+
+    ok = True
+    current_year = date.today().year
+    print(f"  {'Consulta':<28}{'Normal':>12}{'Particionada':>15}{'Particiones':>14}")
+    for name, sql, years_back in QUERIES:
+        plain_ms, _ = measure(sql.format(schema=PLAIN_SCHEMA), runs)
+        part_ms, relations = measure(sql.format(schema=PARTITIONED_SCHEMA), runs)
+        print(f"  {name:<28}{plain_ms:>10.1f}ms{part_ms:>13.1f}ms{len(relations):>14}")
+
+        if years_back is not None:
+            years = partition_years(relations)
+            if years and years[0] < current_year - years_back:
+                print_fail(f"{name}: se leyó la partición de {years[0]}, no hubo poda")
+                ok = False
+
+    if ok:
+        print_pass("Las queries con filtro de fecha solo leen las particiones de su ventana")
+    return ok
+
+
+def compare_after_archive(runs: int) -> bool:
+    print_test("Historia completa después de archivar (keep_years=6)")
+
+    with engine.begin() as conn:
+        archived = archive_old_partitions(
+            conn, SPEC, keep_years=6, schema=PARTITIONED_SCHEMA, archive_schema=ARCHIVE_SCHEMA
+        )
+        remaining = conn.execute(text(f"SELECT COUNT(*) FROM {PARTITIONED_SCHEMA}.appointments")).scalar()
+        in_archive = conn.execute(text(
+            f"SELECT COUNT(*) FROM pg_tables WHERE schemaname = '{ARCHIVE_SCHEMA}'"
+        )).scalar()
+    print_info(f"{len(archived)} particiones movidas a {ARCHIVE_SCHEMA}, {remaining:,} filas siguen calientes")
+
+    sql = "SELECT COUNT(*) FROM {schema}.appointments"
+    plain_ms, _ = measure(sql.format(schema=PLAIN_SCHEMA), runs)
+    part_ms, relations = measure(sql.format(schema=PARTITIONED_SCHEMA), runs)
+    print(f"  {'Historia completa':<28}{plain_ms:>10.1f}ms{part_ms:>13.1f}ms{len(relations):>14}")
+
+    ok = in_archive == len(archived) and len(archived) > 0
+    if ok:
+        print_pass("Las particiones archivadas ya no se leen desde la tabla caliente")
+    else:
+        print_fail(f"Archivado incompleto: {len(archived)} separadas, {in_archive} en {ARCHIVE_SCHEMA}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark de particionamiento por fecha")
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="No borrar los esquemas de prueba")
+    args = parser.parse_args()
+
+    engine.echo = False
+    try:
+        build_dataset(args.rows)
+        ok = compare(args.runs)
+        ok = compare_after_archive(args.runs) and ok
+    finally:
+        if not args.keep:
+            with engine.begin() as conn:
+                drop_schemas(conn)
+
+    print()
+    if ok:
+        print_pass("Benchmark completo")
+        return 0
+    print_fail("El particionamiento no podó como se esperaba")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
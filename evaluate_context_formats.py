@@ -0,0 +1,231 @@
+"""
+SmartHealth - Evaluación de Formatos de Contexto
+================================================
+Ejecutar: python evaluate_context_formats.py [--patients 5] [--with-llm]
+
+Compara los formatos de contexto de app.services.rag_context ("markdown" y
+"compact") sobre pacientes reales de la BD configurada en .env:
+
+1. Tokens de cada formato con el contexto completo y cuántos ítems entran
+   con el presupuesto RAG_CONTEXT_MAX_TOKENS.
+2. Paridad de información: todos los datos clínicos (fechas, motivos,
+   doctores, medicamentos, dosis, códigos ICD-10...) que muestra el formato
+   markdown también aparecen en el compacto.
+3. Con --with-llm (requiere OPENAI_API_KEY y red): responde QUESTIONS con
+   cada formato y compara qué datos clínicos cita cada respuesta.
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from sqlalchemy import text
+
+from app.database.database import engine, open_read_session
+from app.database.db_config import settings
+from app.services.clinical_service import fetch_patient_and_records_by_document
+from app.services.rag_context import build_context, get_encoder
+
+FORMATS = ["markdown", "compact"]
+# Presupuesto que no descarta nada: mide el tamaño del contexto completo
+UNBOUNDED_TOKENS = 1_000_000
+
+QUESTIONS = [
+    "¿Qué medicamentos tiene recetados el paciente y en qué dosis?",
+    "¿Cuáles son los diagnósticos principales del paciente?",
+    "¿Cuándo fue la última cita y cuál fue el motivo?",
+    "Resume la historia clínica reciente del paciente.",
+    "¿Qué doctores han atendido al paciente?",
+    "¿Hay prescripciones con indicaciones especiales?",
+]
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# DATOS
+# ============================================================
+
+def load_patients(limit: int) -> list:
+    """(PatientInfo, ClinicalRecords) de los primeros pacientes con historia."""
+    db = open_read_session()
+    try:
+        documents = db.execute(text("""
+            SELECT p.document_type_id, p.document_number
+            FROM smart_health.patients p
+            WHERE EXISTS (
+                SELECT 1 FROM smart_health.appointments a WHERE a.patient_id = p.patient_id
+            )
+            ORDER BY p.patient_id
+            LIMIT :limit
+        """), {"limit": limit}).fetchall()
+    finally:
+        db.close()
+
+    patients = []
+    for document_type_id, document_number in documents:
+        patient, data = fetch_patient_and_records_by_document(document_type_id, document_number)
+        if patient is not None:
+            patients.append((patient, data.records))
+    return patients
+
+
+def record_facts(records) -> set:
+    """Valores clínicos que ambos formatos deben mostrar."""
+    facts = set()
+
+    def add(*values):
+        for value in values:
+            if value not in (None, ""):
+                # Las fechas se comparan a nivel de día
+                facts.add(str(value)[:10] if hasattr(value, "year") else str(value))
+
+    for apt in records.appointments:
+        add(apt.appointment_date, apt.status, apt.reason, apt.doctor_name, apt.specialty_name)
+    for rec in records.medical_records:
+        add(rec.registration_datetime, rec.summary_text)
+    for presc in records.prescriptions:
+        add(presc.medication_name, presc.dosage, presc.frequency, presc.duration,
+            presc.instruction, presc.prescription_date)
+    for diag in records.diagnoses:
+        add(diag.description, diag.icd_code, diag.diagnosis_type, diag.note)
+    return facts
+
+
+# ============================================================
+# EVALUACIONES
+# ============================================================
+
+def evaluate_tokens(patients: list) -> bool:
+    budget = settings.rag_context_max_tokens
+    print_test(f"Tokens por formato (presupuesto {budget})")
+
+    print(f"  {'Paciente':<10}{'Markdown':>10}{'Compacto':>10}{'Ahorro':>9}{'Ítems md':>10}{'Ítems cmp':>11}")
+    savings = []
+    for patient, records in patients:
+        full = {f: build_context(patient, records, [], UNBOUNDED_TOKENS, f) for f in FORMATS}
+        bounded = {f: build_context(patient, records, [], budget, f) for f in FORMATS}
+        saving = 1 - full["compact"].tokens / full["markdown"].tokens
+        savings.append(saving)
+        print(
+            f"  {patient.patient_id:<10}{full['markdown'].tokens:>10}{full['compact'].tokens:>10}"
+            f"{saving:>8.0%}{sum(bounded['markdown'].items_used.values()):>10}"
+            f"{sum(bounded['compact'].items_used.values()):>11}"
+        )
+
+    average = statistics.mean(savings)
+    if average > 0:
+        print_pass(f"El formato compacto usa en promedio {average:.0%} menos tokens")
+        return True
+    print_fail(f"El formato compacto no ahorra tokens ({average:.0%})")
+    return False
+
+
+def evaluate_information_parity(patients: list) -> bool:
+    print_test("Paridad de información entre formatos")
+
+    ok = True
+    for patient, records in patients:
+        facts = record_facts(records)
+        contexts = {f: build_context(patient, records, [], UNBOUNDED_TOKENS, f).text for f in FORMATS}
+        in_markdown = {fact for fact in facts if fact in contexts["markdown"]}
+        missing = sorted(fact for fact in in_markdown if fact not in contexts["compact"])
+        if missing:
+            print_fail(f"Paciente {patient.patient_id}: faltan en compacto {missing[:5]}")
+            ok = False
+
+    if ok:
+        print_pass(f"Los {len(patients)} contextos compactos contienen todos los datos del markdown")
+    return ok
+
+
+async def evaluate_answer_parity(patients: list, min_parity: float) -> bool:
+    from app.services.llm_service import llm_service
+
+    print_test(f"Paridad de respuestas del LLM ({len(QUESTIONS)} preguntas por paciente)")
+
+    scores = []
+    for patient, records in patients:
+        facts = record_facts(records)
+        contexts = {f: build_context(patient, records, [], context_format=f).text for f in FORMATS}
+        for question in QUESTIONS:
+            cited = {}
+            for context_format, context in contexts.items():
+                response = await llm_service.run_llm(question=question, context=context)
+                cited[context_format] = {fact for fact in facts if fact in response.text}
+
+            union = cited["markdown"] | cited["compact"]
+            score = len(cited["markdown"] & cited["compact"]) / len(union) if union else 1.0
+            scores.append(score)
+            print_info(f"Paciente {patient.patient_id} · {question[:45]:<45} paridad {score:.2f}")
+
+    average = statistics.mean(scores)
+    if average >= min_parity:
+        print_pass(f"Paridad promedio {average:.2f} (mínimo {min_parity})")
+        return True
+    print_fail(f"Paridad promedio {average:.2f} por debajo de {min_parity}")
+    return False
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compara los formatos de contexto RAG")
+    parser.add_argument("--patients", type=int, default=5)
+    parser.add_argument("--with-llm", action="store_true", help="Comparar también respuestas del LLM")
+    parser.add_argument("--min-parity", type=float, default=0.8)
+    args = parser.parse_args()
+
+    engine.echo = False
+    if get_encoder() is None:
+        print_info("tiktoken sin codificación disponible: los tokens son estimados")
+
+    patients = load_patients(args.patients)
+    if not patients:
+        print_fail("No hay pacientes con historia en la BD")
+        return 1
+    print_info(f"Pacientes evaluados: {', '.join(str(p.patient_id) for p, _ in patients)}")
+
+    ok = evaluate_tokens(patients)
+    ok = evaluate_information_parity(patients) and ok
+    if args.with_llm:
+        ok = asyncio.run(evaluate_answer_parity(patients, args.min_parity)) and ok
+
+    print()
+    if ok:
+        print_pass("Evaluación completa")
+        return 0
+    print_fail("Hay diferencias entre formatos")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
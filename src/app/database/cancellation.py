@@ -0,0 +1,136 @@
+# src/app/database/cancellation.py
+"""
+Cancelación de las consultas a la BD de una solicitud.
+
+Las funciones de acceso a datos son síncronas (SQLAlchemy + psycopg2). Desde
+código async se ejecutan con run_cancellable(), que las corre en un hilo
+dentro de un CancelScope: los eventos de Engine registran en el scope la
+conexión de cada statement mientras se ejecuta.
+
+Si la tarea que espera se cancela (el cliente se desconectó, se venció un
+timeout o se canceló el single-flight), el scope:
+- cancela en el servidor los statements en curso con connection.cancel()
+  del driver (el mismo pedido de cancelación que pg_cancel_backend, sin
+  abrir otra conexión); psycopg2 los corta con QueryCanceledError,
+- hace fallar con QueryCancelledError los statements siguientes del hilo,
+  para que la función termine sin volver a la BD.
+
+Los errores se manejan como cualquier error de BD en el hilo (que sigue
+cerrando su sesión); el llamador ya recibió CancelledError.
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+from typing import Callable, Dict, Set, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Scope de la función que corre en este hilo (to_thread copia el contexto)
+_current_scope: contextvars.ContextVar = contextvars.ContextVar("db_cancel_scope", default=None)
+
+metrics: Dict[str, int] = {"scopes_cancelled": 0, "statements_cancelled": 0}
+
+
+class QueryCancelledError(Exception):
+    """La solicitud se canceló: no se ejecutan más statements."""
+
+
+class CancelScope:
+    """Conexiones con un statement en curso de una misma solicitud."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._active: Set = set()
+        self._lock = threading.Lock()
+
+    def started(self, dbapi_connection) -> None:
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelledError("Consulta cancelada por la solicitud")
+            self._active.add(dbapi_connection)
+
+    def finished(self, dbapi_connection) -> None:
+        with self._lock:
+            self._active.discard(dbapi_connection)
+
+    def cancel(self) -> int:
+        """
+        Cancela los statements en curso y los siguientes; retorna cuántos se cortaron.
+
+        El lock se mantiene mientras se envían las cancelaciones: finished()
+        espera, así que ninguna conexión vuelve al pool (y a otra solicitud)
+        antes de que se cancele su statement.
+        """
+        cancelled = 0
+        with self._lock:
+            self.cancelled = True
+            for dbapi_connection in self._active:
+                try:
+                    dbapi_connection.cancel()
+                    cancelled += 1
+                except Exception as e:
+                    logger.warning(f"No se pudo cancelar el statement: {type(e).__name__}: {e}")
+        return cancelled
+
+
+# ============================================================================
+# Eventos de Engine (todas las instancias: primario, réplicas y shards)
+# ============================================================================
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.started(cursor.connection)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.finished(cursor.connection)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    scope = _current_scope.get()
+    execution_context = context.execution_context
+    if scope is not None and execution_context is not None and execution_context.cursor is not None:
+        scope.finished(execution_context.cursor.connection)
+
+
+# ============================================================================
+# Ejecución desde código async
+# ============================================================================
+
+def _run_in_scope(scope: CancelScope, func: Callable[..., T], *args, **kwargs) -> T:
+    _current_scope.set(scope)
+    return func(*args, **kwargs)
+
+
+async def run_cancellable(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Ejecuta func(*args, **kwargs) en un hilo; si se cancela la espera,
+    cancela también sus consultas a la BD.
+    """
+    scope = CancelScope()
+    try:
+        return await asyncio.to_thread(_run_in_scope, scope, func, *args, **kwargs)
+    except asyncio.CancelledError:
+        statements = scope.cancel()
+        metrics["scopes_cancelled"] += 1
+        metrics["statements_cancelled"] += statements
+        logger.info(f"Consulta a la BD cancelada ({statements} statement(s) en curso)")
+        raise
+
+
+def status() -> Dict[str, int]:
+    """Métricas de cancelación (para /health)."""
+    return dict(metrics)
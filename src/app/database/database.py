@@ -1,13 +1,23 @@
 # app/database/database.py
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import itertools
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 from .db_config import settings
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = (
     f"postgresql://{settings.db_user}:{settings.db_password}@"
     f"{settings.db_host}:{settings.db_port}/{settings.db_name}"
 )
 
+# Primario: escrituras (auth, usuarios, auditoría) y lecturas que no toleran atraso
 engine = create_engine(DATABASE_URL, echo=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -18,3 +28,184 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# ============================================================================
+# Réplicas de lectura
+# ============================================================================
+#
+# Las rutas de solo lectura (clinical_service, vector_search, listado de
+# usuarios, cache de referencia) piden una sesión con open_read_session()
+# indicando cuánto atraso toleran. El router elige una réplica sana por
+# round-robin y, si ninguna cumple, usa el primario.
+
+# Atraso de réplica en segundos (0 si está al día o si es un primario).
+# "Al día" exige que el WAL receiver esté conectado (streaming): una réplica
+# desconectada del primario deja de recibir WAL y receive_lsn = replay_lsn,
+# pero sus datos envejecen; en ese caso el atraso se mide desde la última
+# transacción aplicada. Ver status requiere pg_read_all_stats (sin ese rol
+# la réplica nunca cuenta como "al día" y se usa siempre la segunda medida).
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+             AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END AS lag_seconds
+""")
+
+
+class ReplicaState:
+    """Engine de una réplica y el resultado de su último chequeo de salud."""
+
+    def __init__(self, name: str, replica_engine: Engine):
+        self.name = name
+        self.engine = replica_engine
+        self.healthy = True
+        self.lag_seconds = 0.0
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+
+class ReplicaRouter:
+    """Elige el engine para una lectura según salud y atraso de cada réplica."""
+
+    def __init__(
+        self,
+        primary: Engine,
+        replicas: List[ReplicaState],
+        health_check_interval: float,
+        default_max_staleness: float
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.health_check_interval = health_check_interval
+        self.default_max_staleness = default_max_staleness
+        self._counter = itertools.count()
+
+        for replica in replicas:
+            event.listen(replica.engine, "handle_error", self._on_error_for(replica))
+
+    def _on_error_for(self, replica: ReplicaState):
+        def on_error(context):
+            # Conexión caída: sacar la réplica de rotación hasta el próximo chequeo
+            if context.is_disconnect:
+                self.mark_down(replica, context.original_exception)
+        return on_error
+
+    def mark_down(self, replica: ReplicaState, reason=None) -> None:
+        if replica.healthy:
+            logger.warning(f"Réplica {replica.name} fuera de rotación: {reason}")
+        replica.healthy = False
+        replica.checked_at = time.monotonic()
+
+    def check(self, replica: ReplicaState) -> None:
+        """Consulta disponibilidad y atraso de la réplica."""
+        try:
+            with replica.engine.connect() as conn:
+                lag = conn.execute(REPLICA_LAG_QUERY).scalar()
+        except Exception as e:
+            self.mark_down(replica, e)
+            return
+
+        if not replica.healthy:
+            logger.info(f"Réplica {replica.name} de vuelta en rotación")
+        replica.healthy = True
+        # NULL: la réplica nunca aplicó una transacción, no se puede medir
+        replica.lag_seconds = float(lag) if lag is not None else float("inf")
+        replica.checked_at = time.monotonic()
+
+    def _refresh_if_due(self, replica: ReplicaState) -> None:
+        if time.monotonic() - replica.checked_at < self.health_check_interval:
+            return
+        # Un solo hilo chequea; los demás usan el último estado conocido
+        if replica.lock.acquire(blocking=False):
+            try:
+                if time.monotonic() - replica.checked_at >= self.health_check_interval:
+                    self.check(replica)
+            finally:
+                replica.lock.release()
+
+    def engine_for_read(self, max_staleness: Optional[float] = None) -> Engine:
+        """
+        Devuelve una réplica sana con atraso <= max_staleness (segundos),
+        rotando entre réplicas. max_staleness=0 o sin réplicas -> primario.
+        """
+        if max_staleness is None:
+            max_staleness = self.default_max_staleness
+        if max_staleness <= 0 or not self.replicas:
+            return self.primary
+
+        start = next(self._counter)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            self._refresh_if_due(replica)
+            if replica.healthy and replica.lag_seconds <= max_staleness:
+                return replica.engine
+
+        logger.warning("Ninguna réplica disponible dentro del atraso tolerado, leyendo del primario")
+        return self.primary
+
+    def status(self) -> List[dict]:
+        """Último estado conocido de cada réplica (para /health)."""
+        result = []
+        for replica in self.replicas:
+            measured = replica.checked_at and replica.lag_seconds != float("inf")
+            result.append({
+                "name": replica.name,
+                "healthy": replica.healthy,
+                # None: aún sin chequear o atraso no medible
+                "lag_seconds": round(replica.lag_seconds, 3) if measured else None
+            })
+        return result
+
+
+def _replica_url(host: str, port: int) -> str:
+    return (
+        f"postgresql://{settings.db_user}:{settings.db_password}@"
+        f"{host}:{port}/{settings.db_name}"
+    )
+
+
+def _build_replicas() -> List[ReplicaState]:
+    replicas = []
+    for entry in settings.db_replica_hosts.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(":")
+        replica_engine = create_engine(
+            _replica_url(host, int(port or settings.db_port)),
+            echo=engine.echo,
+            pool_pre_ping=True,
+            connect_args={"connect_timeout": settings.db_replica_connect_timeout}
+        )
+        replicas.append(ReplicaState(entry, replica_engine))
+    return replicas
+
+
+replica_router = ReplicaRouter(
+    primary=engine,
+    replicas=_build_replicas(),
+    health_check_interval=settings.db_replica_health_check_interval,
+    default_max_staleness=settings.db_replica_max_staleness
+)
+
+
+def open_read_session(max_staleness: Optional[float] = None) -> Session:
+    """
+    Sesión para lecturas. max_staleness: segundos de atraso aceptables para
+    este llamado (None = DB_REPLICA_MAX_STALENESS, 0 = leer del primario).
+    """
+    return SessionLocal(bind=replica_router.engine_for_read(max_staleness))
+
+
+def get_read_db(max_staleness: Optional[float] = None):
+    """Dependency de FastAPI equivalente a get_db pero ruteada a réplicas."""
+    def dependency():
+        db = open_read_session(max_staleness)
+        try:
+            yield db
+        finally:
+            db.close()
+    return dependency
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # Encontrar la raíz del proyecto (donde está el .env)
@@ -13,6 +14,24 @@ class Settings(BaseSettings):
     db_name: str
     db_user: str
     db_password: str
+    # Crear tablas con Base.metadata.create_all al iniciar. En producción
+    # desactivar y aplicar el esquema con `alembic upgrade head`
+    db_auto_create_tables: bool = True
+    # Réplicas de lectura: "host:puerto" separados por coma (mismas credenciales
+    # y base que el primario). Vacío = todas las lecturas van al primario
+    db_replica_hosts: str = ""
+    # Atraso máximo (segundos) aceptado por defecto al leer de una réplica
+    db_replica_max_staleness: float = 10.0
+    # Cada cuánto se re-chequea salud y atraso de cada réplica
+    db_replica_health_check_interval: float = 5.0
+    db_replica_connect_timeout: int = 2
+    # Shards por paciente: "nombre=host:puerto/base" separados por coma (mismas
+    # credenciales que el primario). Vacío = sin sharding, todo en la BD principal
+    db_shards: str = ""
+    # Puntos por shard en el anillo de hashing consistente
+    db_shard_virtual_nodes: int = 100
+    # Segundos que se recuerda en memoria el shard de un paciente
+    db_shard_directory_cache_seconds: float = 5.0
     
     # === CONFIGURACIÓN DE SEGURIDAD ===
     secret_key: str
@@ -24,6 +43,112 @@ class Settings(BaseSettings):
     llm_temperature: float = 0.1
     llm_max_tokens: int = 500
     llm_timeout: int = 30
+    # Respuestas del RAG (llm_service): más largas y algo menos deterministas
+    rag_answer_max_tokens: int = 2000
+    rag_answer_temperature: float = 0.3
+    # Enrutamiento por complejidad (app/services/model_router.py): el nivel
+    # standard usa LLM_MODEL y RAG_ANSWER_MAX_TOKENS
+    llm_routing_enabled: bool = True
+    llm_fast_model: str = "gpt-4o-mini"
+    llm_fast_max_tokens: int = 500
+    llm_complex_model: str = "gpt-4o"
+    llm_complex_max_tokens: int = 2000
+    # Consultas puntuales de hasta N palabras -> fast
+    llm_route_fast_max_words: int = 12
+    # Preguntas de N palabras o más -> complex
+    llm_route_complex_min_words: int = 30
+    # Síntesis sobre al menos N registros o N tokens de contexto -> complex
+    llm_route_complex_min_records: int = 20
+    llm_route_complex_context_tokens: int = 2500
+    llm_embedding_model: str = "text-embedding-3-small"
+    # Backends compatibles con OpenAI (app/services/llm_gateway.py):
+    # "nombre=base_url;opción=valor;..." separados por coma, en orden de
+    # prioridad. Opciones: model, embedding_model, timeout, connect_timeout,
+    # priority, weight, api_key_env. Vacío = solo la API de OpenAI
+    llm_backends: str = ""
+    # Pool HTTP compartido por todas las llamadas al proveedor (llm_gateway)
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 20
+    llm_keepalive_expiry_seconds: float = 30.0
+    llm_connect_timeout: float = 5.0
+    llm_http2: bool = True
+    # Reintentos internos del SDK de OpenAI. 0: los reintentos los hace el
+    # gateway (backoff con jitter) y así no se multiplican
+    llm_sdk_max_retries: int = 0
+    # Resiliencia del gateway: intentos con backoff exponencial con jitter
+    llm_max_attempts: int = 3
+    llm_backoff_base_seconds: float = 0.25
+    llm_backoff_max_seconds: float = 4.0
+    # Hedging: segunda solicitud si la primera supera el percentil de latencia
+    llm_hedge_enabled: bool = True
+    llm_hedge_percentile: float = 0.95
+    llm_hedge_min_delay_seconds: float = 0.5
+    # Espera antes del hedge mientras no hay muestras suficientes
+    llm_hedge_default_delay_seconds: float = 3.0
+    # Circuit breaker: fallos seguidos para abrir y segundos hasta probar de nuevo
+    llm_breaker_failure_threshold: int = 5
+    llm_breaker_reset_seconds: float = 30.0
+    # Control de admisión por worker (app/services/llm_admission.py):
+    # llamadas simultáneas, tokens/minuto (0 = sin límite), turnos en espera
+    # y segundos mínimos que necesita una llamada una vez admitida
+    llm_max_concurrency: int = 16
+    llm_tokens_per_minute: int = 200000
+    llm_admission_queue_size: int = 64
+    llm_admission_min_service_seconds: float = 5.0
+    
+    # === VENTANA DE HISTORIA CLÍNICA ===
+    # Límites por tipo aplicados en SQL (None = sin límite)
+    clinical_appointments_limit: Optional[int] = 10
+    clinical_medical_records_limit: Optional[int] = 10
+    clinical_prescriptions_limit: Optional[int] = 15
+    clinical_diagnoses_limit: Optional[int] = 15
+    # Ventana de fechas en años hacia atrás (None = sin filtro de fecha)
+    clinical_history_years: Optional[int] = None
+    # Filas por lote al recorrer historias completas con cursor del servidor
+    clinical_stream_batch_size: int = 500
+    
+    # === CACHE DE DATOS DE REFERENCIA (doctores, especialidades, medicamentos) ===
+    reference_cache_ttl_seconds: int = 300
+    
+    # === CONTEXTO RAG ===
+    # Presupuesto de tokens del contexto clínico que se envía al LLM
+    rag_context_max_tokens: int = 4000
+    # Codificación de tiktoken para contar tokens
+    rag_context_encoding: str = "cl100k_base"
+    # Serialización del contexto: "markdown" o "compact" (tablas por sección)
+    rag_context_format: str = "markdown"
+    # Pacientes con fragmentos de contexto pre-renderizados en memoria (0 = sin cache)
+    rag_context_fragment_cache_size: int = 1000
+
+    # === CACHE DE RESPUESTAS DEL RAG ===
+    # Respuestas completas por (paciente, versión de la historia, pregunta
+    # normalizada, versión del prompt/modelo). 0 = sin cache
+    answer_cache_size: int = 5000
+    # Vida máxima de una respuesta aunque la historia no cambie (segundos)
+    answer_cache_ttl_seconds: int = 3600
+    # Cache semántico: reutiliza la respuesta de una pregunta parecida
+    # (similitud coseno de embeddings >= umbral) sobre la misma historia, solo
+    # si coinciden sus números, fechas y negaciones.
+    # Pacientes con índice en memoria (0 = desactivado) y preguntas por paciente
+    semantic_answer_cache_patients: int = 1000
+    semantic_answer_cache_entries_per_patient: int = 20
+    # Con 0.9 ya coinciden preguntas que piden cosas distintas: no bajarlo
+    # sin revisar cache_similarity en la metadata
+    semantic_answer_cache_threshold: float = 0.97
+    # La misma pregunta sobre el mismo paciente mientras otra está en curso
+    # espera el resultado de esa (single-flight) en lugar de repetirla
+    query_single_flight_enabled: bool = True
+    # Preguntas puramente estructuradas ("¿cuál fue su última cita?") se
+    # responden con plantillas desde los registros, sin llamar al LLM
+    template_answers_enabled: bool = True
+    
+    # === RESÚMENES CLÍNICOS POR PACIENTE ===
+    # Backend que redacta los resúmenes: "stub" (local, determinista) o "llm"
+    patient_summary_backend: str = "stub"
+    # Cada cuántos segundos la API actualiza resúmenes pendientes (0 = desactivado)
+    patient_summary_refresh_seconds: int = 0
+    # Pacientes por pasada del resumidor
+    patient_summary_batch_size: int = 100
     
     # Configuración de Pydantic
     model_config = SettingsConfigDict(
@@ -0,0 +1,365 @@
+# app/database/partitioning.py
+"""
+Particionamiento por rango de fechas de las tablas clínicas que crecen sin fin
+(appointments, medical_records, prescriptions) y archivado en frío.
+
+- Una partición por año (<tabla>_yYYYY) más una partición DEFAULT para fechas
+  fuera de rango. Los filtros por fecha de las queries calientes (p.ej.
+  `>= NOW() - INTERVAL '5 years'` en vector_search) podan las particiones viejas.
+- La clave primaria pasa a ser (id, fecha): PostgreSQL exige que incluya la
+  columna de partición, así que una FK ya no puede apuntar solo al id. La
+  migración 0003 reemplaza las FK prescriptions/record_diagnoses ->
+  medical_records por triggers con la misma semántica (ver
+  MEDICAL_RECORD_REFERENCES), incluido el lock FOR KEY SHARE sobre el
+  registro padre que usa shard_rebalance. Cualquier otra FK entrante o índice
+  único sin la columna de fecha hace fallar la conversión.
+- El job de archivado separa (DETACH) las particiones anteriores a la ventana
+  caliente y las mueve al esquema smart_health_archive, junto con las filas
+  que referencian sus registros. Las filas archivadas dejan de aparecer en la
+  app, incluida la exportación de historia completa.
+
+Uso (desde src/):
+    alembic upgrade head                                      # convierte las tablas
+    python -m app.database.partitioning ensure --years-ahead 1
+    python -m app.database.partitioning archive --keep-years 6 [--dry-run]
+"""
+
+import argparse
+import logging
+import sys
+from datetime import date
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "smart_health"
+ARCHIVE_SCHEMA = "smart_health_archive"
+
+# Años que leen las queries calientes: nunca se archiva dentro de esta ventana
+HOT_WINDOW_YEARS = 5
+
+
+class PartitionSpec(NamedTuple):
+    table: str
+    date_column: str
+    key_column: str
+
+
+PARTITIONED_TABLES = [
+    PartitionSpec("appointments", "appointment_date", "appointment_id"),
+    PartitionSpec("medical_records", "registration_datetime", "medical_record_id"),
+    PartitionSpec("prescriptions", "prescription_date", "prescription_id"),
+]
+
+# (tabla, columna) que referencian medical_records.medical_record_id con
+# triggers en lugar de FK (migración 0003)
+MEDICAL_RECORD_REFERENCES = [
+    ("prescriptions", "medical_record_id"),
+    ("record_diagnoses", "medical_record_id"),
+]
+
+
+# ============================================================================
+# Introspección
+# ============================================================================
+
+def is_partitioned(conn: Connection, schema: str, table: str) -> bool:
+    return bool(conn.execute(text("""
+        SELECT 1
+        FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relname = :table
+    """), {"schema": schema, "table": table}).first())
+
+
+def _indexes(conn: Connection, qualified: str, date_column: str) -> list:
+    """Índices del padre, salvo la clave primaria (se recrea aparte)."""
+    return conn.execute(text("""
+        SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition, ix.indisunique AS is_unique,
+               EXISTS (
+                   SELECT 1 FROM pg_attribute a
+                   WHERE a.attrelid = ix.indrelid AND a.attname = :date_column
+                     AND a.attnum = ANY ((ix.indkey::int2[])[0:ix.indnkeyatts - 1])
+               ) AS has_date_column
+        FROM pg_index ix
+        JOIN pg_class i ON i.oid = ix.indexrelid
+        WHERE ix.indrelid = CAST(:qualified AS regclass)
+          AND NOT ix.indisprimary
+    """), {"qualified": qualified, "date_column": date_column}).fetchall()
+
+
+def _outgoing_foreign_keys(conn: Connection, qualified: str) -> list:
+    return conn.execute(text("""
+        SELECT conname AS name, pg_get_constraintdef(oid) AS definition,
+               confrelid::regclass::text AS referenced
+        FROM pg_constraint
+        WHERE conrelid = CAST(:qualified AS regclass) AND contype = 'f'
+    """), {"qualified": qualified}).fetchall()
+
+
+def _incoming_foreign_keys(conn: Connection, qualified: str) -> list:
+    return conn.execute(text("""
+        SELECT conrelid::regclass::text AS referencing, conname AS name
+        FROM pg_constraint
+        WHERE confrelid = CAST(:qualified AS regclass) AND contype = 'f'
+          AND conrelid <> confrelid
+    """), {"qualified": qualified}).fetchall()
+
+
+def _owned_sequences(conn: Connection, qualified: str) -> list:
+    return conn.execute(text("""
+        SELECT a.attname AS column_name, s.oid::regclass::text AS sequence
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.refobjid = CAST(:qualified AS regclass) AND d.deptype IN ('a', 'i')
+    """), {"qualified": qualified}).fetchall()
+
+
+def _year_partitions(conn: Connection, schema: str, table: str) -> List[tuple]:
+    """(nombre, año) de las particiones anuales <tabla>_yYYYY."""
+    rows = conn.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits inh
+        JOIN pg_class c ON c.oid = inh.inhrelid
+        WHERE inh.inhparent = CAST(:qualified AS regclass)
+    """), {"qualified": f"{schema}.{table}"}).scalars()
+
+    prefix = f"{table}_y"
+    partitions = []
+    for name in rows:
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isdigit():
+            partitions.append((name, int(suffix)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+# ============================================================================
+# Conversión
+# ============================================================================
+
+def create_year_partition(conn: Connection, spec: PartitionSpec, year: int, schema: str = SCHEMA) -> None:
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {schema}.{spec.table}_y{year} "
+        f"PARTITION OF {schema}.{spec.table} "
+        f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+    ))
+
+
+def _rebuild(conn: Connection, spec: PartitionSpec, schema: str, partitioned: bool, years_ahead: int) -> None:
+    qualified = f"{schema}.{spec.table}"
+    legacy = f"{spec.table}_legacy"
+
+    indexes = _indexes(conn, qualified, spec.date_column)
+    foreign_keys = _outgoing_foreign_keys(conn, qualified)
+    sequences = _owned_sequences(conn, qualified)
+
+    conn.execute(text(f"ALTER TABLE {qualified} RENAME TO {legacy}"))
+
+    partition_clause = f" PARTITION BY RANGE ({spec.date_column})" if partitioned else ""
+    conn.execute(text(
+        f"CREATE TABLE {qualified} (LIKE {schema}.{legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+        f"INCLUDING STORAGE INCLUDING COMMENTS){partition_clause}"
+    ))
+
+    if partitioned:
+        first_year, last_year = conn.execute(text(
+            f"SELECT EXTRACT(YEAR FROM MIN({spec.date_column}))::int, "
+            f"EXTRACT(YEAR FROM MAX({spec.date_column}))::int FROM {schema}.{legacy}"
+        )).one()
+        current_year = date.today().year
+        first_year = first_year or current_year
+        last_year = max(last_year or current_year, current_year) + years_ahead
+        for year in range(first_year, last_year + 1):
+            create_year_partition(conn, spec, year, schema)
+        conn.execute(text(f"CREATE TABLE {qualified}_default PARTITION OF {qualified} DEFAULT"))
+
+    conn.execute(text(f"INSERT INTO {qualified} SELECT * FROM {schema}.{legacy}"))
+
+    # Las secuencias de los serial deben sobrevivir al DROP de la tabla vieja
+    for column, sequence in sequences:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {qualified}.{column}"))
+
+    conn.execute(text(f"DROP TABLE {schema}.{legacy}"))
+
+    primary_key = f"{spec.key_column}, {spec.date_column}" if partitioned else spec.key_column
+    conn.execute(text(f"ALTER TABLE {qualified} ADD CONSTRAINT {spec.table}_pkey PRIMARY KEY ({primary_key})"))
+
+    for index in indexes:
+        conn.execute(text(index.definition.replace(" ON ONLY ", " ON ")))
+
+    for foreign_key in foreign_keys:
+        referenced_table = foreign_key.referenced.split(".")[-1]
+        if is_partitioned(conn, schema, referenced_table) and referenced_table != spec.table:
+            logger.warning(f"FK {foreign_key.name} omitida: {foreign_key.referenced} está particionada")
+            continue
+        conn.execute(text(f"ALTER TABLE {qualified} ADD CONSTRAINT {foreign_key.name} {foreign_key.definition}"))
+
+    conn.execute(text(f"ANALYZE {qualified}"))
+
+
+def convert_to_partitioned(
+    conn: Connection,
+    spec: PartitionSpec,
+    schema: str = SCHEMA,
+    years_ahead: int = 1
+) -> None:
+    """
+    Reemplaza la tabla por una particionada por año con los mismos datos,
+    índices, defaults y FK salientes. Toma un lock exclusivo mientras copia:
+    ejecutar en ventana de mantenimiento.
+    """
+    if is_partitioned(conn, schema, spec.table):
+        logger.info(f"{schema}.{spec.table} ya está particionada")
+        return
+
+    qualified = f"{schema}.{spec.table}"
+    incoming = _incoming_foreign_keys(conn, qualified)
+    if incoming:
+        names = ", ".join(f"{fk.name} ({fk.referencing})" for fk in incoming)
+        raise RuntimeError(
+            f"{qualified} es referenciada por FK que no pueden apuntar a una tabla particionada: "
+            f"{names}. Reemplazarlas antes de particionar (ver migración 0003)"
+        )
+
+    # Un índice único sin la columna de partición no se puede crear en la
+    # tabla particionada; agregarle la fecha cambiaría lo que garantiza
+    unique = [index.name for index in _indexes(conn, qualified, spec.date_column)
+              if index.is_unique and not index.has_date_column]
+    if unique:
+        raise RuntimeError(
+            f"{qualified} tiene índices únicos sin {spec.date_column}: {', '.join(unique)}. "
+            f"Redefinirlos (o reemplazarlos) antes de particionar"
+        )
+
+    nulls = conn.execute(text(
+        f"SELECT COUNT(*) FROM {schema}.{spec.table} WHERE {spec.date_column} IS NULL"
+    )).scalar()
+    if nulls:
+        raise RuntimeError(
+            f"{schema}.{spec.table} tiene {nulls} filas con {spec.date_column} NULL; "
+            f"completarlas antes de particionar (la columna pasa a ser parte de la clave primaria)"
+        )
+
+    logger.info(f"Particionando {schema}.{spec.table} por {spec.date_column}")
+    _rebuild(conn, spec, schema, partitioned=True, years_ahead=years_ahead)
+
+
+def convert_to_plain(conn: Connection, spec: PartitionSpec, schema: str = SCHEMA) -> None:
+    """Vuelve a una tabla normal con las filas de las particiones no archivadas."""
+    if not is_partitioned(conn, schema, spec.table):
+        return
+    logger.info(f"Des-particionando {schema}.{spec.table}")
+    _rebuild(conn, spec, schema, partitioned=False, years_ahead=0)
+
+
+# ============================================================================
+# Jobs de mantenimiento
+# ============================================================================
+
+def ensure_partitions(conn: Connection, spec: PartitionSpec, years_ahead: int = 1, schema: str = SCHEMA) -> None:
+    """
+    Crea las particiones de los próximos años. Correr al menos una vez al año:
+    si una fecha nueva cae en DEFAULT, crear luego esa partición falla.
+    """
+    current_year = date.today().year
+    for year in range(current_year, current_year + years_ahead + 1):
+        create_year_partition(conn, spec, year, schema)
+
+
+def _archive_referencing_rows(
+    conn: Connection,
+    table: str,
+    column: str,
+    partition: str,
+    schema: str,
+    archive_schema: str
+) -> int:
+    """Mueve a archive_schema.<table> las filas que referencian registros de partition."""
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {archive_schema}.{table} (LIKE {schema}.{table} INCLUDING DEFAULTS)"
+    ))
+    return conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {schema}.{table} child
+            USING {partition} parent
+            WHERE child.{column} = parent.{column}
+            RETURNING child.*
+        )
+        INSERT INTO {archive_schema}.{table} SELECT * FROM moved
+    """)).rowcount
+
+
+def archive_old_partitions(
+    conn: Connection,
+    spec: PartitionSpec,
+    keep_years: int,
+    schema: str = SCHEMA,
+    archive_schema: str = ARCHIVE_SCHEMA,
+    dry_run: bool = False
+) -> List[str]:
+    """
+    Separa las particiones anteriores a los últimos keep_years años y las mueve
+    a archive_schema. Devuelve los nombres de las particiones archivadas.
+
+    Para medical_records mueve antes a archive_schema las filas de
+    MEDICAL_RECORD_REFERENCES que apuntan a esos registros: el DETACH no
+    dispara los triggers que reemplazan a las FK.
+    """
+    if keep_years < HOT_WINDOW_YEARS:
+        raise ValueError(f"keep_years debe ser >= {HOT_WINDOW_YEARS} (ventana de las queries calientes)")
+
+    cutoff_year = date.today().year - keep_years
+    old = [name for name, year in _year_partitions(conn, schema, spec.table) if year < cutoff_year]
+    if dry_run or not old:
+        return old
+
+    conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}"))
+    for name in old:
+        if spec.table == "medical_records":
+            for table, column in MEDICAL_RECORD_REFERENCES:
+                moved = _archive_referencing_rows(conn, table, column, f"{schema}.{name}", schema, archive_schema)
+                logger.info(f"{moved} filas de {schema}.{table} archivadas con {name}")
+        conn.execute(text(f"ALTER TABLE {schema}.{spec.table} DETACH PARTITION {schema}.{name}"))
+        conn.execute(text(f"ALTER TABLE {schema}.{name} SET SCHEMA {archive_schema}"))
+        logger.info(f"{schema}.{name} archivada en {archive_schema}")
+    return old
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from .database import engine
+
+    parser = argparse.ArgumentParser(description="Mantenimiento de particiones clínicas")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ensure = commands.add_parser("ensure", help="Crear particiones de los próximos años")
+    ensure.add_argument("--years-ahead", type=int, default=1)
+
+    archive = commands.add_parser("archive", help=f"Mover particiones viejas a {ARCHIVE_SCHEMA}")
+    archive.add_argument("--keep-years", type=int, default=HOT_WINDOW_YEARS + 1)
+    archive.add_argument("--dry-run", action="store_true")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    engine.echo = False
+
+    with engine.begin() as conn:
+        for spec in PARTITIONED_TABLES:
+            if not is_partitioned(conn, SCHEMA, spec.table):
+                logger.warning(f"{SCHEMA}.{spec.table} no está particionada (aplicar migraciones)")
+                continue
+            if args.command == "ensure":
+                ensure_partitions(conn, spec, args.years_ahead)
+            else:
+                archived = archive_old_partitions(conn, spec, args.keep_years, dry_run=args.dry_run)
+                action = "A archivar" if args.dry_run else "Archivadas"
+                logger.info(f"{spec.table}: {action} {len(archived)} particiones {archived}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+# app/database/shard_rebalance.py
+"""
+Herramienta de rebalanceo de shards de pacientes.
+
+Uso (desde src/):
+    python -m app.database.shard_rebalance backfill
+    python -m app.database.shard_rebalance move --patient-id 42 --to shard2
+    python -m app.database.shard_rebalance rebalance [--limit 100] [--dry-run]
+
+- backfill: registra en patient_directory a los pacientes de cada shard.
+- move: mueve todas las filas de un paciente a otro shard.
+- rebalance: mueve a cada paciente cuyo shard en el directorio no coincide
+  con el que le asigna el anillo (p.ej. después de agregar un shard).
+
+Mover un paciente:
+1. En el shard origen bloquea (FOR UPDATE) las filas del paciente en todas
+   las PATIENT_TABLES. Las filas nuevas que referencian al paciente o a sus
+   medical_records (FK y triggers de la migración 0003) esperan hasta el final.
+2. Borra del destino lo que quedara de un movimiento interrumpido, copia las
+   filas de PATIENT_TABLES y verifica los conteos antes de confirmar.
+3. Apunta el directorio al shard destino.
+4. Espera --grace-seconds para que réplicas y caches de otros procesos vean
+   el cambio, vuelve a contar en el origen y recién ahí borra sus filas. Si
+   los conteos cambiaron (una fila entró sin pasar por los locks), no borra
+   nada, devuelve el directorio al origen y falla: repetir el comando.
+Si falla antes del paso 3 el paciente sigue completo en el origen; si falla
+después, volver a ejecutar el mismo comando termina el movimiento.
+"""
+
+import argparse
+import logging
+import sys
+import time
+import warnings
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import MetaData, Table, exc, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Connection
+
+from .database import engine, SessionLocal
+from .db_config import settings
+from .sharding import shard_router
+from ..models.patient_directory import PatientDirectory
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "smart_health"
+BATCH_SIZE = 1000
+
+_BY_PATIENT = "patient_id = :patient_id"
+_BY_MEDICAL_RECORD = (
+    f"medical_record_id IN (SELECT medical_record_id FROM {SCHEMA}.medical_records "
+    f"WHERE patient_id = :patient_id)"
+)
+
+# (tabla, filtro del paciente) en orden de claves foráneas: se copian en este
+# orden y se borran en el inverso. Agregar aquí cualquier tabla nueva por paciente.
+PATIENT_TABLES = [
+    ("patients", _BY_PATIENT),
+    ("patient_summaries", _BY_PATIENT),
+    ("appointments", _BY_PATIENT),
+    ("medical_records", _BY_PATIENT),
+    ("prescriptions", _BY_MEDICAL_RECORD),
+    ("record_diagnoses", _BY_MEDICAL_RECORD),
+]
+
+
+def _count(conn: Connection, table: str, where: str, patient_id: int) -> int:
+    return conn.execute(
+        text(f"SELECT COUNT(*) FROM {SCHEMA}.{table} WHERE {where}"),
+        {"patient_id": patient_id}
+    ).scalar()
+
+
+def _counts(conn: Connection, patient_id: int) -> Dict[str, int]:
+    return {table: _count(conn, table, where, patient_id) for table, where in PATIENT_TABLES}
+
+
+def _lock_patient_rows(conn: Connection, patient_id: int) -> None:
+    for table_name, where in PATIENT_TABLES:
+        conn.execute(
+            text(f"SELECT 1 FROM {SCHEMA}.{table_name} WHERE {where} FOR UPDATE"),
+            {"patient_id": patient_id}
+        )
+
+
+def _stream(conn: Connection, table: str, where: str, patient_id: int) -> Iterator[List[dict]]:
+    result = conn.execute(
+        text(f"SELECT * FROM {SCHEMA}.{table} WHERE {where}"),
+        {"patient_id": patient_id},
+        execution_options={"stream_results": True}
+    )
+    try:
+        for partition in result.partitions(BATCH_SIZE):
+            yield [dict(row._mapping) for row in partition]
+    finally:
+        result.close()
+
+
+def _directory_shard(patient_id: int) -> Optional[str]:
+    # Siempre del primario: el rebalanceo no puede decidir con datos atrasados
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(PatientDirectory.shard_name).where(PatientDirectory.patient_id == patient_id)
+        ).scalar()
+    finally:
+        db.close()
+
+
+def _set_directory_shard(patient_id: int, shard_name: str) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(PatientDirectory)
+            .where(PatientDirectory.patient_id == patient_id)
+            .values(shard_name=shard_name, updated_at=func.now())
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _delete_patient_rows(conn: Connection, patient_id: int) -> None:
+    # Orden inverso por las claves foráneas
+    for table_name, where in reversed(PATIENT_TABLES):
+        conn.execute(text(f"DELETE FROM {SCHEMA}.{table_name} WHERE {where}"), {"patient_id": patient_id})
+
+
+def _remove_leftovers(patient_id: int, keep: str) -> bool:
+    """Borra copias del paciente en shards distintos de `keep` (movimiento interrumpido)."""
+    removed = False
+    for shard_name, shard_engine in shard_router.shards.items():
+        if shard_name == keep:
+            continue
+        with shard_engine.begin() as conn:
+            if _count(conn, "patients", _BY_PATIENT, patient_id):
+                logger.info(f"Paciente {patient_id}: borrando copia sobrante en {shard_name}")
+                _delete_patient_rows(conn, patient_id)
+                removed = True
+    return removed
+
+
+def move_patient(patient_id: int, target: str, grace_seconds: float, dry_run: bool = False) -> bool:
+    """Mueve las filas del paciente al shard destino. Devuelve True si movió algo."""
+    if target not in shard_router.shards:
+        raise ValueError(f"Shard destino no configurado: {target}")
+
+    source = _directory_shard(patient_id)
+    if source is None:
+        raise ValueError(f"Paciente {patient_id} no está en patient_directory (ejecutar backfill)")
+    if source == target:
+        # Un movimiento interrumpido después de cambiar el directorio deja
+        # filas en el origen: se terminan de borrar aquí
+        return False if dry_run else _remove_leftovers(patient_id, keep=target)
+
+    with shard_router.shards[source].connect() as src, shard_router.shards[target].connect() as dst:
+        src.begin()
+        _lock_patient_rows(src, patient_id)
+
+        counts = _counts(src, patient_id)
+        logger.info(f"Paciente {patient_id}: {source} -> {target} {counts}")
+        if dry_run:
+            src.rollback()
+            return False
+
+        # 1. Copiar al destino (sin restos de un movimiento interrumpido)
+        metadata = MetaData()
+        with dst.begin():
+            _delete_patient_rows(dst, patient_id)
+            for table_name, where in PATIENT_TABLES:
+                with warnings.catch_warnings():
+                    # Columnas vector sin tipo registrado: los valores viajan
+                    # como texto '[...]' y PostgreSQL los convierte al insertar
+                    warnings.simplefilter("ignore", exc.SAWarning)
+                    table = Table(table_name, metadata, schema=SCHEMA, autoload_with=dst)
+                columns = set(table.columns.keys())
+                for rows in _stream(src, table_name, where, patient_id):
+                    dst.execute(
+                        insert(table).on_conflict_do_nothing(),
+                        [{k: v for k, v in row.items() if k in columns} for row in rows]
+                    )
+                copied = _count(dst, table_name, where, patient_id)
+                if copied != counts[table_name]:
+                    raise RuntimeError(
+                        f"{table_name}: {counts[table_name]} filas en {source}, {copied} en {target}"
+                    )
+
+        # 2. Cambiar el directorio
+        _set_directory_shard(patient_id, target)
+        shard_router.forget(patient_id)
+
+        # 3. Dejar que los lectores con atraso tolerado vean el cambio
+        time.sleep(grace_seconds)
+
+        # 4. Borrar del origen, si nada cambió desde la copia
+        final_counts = _counts(src, patient_id)
+        if final_counts != counts:
+            src.rollback()
+            _set_directory_shard(patient_id, source)
+            shard_router.forget(patient_id)
+            raise RuntimeError(
+                f"Paciente {patient_id}: sus filas en {source} cambiaron durante el movimiento "
+                f"({counts} -> {final_counts}); el directorio vuelve a {source}, repetir el movimiento"
+            )
+        _delete_patient_rows(src, patient_id)
+        src.commit()
+
+    logger.info(f"Paciente {patient_id} movido a {target}")
+    return True
+
+
+def backfill_directory() -> int:
+    """Registra en el directorio a los pacientes de cada shard. Devuelve cuántos agregó."""
+    added = 0
+    db = SessionLocal()
+    try:
+        for shard_name, shard_engine in shard_router.shards.items():
+            with shard_engine.connect() as conn:
+                result = conn.execute(
+                    text(f"SELECT patient_id, document_type_id, document_number FROM {SCHEMA}.patients"),
+                    execution_options={"stream_results": True}
+                )
+                for partition in result.partitions(BATCH_SIZE):
+                    rows = [
+                        {
+                            "patient_id": row.patient_id,
+                            "document_type_id": row.document_type_id,
+                            "document_number": row.document_number,
+                            "shard_name": shard_name,
+                        }
+                        for row in partition
+                    ]
+                    inserted = db.execute(
+                        insert(PatientDirectory).on_conflict_do_nothing().returning(PatientDirectory.patient_id),
+                        rows
+                    ).fetchall()
+                    added += len(inserted)
+                    db.commit()
+            logger.info(f"Directorio actualizado con pacientes de {shard_name}")
+    finally:
+        db.close()
+    return added
+
+
+def misplaced_patients(limit: Optional[int] = None) -> List[tuple]:
+    """(patient_id, shard actual, shard según el anillo) de pacientes fuera de lugar."""
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(PatientDirectory.patient_id, PatientDirectory.shard_name)
+            .order_by(PatientDirectory.patient_id)
+        )
+        misplaced = []
+        for patient_id, shard_name in rows:
+            home = shard_router.home_shard(patient_id)
+            if home != shard_name:
+                misplaced.append((patient_id, shard_name, home))
+                if limit and len(misplaced) >= limit:
+                    break
+        return misplaced
+    finally:
+        db.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Rebalanceo de shards de pacientes")
+    parser.add_argument(
+        "--grace-seconds",
+        type=float,
+        default=settings.db_replica_max_staleness + settings.db_shard_directory_cache_seconds,
+        help="Espera entre cambiar el directorio y borrar del shard origen"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Solo mostrar lo que se movería")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("backfill", help="Registrar pacientes existentes en el directorio")
+
+    move = commands.add_parser("move", help="Mover un paciente a otro shard")
+    move.add_argument("--patient-id", type=int, required=True)
+    move.add_argument("--to", dest="target", required=True)
+
+    rebalance = commands.add_parser("rebalance", help="Mover pacientes a su shard según el anillo")
+    rebalance.add_argument("--limit", type=int, default=None)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    # Sin eco de SQL: los INSERT llevan embeddings completos
+    engine.echo = False
+    for shard_engine in shard_router.shards.values():
+        shard_engine.echo = False
+
+    if not shard_router.enabled:
+        logger.error("DB_SHARDS no está configurado")
+        return 1
+
+    if args.command == "backfill":
+        logger.info(f"Pacientes agregados al directorio: {backfill_directory()}")
+    elif args.command == "move":
+        move_patient(args.patient_id, args.target, args.grace_seconds, args.dry_run)
+    elif args.command == "rebalance":
+        pending = misplaced_patients(args.limit)
+        logger.info(f"Pacientes fuera de su shard: {len(pending)}")
+        for patient_id, _current, home in pending:
+            move_patient(patient_id, home, args.grace_seconds, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+# app/database/sharding.py
+"""
+Sharding de datos clínicos por paciente.
+
+Cada paciente vive completo (patients, appointments, medical_records,
+prescriptions, record_diagnoses) en un solo shard, así el camino RAG nunca
+hace queries entre shards:
+
+- patient_id -> shard: hashing consistente sobre los nombres de DB_SHARDS
+  (agregar un shard solo mueve ~1/N de los pacientes).
+- documento -> (patient_id, shard): tabla smart_health.patient_directory en la
+  BD principal. El directorio manda sobre el anillo: un paciente movido con
+  shard_rebalance queda donde dice el directorio. El directorio es la única
+  fuente: un documento sin entrada no se busca en los shards (cada solicitud
+  con un documento desconocido consultaría todos). Quien carga pacientes los
+  registra con register(); `shard_rebalance backfill` (idempotente) registra
+  a los que falten. Las búsquedas sin entrada se cuentan en status().
+
+Las tablas de referencia (doctors, specialties, medications, diagnoses) se
+replican completas en cada shard porque las queries clínicas hacen JOIN con ellas.
+
+Sin DB_SHARDS todo sigue yendo a la BD principal (y sus réplicas de lectura).
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .database import engine, SessionLocal, open_read_session
+from .db_config import settings
+from ..models.patient_directory import PatientDirectory
+
+logger = logging.getLogger(__name__)
+
+# Máximo de pacientes recordados en memoria antes de vaciar el cache
+DIRECTORY_CACHE_MAX_ENTRIES = 10000
+
+
+class PatientLocation(NamedTuple):
+    patient_id: int
+    shard_name: str
+
+
+class ConsistentHashRing:
+    """Anillo de hashing consistente con nodos virtuales."""
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int):
+        points = []
+        for node in nodes:
+            for replica in range(virtual_nodes):
+                points.append((self._hash(f"{node}#{replica}"), node))
+        points.sort()
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        # md5 y no hash(): tiene que dar lo mismo en todos los procesos
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class ShardRouter:
+    """Resuelve el shard de un paciente y abre sesiones contra él."""
+
+    def __init__(self, shards: Dict[str, Engine], virtual_nodes: int, cache_seconds: float):
+        self.shards = shards
+        self.ring = ConsistentHashRing(shards, virtual_nodes) if shards else None
+        self.cache_seconds = cache_seconds
+        self._cache: Dict[int, Tuple[str, float]] = {}
+        self._cache_lock = threading.Lock()
+        self.metrics: Dict[str, int] = {"directory_hits": 0, "directory_misses": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shards)
+
+    def home_shard(self, patient_id: int) -> str:
+        """Shard que le corresponde al paciente según el anillo."""
+        return self.ring.node_for(str(patient_id))
+
+    # ------------------------------------------------------------------
+    # Directorio
+    # ------------------------------------------------------------------
+
+    def _remember(self, patient_id: int, shard_name: str) -> None:
+        with self._cache_lock:
+            if len(self._cache) >= DIRECTORY_CACHE_MAX_ENTRIES:
+                self._cache.clear()
+            self._cache[patient_id] = (shard_name, time.monotonic())
+
+    def forget(self, patient_id: int) -> None:
+        with self._cache_lock:
+            self._cache.pop(patient_id, None)
+
+    def locate_document(
+        self,
+        document_type_id: int,
+        document_number: str,
+        max_staleness: Optional[float] = None
+    ) -> Optional[PatientLocation]:
+        """Busca el documento en el directorio. None si no está registrado."""
+        directory = open_read_session(max_staleness)
+        try:
+            row = directory.execute(
+                select(PatientDirectory.patient_id, PatientDirectory.shard_name).where(
+                    PatientDirectory.document_type_id == document_type_id,
+                    PatientDirectory.document_number == document_number
+                )
+            ).first()
+        finally:
+            directory.close()
+
+        if row is None:
+            self.metrics["directory_misses"] += 1
+            return None
+        self.metrics["directory_hits"] += 1
+        self._remember(row.patient_id, row.shard_name)
+        return PatientLocation(row.patient_id, row.shard_name)
+
+    def register(self, location: PatientLocation, document_type_id: int, document_number: str) -> None:
+        """
+        Agrega al paciente al directorio; no cambia una entrada existente.
+        Llamarlo al crear el paciente en su shard.
+        """
+        db = SessionLocal()
+        try:
+            db.execute(
+                insert(PatientDirectory).values(
+                    document_type_id=document_type_id,
+                    document_number=document_number,
+                    patient_id=location.patient_id,
+                    shard_name=location.shard_name
+                ).on_conflict_do_nothing()
+            )
+            db.commit()
+        finally:
+            db.close()
+        self._remember(location.patient_id, location.shard_name)
+
+    def shard_for_patient(self, patient_id: int, max_staleness: Optional[float] = None) -> str:
+        cached = self._cache.get(patient_id)
+        if cached and time.monotonic() - cached[1] < self.cache_seconds:
+            return cached[0]
+
+        directory = open_read_session(max_staleness)
+        try:
+            shard_name = directory.execute(
+                select(PatientDirectory.shard_name).where(PatientDirectory.patient_id == patient_id)
+            ).scalar()
+        finally:
+            directory.close()
+
+        if shard_name is None:
+            # Sin entrada en el directorio: se asume su shard natural
+            shard_name = self.home_shard(patient_id)
+        self._remember(patient_id, shard_name)
+        return shard_name
+
+    def status(self) -> Dict[str, int]:
+        """Shards configurados y aciertos/fallos del directorio (para /health)."""
+        return {"shards": len(self.shards), **self.metrics}
+
+    # ------------------------------------------------------------------
+    # Sesiones
+    # ------------------------------------------------------------------
+
+    def session_for_shard(self, shard_name: str) -> Session:
+        shard_engine = self.shards.get(shard_name)
+        if shard_engine is None:
+            raise ValueError(f"Shard no configurado en DB_SHARDS: {shard_name}")
+        return SessionLocal(bind=shard_engine)
+
+
+def _parse_shard(entry: str) -> Tuple[str, str]:
+    """'nombre=host:puerto/base' -> (nombre, url)."""
+    name, _, location = entry.partition("=")
+    address, _, db_name = location.partition("/")
+    host, _, port = address.partition(":")
+    if not name or not host:
+        raise ValueError(f"Entrada inválida en DB_SHARDS: {entry!r} (formato nombre=host:puerto/base)")
+    url = (
+        f"postgresql://{settings.db_user}:{settings.db_password}@"
+        f"{host}:{port or settings.db_port}/{db_name or settings.db_name}"
+    )
+    return name.strip(), url
+
+
+def _build_shards() -> Dict[str, Engine]:
+    shards = {}
+    for entry in settings.db_shards.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, url = _parse_shard(entry)
+        shards[name] = create_engine(url, echo=engine.echo, pool_pre_ping=True)
+    return shards
+
+
+shard_router = ShardRouter(
+    shards=_build_shards(),
+    virtual_nodes=settings.db_shard_virtual_nodes,
+    cache_seconds=settings.db_shard_directory_cache_seconds
+)
+
+
+def open_document_session(
+    document_type_id: int,
+    document_number: str,
+    max_staleness: Optional[float] = None
+) -> Optional[Session]:
+    """
+    Sesión en la BD que tiene al paciente con ese documento.
+    Sin sharding es una sesión de lectura normal; con sharding devuelve None
+    si el documento no está en el directorio.
+    """
+    if not shard_router.enabled:
+        return open_read_session(max_staleness)
+
+    location = shard_router.locate_document(document_type_id, document_number, max_staleness)
+    if location is None:
+        return None
+    return shard_router.session_for_shard(location.shard_name)
+
+
+def open_patient_session(patient_id: int, max_staleness: Optional[float] = None) -> Session:
+    """Sesión en la BD que tiene los datos clínicos del paciente."""
+    if not shard_router.enabled:
+        return open_read_session(max_staleness)
+    return shard_router.session_for_shard(shard_router.shard_for_patient(patient_id, max_staleness))
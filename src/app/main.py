@@ -6,6 +6,7 @@ from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
+import asyncio
 import logging
 import time
 from typing import Dict
@@ -22,13 +23,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Crear tablas en la base de datos
-try:
-    Base.metadata.create_all(bind=engine)
-    logger.info("Tablas de base de datos creadas exitosamente")
-except Exception as e:
-    logger.error(f"Error creando tablas: {str(e)}")
-    raise
+# Crear tablas en la base de datos (los índices y cambios de esquema
+# se aplican con Alembic: `alembic upgrade head` desde src/)
+if settings.db_auto_create_tables:
+    try:
+        Base.metadata.create_all(bind=engine)
+        logger.info("Tablas de base de datos creadas exitosamente")
+    except Exception as e:
+        logger.error(f"Error creando tablas: {str(e)}")
+        raise
 
 # Crear aplicación con CDN alternativas para Swagger
 app = FastAPI(
@@ -241,6 +244,27 @@ def health():
     # Agregar detalles de error en desarrollo
     if not is_healthy and settings.app_env == "development" and error_details:
         response["error"] = error_details
+
+    # Réplicas de lectura (si hay): se degradan al primario, no afectan el estado
+    from .database.database import replica_router
+    if replica_router.replicas:
+        response["services"]["database_replicas"] = replica_router.status()
+
+    # Shards de pacientes: aciertos y fallos del directorio
+    from .database.sharding import shard_router
+    if shard_router.enabled:
+        response["services"]["database_shards"] = shard_router.status()
+
+    # Gateway del LLM: breaker, reintentos y hedging (no afectan el estado)
+    from .services.llm_gateway import llm_gateway
+    response["services"]["llm_gateway"] = llm_gateway.status()
+    from .services.llm_admission import llm_admission
+    response["services"]["llm_admission"] = llm_admission.status()
+    from .services.answer_cache import answer_cache, semantic_answer_cache
+    response["services"]["answer_cache"] = answer_cache.stats()
+    response["services"]["semantic_answer_cache"] = semantic_answer_cache.stats()
+    response["services"]["query_single_flight"] = query.query_flights.status()
+    response["services"]["query_cancellation"] = query.cancellation_status()
     
     return response
 # ============================================================
@@ -255,9 +279,29 @@ async def startup_event():
     logger.info(f"Entorno: {settings.app_env}")
     logger.info(f"Modelo LLM: {settings.llm_model}")
     logger.info(f"Base de datos: {settings.db_host}:{settings.db_port}/{settings.db_name}")
+    if settings.db_replica_hosts:
+        logger.info(f"Réplicas de lectura: {settings.db_replica_hosts}")
     logger.info("=" * 60)
 
+    # Resúmenes clínicos incrementales en segundo plano (opcional)
+    app.state.summary_task = None
+    if settings.patient_summary_refresh_seconds > 0:
+        from .services.patient_summary import summary_refresh_loop
+        app.state.summary_task = asyncio.create_task(
+            summary_refresh_loop(settings.patient_summary_refresh_seconds)
+        )
+        logger.info(
+            f"Resúmenes clínicos: backend {settings.patient_summary_backend}, "
+            f"cada {settings.patient_summary_refresh_seconds}s"
+        )
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """Eventos al cerrar la aplicación"""
-    logger.info("SmartHealth API cerrando")
\ No newline at end of file
+    logger.info("SmartHealth API cerrando")
+    if getattr(app.state, "summary_task", None) is not None:
+        app.state.summary_task.cancel()
+
+    # Pool de conexiones compartido con el proveedor del LLM
+    from .services.llm_gateway import llm_gateway
+    await llm_gateway.aclose()
\ No newline at end of file
@@ -0,0 +1,26 @@
+# app/models/patient_directory.py
+
+from sqlalchemy import Column, Integer, String, DateTime, PrimaryKeyConstraint
+from sqlalchemy.sql import func
+from ..database.database import Base
+
+
+class PatientDirectory(Base):
+    """
+    Directorio documento -> paciente -> shard. Vive en la BD principal;
+    los datos clínicos del paciente viven solo en su shard.
+    """
+    __tablename__ = "patient_directory"
+    __table_args__ = (
+        PrimaryKeyConstraint("document_type_id", "document_number"),
+        {"schema": "smart_health"},
+    )
+
+    document_type_id = Column(Integer, nullable=False)
+    document_number = Column(String(50), nullable=False)
+    patient_id = Column(Integer, nullable=False, unique=True, index=True)
+    shard_name = Column(String(64), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+    def __repr__(self):
+        return f"<PatientDirectory {self.patient_id} -> {self.shard_name}>"
\ No newline at end of file
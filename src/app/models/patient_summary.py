@@ -0,0 +1,29 @@
+# app/models/patient_summary.py
+
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import func
+from ..database.database import Base
+
+
+class PatientSummary(Base):
+    """
+    Resumen longitudinal de la historia clínica de un paciente, por año y por
+    condición (ver app.services.patient_summary). Vive en el mismo shard que
+    los datos del paciente. Los last_*_id marcan hasta qué fila de cada tabla
+    ya está incorporada: las actualizaciones solo leen filas nuevas.
+    """
+    __tablename__ = "patient_summaries"
+    __table_args__ = {"schema": "smart_health"}
+
+    patient_id = Column(Integer, primary_key=True)
+    summary = Column(JSONB, nullable=False)
+    last_appointment_id = Column(Integer, nullable=False, default=0)
+    last_medical_record_id = Column(Integer, nullable=False, default=0)
+    last_prescription_id = Column(Integer, nullable=False, default=0)
+    last_record_diagnosis_id = Column(Integer, nullable=False, default=0)
+    backend = Column(String(32), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+    def __repr__(self):
+        return f"<PatientSummary {self.patient_id} ({self.backend})>"
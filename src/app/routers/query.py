@@ -1,19 +1,38 @@
 # src/app/routers/query.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, TypeVar
 from sqlalchemy.orm import Session
 from datetime import datetime, timezone
 import logging
 import time
 import asyncio
+import json
 import re
 
 from app.services.llm_service import llm_service
-from app.services.clinical_service import fetch_patient_and_records
+from app.services.llm_gateway import LLMUnavailableError
+from app.services.llm_admission import llm_admission, LLMAdmissionError
+from app.services.answer_cache import answer_cache, semantic_answer_cache, normalize_question
+from app.services.single_flight import SingleFlight
+from app.services.template_answers import answer_from_template
+from app.services.model_router import route_question
+from app.services.llm_client import get_embedding
+from app.services.clinical_service import (
+    fetch_patient_and_records_by_document,
+    get_patient_by_document,
+    iter_patient_history_ndjson
+)
+from app.services.rag_context import build_context
 from app.services.vector_search import search_similar_chunks
-from app.database.database import get_db
-from app.schemas.clinical import PatientInfo, ClinicalRecords
+from app.database.db_config import settings
+from app.database import cancellation
+from app.database.cancellation import run_cancellable
+from app.database.sharding import open_document_session, open_patient_session
+from app.core.security import get_current_user
+from app.models.user import User
+from app.schemas.clinical import ClinicalRecords
 
 router = APIRouter(prefix="/query", tags=["RAG Query"])
 logger = logging.getLogger(__name__)
@@ -23,6 +42,14 @@ LLM_TIMEOUT_SECONDS = 30
 VECTOR_SEARCH_TIMEOUT_SECONDS = 10
 TOTAL_REQUEST_TIMEOUT_SECONDS = 45
 
+# Status para la solicitud que el cliente abandonó (convención de nginx):
+# no llega a enviarse, queda en los logs
+CLIENT_CLOSED_REQUEST = 499
+
+# === TOLERANCIA DE ATRASO EN RÉPLICAS (segundos) ===
+CLINICAL_READ_MAX_STALENESS_SECONDS = 5
+HISTORY_EXPORT_MAX_STALENESS_SECONDS = 60
+
 # === SCHEMAS ===
 
 class QueryInput(BaseModel):
@@ -111,148 +138,6 @@ def get_iso_timestamp() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def build_context_from_real_data(
-    patient_info: PatientInfo,
-    clinical_records: ClinicalRecords,
-    similar_chunks: List
-) -> str:
-    """Construye el contexto clínico de manera segura"""
-    
-    from datetime import date, datetime
-
-    # === Calcular edad ===
-    age = "No disponible"
-    if patient_info.birth_date:
-        try:
-            birth_date = (
-                patient_info.birth_date
-                if isinstance(patient_info.birth_date, date)
-                else datetime.strptime(patient_info.birth_date, "%Y-%m-%d").date()
-            )
-            today = date.today()
-            age = today.year - birth_date.year - (
-                (today.month, today.day) < (birth_date.month, birth_date.day)
-            )
-        except Exception as e:
-            logger.warning(f"Error calculando edad: {e}")
-            age = "No disponible"
-
-    # Usar getattr para todos los campos de patient_info
-    first_name = getattr(patient_info, 'first_name', 'Nombre')
-    first_surname = getattr(patient_info, 'first_surname', 'Apellido')
-    document_number = getattr(patient_info, 'document_number', 'No disponible')
-    gender = getattr(patient_info, 'gender', None) or "No registrado"
-    email = getattr(patient_info, 'email', None) or "No registrado"
-
-    context = f"""
-### INFORMACIÓN BÁSICA DEL PACIENTE
-Nombre: {first_name} {first_surname}
-Edad: {age}
-Documento: {document_number}
-Género: {gender}
-Email: {email}
-
-"""
-
-    # === CITAS ===
-    if clinical_records.appointments:
-        context += "### CITAS MÉDICAS RECIENTES\n"
-        for apt in clinical_records.appointments[:10]:
-            apt_date = getattr(apt, 'appointment_date', 'Fecha no disponible')
-            apt_status = getattr(apt, 'status', None) or 'No disponible'
-            apt_reason = getattr(apt, 'reason', None) or 'No especificado'
-            apt_type = getattr(apt, 'appointment_type', None) or 'Consulta'
-            doctor_name = getattr(apt, 'doctor_name', None)
-            specialty = getattr(apt, 'specialty_name', None)
-            
-            context += f"**Cita {apt_date}**\n"
-            context += f"- Tipo: {apt_type}\n"
-            context += f"- Estado: {apt_status}\n"
-            context += f"- Motivo: {apt_reason}\n"
-            if doctor_name:
-                context += f"- Doctor: {doctor_name}"
-                if specialty:
-                    context += f" ({specialty})"
-                context += "\n"
-            context += "\n"
-
-    # === REGISTROS MÉDICOS ===
-    if clinical_records.medical_records:
-        context += "### REGISTROS MÉDICOS\n"
-        for rec in clinical_records.medical_records[:10]:
-            desc = (
-                getattr(rec, "summary_text", None) or
-                getattr(rec, "description", None) or
-                getattr(rec, "details", None) or
-                getattr(rec, "notes", None) or
-                "Sin descripción"
-            )
-            
-            rec_date = getattr(rec, 'registration_datetime', 'Fecha no disponible')
-            rec_type = getattr(rec, 'record_type', 'Tipo no especificado')
-
-            context += (
-                f"- Fecha: {rec_date}\n"
-                f"  Tipo: {rec_type}\n"
-                f"  Descripción: {desc}\n\n"
-            )
-
-    # === PRESCRIPCIONES ===
-    if clinical_records.prescriptions:
-        context += "### MEDICAMENTOS Y PRESCRIPCIONES\n"
-        for presc in clinical_records.prescriptions[:15]:
-            medication = getattr(presc, 'medication_name', 'Medicamento sin nombre')
-            dosage = getattr(presc, 'dosage', '')
-            frequency = getattr(presc, 'frequency', '')
-            duration = getattr(presc, 'duration', None)
-            instruction = getattr(presc, 'instruction', None)
-            presc_date = getattr(presc, 'prescription_date', None)
-            
-            context += f"**{medication}**\n"
-            if dosage or frequency:
-                context += f"- Dosis: {dosage} {frequency}\n"
-            if duration:
-                context += f"- Duración: {duration}\n"
-            if instruction:
-                context += f"- Indicaciones: {instruction}\n"
-            if presc_date:
-                context += f"- Fecha de prescripción: {presc_date}\n"
-            context += "\n"
-
-    # === DIAGNÓSTICOS ===
-    if clinical_records.diagnoses:
-        context += "### DIAGNÓSTICOS\n"
-        for diag in clinical_records.diagnoses[:15]:
-            diag_desc = getattr(diag, 'description', 'Diagnóstico sin descripción')
-            icd_code = getattr(diag, 'icd_code', 'Sin código')
-            diag_type = getattr(diag, 'diagnosis_type', 'Tipo no especificado')
-            note = getattr(diag, 'note', None)
-            diag_date = getattr(diag, 'diagnosis_date', None)
-            
-            context += f"**{diag_desc}**\n"
-            context += f"- Código ICD-10: {icd_code}\n"
-            context += f"- Tipo: {diag_type}\n"
-            if diag_date:
-                context += f"- Fecha: {diag_date}\n"
-            if note:
-                context += f"- Nota: {note}\n"
-            context += "\n"
-
-    # === VECTOR SEARCH ===
-    if similar_chunks:
-        context += "### INFORMACIÓN ADICIONAL RELEVANTE (BÚSQUEDA SEMÁNTICA)\n"
-        for chunk in similar_chunks[:5]:
-            chunk_text = getattr(chunk, 'chunk_text', 'Texto no disponible')
-            relevance = getattr(chunk, 'relevance_score', 0.0)
-            source_type = getattr(chunk, 'source_type', 'Desconocida')
-            chunk_date = getattr(chunk, 'date', 'Sin fecha')
-            
-            context += f"- [Relevancia: {relevance:.2f}] {chunk_text}\n"
-            context += f"  Fuente: {source_type} - Fecha: {chunk_date}\n\n"
-
-    return context
-
-
 def build_sources_from_real_data(
     clinical_records: ClinicalRecords, 
     similar_chunks: List,
@@ -438,175 +323,462 @@ def _generate_fallback_response(clinical_records: ClinicalRecords, question: str
     return "\n".join(response_parts)
 
 
-# === ENDPOINT PRINCIPAL ===
+# === PIPELINE DE EVENTOS ===
+#
+# Una consulta produce siempre la misma secuencia de eventos, que comparten
+# POST /query/ (devuelve solo el último), POST /query/stream (SSE o NDJSON)
+# y el WebSocket:
+#   status* -> [stream_start -> token* -> stream_end] -> complete | error
+# complete y error llevan el mismo cuerpo que la respuesta REST.
+
+def _error_event(
+    input_data: QueryInput,
+    sequence_chat_id: int,
+    code: str,
+    message: str,
+    details: str
+) -> dict:
+    return {
+        "type": "error",
+        "status": "error",
+        "session_id": input_data.session_id,
+        "sequence_chat_id": sequence_chat_id,
+        "timestamp": get_iso_timestamp(),
+        "error": {
+            "code": code,
+            "message": message,
+            "details": details
+        }
+    }
+
+
+def _event_payload(event: dict) -> dict:
+    """Cuerpo REST de un evento complete / error."""
+    return {key: value for key, value in event.items() if key != "type"}
+
+
+# Campos propios de cada solicitud que no se guardan en el cache de respuestas
+_PER_REQUEST_FIELDS = ("type", "session_id", "sequence_chat_id", "timestamp")
+_PER_REQUEST_METADATA = (
+    "time_to_first_token_ms", "llm_time_to_first_token_ms",
+    "prompt_tokens", "cached_tokens",
+    "cached", "cache_similarity", "semantic_cache_hit_rate"
+)
+
+
+def _cacheable_payload(event: dict) -> dict:
+    payload = {key: value for key, value in event.items() if key not in _PER_REQUEST_FIELDS}
+    payload["metadata"] = {
+        key: value for key, value in event["metadata"].items() if key not in _PER_REQUEST_METADATA
+    }
+    return payload
+
+
+def _cached_event(
+    payload: dict,
+    input_data: QueryInput,
+    sequence_chat_id: int,
+    start_time: float,
+    match: str,
+    similarity: float
+) -> dict:
+    """Evento complete a partir de una respuesta guardada (match: exact | semantic)."""
+    return {
+        "type": "complete",
+        **payload,
+        "session_id": input_data.session_id,
+        "sequence_chat_id": sequence_chat_id,
+        "timestamp": get_iso_timestamp(),
+        "metadata": {
+            **payload["metadata"],
+            "query_time_ms": int((time.time() - start_time) * 1000),
+            "cached": True,
+            "cache_match": match,
+            "cache_similarity": round(similarity, 4),
+            "semantic_cache_hit_rate": round(semantic_answer_cache.hit_rate, 3)
+        }
+    }
+
+
+# Consultas en curso por (documento del paciente, pregunta normalizada)
+query_flights = SingleFlight()
+
+
+def _follower_event(event: dict, input_data: QueryInput, sequence_chat_id: int) -> dict:
+    """Evento de la ejecución compartida con los datos de esta solicitud."""
+    if event.get("type") not in ("complete", "error"):
+        return event
+    event = {**event, "session_id": input_data.session_id, "sequence_chat_id": sequence_chat_id}
+    if "metadata" in event:
+        event["metadata"] = {**event["metadata"], "coalesced": True}
+    return event
+
+
+async def query_events(
+    input_data: QueryInput,
+    sanitized_doc_number: str,
+    sequence_chat_id: int = 1
+) -> AsyncIterator[dict]:
+    """
+    Ejecuta la consulta RAG como una secuencia de eventos, con el límite de
+    TOTAL_REQUEST_TIMEOUT_SECONDS para toda la secuencia. La entrada ya debe
+    venir validada y con el documento sanitizado.
+
+    Si la misma pregunta sobre el mismo paciente ya está en curso, esta
+    solicitud recibe los eventos de esa ejecución (single-flight) en lugar
+    de repetir la consulta, con su propio session_id y "coalesced": true.
+    """
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TOTAL_REQUEST_TIMEOUT_SECONDS
+    if settings.query_single_flight_enabled:
+        events = query_flights.join(
+            (input_data.document_type_id, sanitized_doc_number, normalize_question(input_data.question)),
+            lambda: _process_query(input_data, start_time, sequence_chat_id, sanitized_doc_number, deadline)
+        )
+        leader = events.leader
+    else:
+        events = _process_query(input_data, start_time, sequence_chat_id, sanitized_doc_number, deadline)
+        leader = True
+
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    events.__anext__(),
+                    timeout=max(deadline - loop.time(), 0)
+                )
+            except StopAsyncIteration:
+                return
+            yield event if leader else _follower_event(event, input_data, sequence_chat_id)
+
+    except asyncio.TimeoutError:
+        logger.error(f"Request timeout después de {TOTAL_REQUEST_TIMEOUT_SECONDS}s")
+        yield _error_event(
+            input_data, sequence_chat_id,
+            "REQUEST_TIMEOUT",
+            f"La solicitud excedió el tiempo máximo de {TOTAL_REQUEST_TIMEOUT_SECONDS} segundos",
+            "Intente nuevamente con una pregunta más específica"
+        )
+
+    except asyncio.CancelledError:
+        logger.warning("Request cancelado por el cliente")
+        raise
+
+    except Exception as e:
+        logger.exception("Error inesperado en endpoint")
+        yield _error_event(
+            input_data, sequence_chat_id,
+            "INTERNAL_ERROR", "Error interno del servidor", str(e)
+        )
+
+    finally:
+        await events.aclose()
+
+
+# === DESCONEXIÓN DEL CLIENTE ===
+
+T = TypeVar("T")
+
+disconnect_metrics: Dict[str, int] = {"client_disconnects": 0}
+
+
+class ClientDisconnected(Exception):
+    """El cliente cerró la conexión antes de recibir la respuesta."""
+
+
+async def run_until_disconnected(work: Awaitable[T], disconnected: Callable[[], Awaitable]) -> T:
+    """
+    Espera work; si antes retorna disconnected() (el cliente se fue), cancela
+    work y lanza ClientDisconnected. La cancelación llega hasta
+    _process_query: corta los statements en curso en la BD y cierra el
+    streaming del LLM (si otra solicitud comparte el single-flight, la
+    ejecución sigue para ella).
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            # Esperar a que se liberen conexiones y reservas antes de seguir
+            await asyncio.gather(task, return_exceptions=True)
+
+    if task.cancelled():
+        disconnect_metrics["client_disconnects"] += 1
+        raise ClientDisconnected()
+    return task.result()
+
+
+async def _http_disconnected(request: Request) -> None:
+    """Retorna cuando llega http.disconnect (el cuerpo ya se leyó)."""
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+def cancellation_status() -> Dict[str, int]:
+    """Desconexiones y statements cancelados (para /health)."""
+    return {**disconnect_metrics, **cancellation.status()}
+
+
+# === ENDPOINTS PRINCIPALES ===
 
 @router.post("/")
-async def query_patient(input_data: QueryInput, db: Session = Depends(get_db)):
+async def query_patient(input_data: QueryInput, request: Request):
     """
     Endpoint principal de consulta RAG con validación de seguridad.
     ✅ FIX JAILBREAK: Validación estricta de inputs
+
+    Si el cliente se desconecta antes de la respuesta, la consulta se
+    cancela (BD y LLM) en lugar de terminarla para nadie.
     """
-    start_time = time.time()
-    timestamp = get_iso_timestamp()
     sequence_chat_id = 1
 
     # ✅ VALIDACIÓN DE SEGURIDAD
     is_valid, error_msg = validate_query_input(input_data)
     if not is_valid:
         logger.warning(f"⚠️ Input inválido rechazado: {error_msg}")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "INVALID_INPUT",
-                "message": error_msg,
-                "details": "Verifica que los datos sean correctos"
-            }
-        }
+        return _event_payload(_error_event(
+            input_data, sequence_chat_id,
+            "INVALID_INPUT", error_msg, "Verifica que los datos sean correctos"
+        ))
     
     # ✅ SANITIZAR NÚMERO DE DOCUMENTO
     sanitized_doc_number = sanitize_document_number(input_data.document_number)
     logger.info(f"📝 Query para paciente: {input_data.document_type_id}-{sanitized_doc_number}")
 
+    # Misma secuencia que /query/stream: aquí solo importa el evento final
+    async def final_event():
+        last = None
+        async for event in query_events(input_data, sanitized_doc_number, sequence_chat_id):
+            last = event
+        return last
+
     try:
-        return await asyncio.wait_for(
-            _process_query(input_data, db, start_time, timestamp, sequence_chat_id, sanitized_doc_number),
-            timeout=TOTAL_REQUEST_TIMEOUT_SECONDS
-        )
-    
-    except asyncio.TimeoutError:
-        logger.error(f"Request timeout después de {TOTAL_REQUEST_TIMEOUT_SECONDS}s")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "REQUEST_TIMEOUT",
-                "message": f"La solicitud excedió el tiempo máximo de {TOTAL_REQUEST_TIMEOUT_SECONDS} segundos",
-                "details": "Intente nuevamente con una pregunta más específica"
-            }
-        }
-    
-    except asyncio.CancelledError:
-        logger.warning("Request cancelado por el cliente")
-        raise
-    
-    except Exception as e:
-        logger.exception("Error inesperado en endpoint")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "INTERNAL_ERROR",
-                "message": "Error interno del servidor",
-                "details": str(e)
-            }
-        }
+        event = await run_until_disconnected(final_event(), lambda: _http_disconnected(request))
+    except ClientDisconnected:
+        logger.info(f"Cliente desconectado, consulta cancelada - Session: {input_data.session_id}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    return _event_payload(event)
+
+
+STREAM_FORMATS = {
+    # formato -> (media type, serialización de un evento)
+    "sse": (
+        "text/event-stream",
+        lambda event: f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+    ),
+    "ndjson": (
+        "application/x-ndjson",
+        lambda event: json.dumps(event, ensure_ascii=False, default=str) + "\n"
+    ),
+}
+
+
+@router.post("/stream")
+async def query_patient_stream(
+    input_data: QueryInput,
+    format: str = Query("sse", pattern="^(sse|ndjson)$", description="sse o ndjson")
+):
+    """
+    Variante en streaming de POST /query/ para clientes sin WebSocket: emite
+    los mismos eventos que el WebSocket (status, stream_start, token,
+    stream_end, complete / error) como Server-Sent Events o NDJSON, con los
+    mismos timeouts, fallback y fuentes que la respuesta REST.
+    """
+    media_type, serialize = STREAM_FORMATS[format]
+
+    is_valid, error_msg = validate_query_input(input_data)
+    if not is_valid:
+        logger.warning(f"⚠️ Input inválido rechazado: {error_msg}")
+        events = iter([_error_event(
+            input_data, 1, "INVALID_INPUT", error_msg, "Verifica que los datos sean correctos"
+        )])
+        return StreamingResponse((serialize(event) for event in events), media_type=media_type)
+
+    sanitized_doc_number = sanitize_document_number(input_data.document_number)
+    logger.info(f"📝 Query (stream {format}) para paciente: {input_data.document_type_id}-{sanitized_doc_number}")
+
+    # Si el cliente se desconecta, StreamingResponse cancela body(): la
+    # cancelación llega a query_events y de ahí a la BD y al LLM
+    async def body():
+        async for event in query_events(input_data, sanitized_doc_number):
+            yield serialize(event)
+
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        # Sin buffering en proxies: cada evento sale apenas se genera
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 async def _process_query(
     input_data: QueryInput,
-    db: Session,
     start_time: float,
-    timestamp: str,
     sequence_chat_id: int,
-    sanitized_doc_number: str  # ✅ Usar documento sanitizado
-) -> dict:
-    """Lógica principal del procesamiento de la query"""
+    sanitized_doc_number: str,  # ✅ Usar documento sanitizado
+    deadline: Optional[float] = None  # loop.time() límite de toda la solicitud
+) -> AsyncIterator[dict]:
+    """Lógica principal del procesamiento de la query, como secuencia de eventos"""
     
     logger.info(f"Procesando query - Session: {input_data.session_id}")
 
     # 1. BUSCAR PACIENTE (usando documento sanitizado)
+    yield {"type": "status", "message": "Buscando información del paciente"}
     try:
-        patient_info, clinical_data = fetch_patient_and_records(
-            db=db,
+        # La sesión se abre en el shard/réplica del paciente y se cierra al terminar
+        # En un hilo: si se cancela la solicitud se cancela también en la BD
+        patient_info, clinical_data = await run_cancellable(
+            fetch_patient_and_records_by_document,
             document_type_id=input_data.document_type_id,
-            document_number=sanitized_doc_number  # ✅ Sanitizado
+            document_number=sanitized_doc_number,  # ✅ Sanitizado
+            max_staleness=CLINICAL_READ_MAX_STALENESS_SECONDS
         )
     except Exception as e:
         logger.error(f"Error en búsqueda de paciente: {type(e).__name__}")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "DATABASE_ERROR",
-                "message": "Error al buscar datos del paciente",
-                "details": str(e)
-            }
-        }
+        yield _error_event(
+            input_data, sequence_chat_id,
+            "DATABASE_ERROR", "Error al buscar datos del paciente", str(e)
+        )
+        return
 
     if not patient_info:
         doc_type = get_document_type_name(input_data.document_type_id)
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "PATIENT_NOT_FOUND",
-                "message": f"No se encontró paciente con documento {doc_type} {sanitized_doc_number}",
-                "details": "Verifique el tipo y número de documento"
+        yield _error_event(
+            input_data, sequence_chat_id,
+            "PATIENT_NOT_FOUND",
+            f"No se encontró paciente con documento {doc_type} {sanitized_doc_number}",
+            "Verifique el tipo y número de documento"
+        )
+        return
+
+    # Extraer info del paciente
+    patient_id = getattr(patient_info, 'patient_id', None)
+    first_name = getattr(patient_info, 'first_name', 'Nombre')
+    first_surname = getattr(patient_info, 'first_surname', 'Apellido')
+    second_surname = getattr(patient_info, 'second_surname', '')
+    document_number = getattr(patient_info, 'document_number', 'No disponible')
+    doc_type = get_document_type_name(input_data.document_type_id)
+    
+    full_name = f"{first_name} {first_surname}"
+    if second_surname:
+        full_name += f" {second_surname}"
+
+    patient_payload = {
+        "patient_id": patient_id,
+        "full_name": full_name,
+        "document_type": doc_type,
+        "document_number": document_number
+    }
+
+    # 2. RESPUESTA POR PLANTILLA (preguntas estructuradas: sin búsqueda ni LLM)
+    if settings.template_answers_enabled:
+        template = answer_from_template(input_data.question, clinical_data.records)
+        if template is not None:
+            try:
+                sources = build_sources_from_real_data(template.records, [], sequence_counter=1)
+            except Exception as e:
+                logger.warning(f"Error construyendo sources: {type(e).__name__}")
+                sources = []
+            yield {
+                "type": "complete",
+                "status": "success",
+                "session_id": input_data.session_id,
+                "sequence_chat_id": sequence_chat_id,
+                "timestamp": get_iso_timestamp(),
+                "patient_info": patient_payload,
+                "answer": {
+                    "text": template.text,
+                    "confidence": 1.0,
+                    "model_used": "template"
+                },
+                "sources": sources,
+                "metadata": {
+                    "total_records_analyzed": (
+                        len(clinical_data.records.appointments) +
+                        len(clinical_data.records.medical_records) +
+                        len(clinical_data.records.prescriptions) +
+                        len(clinical_data.records.diagnoses)
+                    ),
+                    "vector_chunks_used": 0,
+                    "query_time_ms": int((time.time() - start_time) * 1000),
+                    "sources_used": len(sources),
+                    "template_intent": template.intent,
+                    "cached": False
+                }
             }
-        }
+            return
 
-    # 2. VECTOR SEARCH CON TIMEOUT
-    similar_chunks = []
+    # 3. RESPUESTA EN CACHE (misma pregunta sobre la misma versión de la historia)
+    answer_key = None
+    if clinical_data.chart_version is not None:
+        answer_key = answer_cache.key(
+            patient_info.patient_id,
+            clinical_data.chart_version,
+            input_data.question,
+            llm_service.prompt_version
+        )
+    if answer_key is not None and answer_cache.enabled:
+        cached = answer_cache.get(answer_key)
+        if cached is not None:
+            logger.info(f"Respuesta servida desde cache - Session: {input_data.session_id}")
+            yield _cached_event(cached, input_data, sequence_chat_id, start_time, "exact", 1.0)
+            return
+
+    # 4. EMBEDDING DE LA PREGUNTA (vector search y cache semántico)
+    yield {"type": "status", "message": "Analizando registros médicos"}
+    loop = asyncio.get_running_loop()
+    vector_deadline = loop.time() + VECTOR_SEARCH_TIMEOUT_SECONDS
+    question_embedding = None
     try:
-        similar_chunks = await asyncio.wait_for(
-            search_similar_chunks(
-                patient_id=getattr(patient_info, 'patient_id', None),
-                question=input_data.question,
-                k=15,
-                min_score=0.3
-            ),
+        question_embedding = await asyncio.wait_for(
+            get_embedding(input_data.question),
             timeout=VECTOR_SEARCH_TIMEOUT_SECONDS
         )
     except asyncio.TimeoutError:
-        logger.warning(f"Vector search timeout después de {VECTOR_SEARCH_TIMEOUT_SECONDS}s")
+        logger.warning(f"Embedding timeout después de {VECTOR_SEARCH_TIMEOUT_SECONDS}s")
     except Exception as e:
-        logger.warning(f"Vector search falló: {type(e).__name__}")
+        logger.warning(f"Embedding de la pregunta falló: {type(e).__name__}")
 
-    # 3. CONSTRUIR CONTEXTO
+    # 5. VECTOR SEARCH CON TIMEOUT (con el embedding ya calculado)
+    similar_chunks = []
+    if question_embedding is not None:
+        try:
+            similar_chunks = await asyncio.wait_for(
+                search_similar_chunks(
+                    patient_id=getattr(patient_info, 'patient_id', None),
+                    question=input_data.question,
+                    k=15,
+                    min_score=0.3,
+                    question_embedding=question_embedding
+                ),
+                timeout=max(vector_deadline - loop.time(), 0)
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Vector search timeout después de {VECTOR_SEARCH_TIMEOUT_SECONDS}s")
+        except Exception as e:
+            logger.warning(f"Vector search falló: {type(e).__name__}")
+
+    # 6. CONSTRUIR CONTEXTO
     try:
-        context = build_context_from_real_data(
+        context = build_context(
             patient_info=patient_info,
             clinical_records=clinical_data.records,
-            similar_chunks=similar_chunks
+            similar_chunks=similar_chunks,
+            chart_version=clinical_data.chart_version
         )
     except Exception as e:
         logger.error(f"Error construyendo contexto: {type(e).__name__}")
-        return {
-            "status": "error",
-            "session_id": input_data.session_id,
-            "sequence_chat_id": sequence_chat_id,
-            "timestamp": get_iso_timestamp(),
-            "error": {
-                "code": "CONTEXT_BUILD_ERROR",
-                "message": "Error al construir contexto clínico",
-                "details": str(e)
-            }
-        }
-
-    # Extraer info del paciente
-    patient_id = getattr(patient_info, 'patient_id', None)
-    first_name = getattr(patient_info, 'first_name', 'Nombre')
-    first_surname = getattr(patient_info, 'first_surname', 'Apellido')
-    second_surname = getattr(patient_info, 'second_surname', '')
-    document_number = getattr(patient_info, 'document_number', 'No disponible')
-    doc_type = get_document_type_name(input_data.document_type_id)
-    
-    full_name = f"{first_name} {first_surname}"
-    if second_surname:
-        full_name += f" {second_surname}"
+        yield _error_event(
+            input_data, sequence_chat_id,
+            "CONTEXT_BUILD_ERROR", "Error al construir contexto clínico", str(e)
+        )
+        return
 
-    # 4. VERIFICAR SI HAY DATOS (Caso: sin datos)
+    # 7. VERIFICAR SI HAY DATOS (Caso: sin datos)
     total_records = (
         len(clinical_data.records.appointments) +
         len(clinical_data.records.medical_records) +
@@ -616,17 +788,13 @@ async def _process_query(
     )
 
     if total_records == 0:
-        return {
+        yield {
+            "type": "complete",
             "status": "success",
             "session_id": input_data.session_id,
             "sequence_chat_id": sequence_chat_id,
             "timestamp": get_iso_timestamp(),
-            "patient_info": {
-                "patient_id": patient_id,
-                "full_name": full_name,
-                "document_type": doc_type,
-                "document_number": document_number
-            },
+            "patient_info": patient_payload,
             "answer": {
                 "text": f"El paciente {full_name} no tiene citas médicas registradas en el sistema.",
                 "confidence": 1.0,
@@ -635,115 +803,138 @@ async def _process_query(
             "sources": [],
             "metadata": {
                 "total_records_analyzed": 0,
+                "vector_chunks_used": 0,
                 "query_time_ms": int((time.time() - start_time) * 1000),
                 "sources_used": 0
             }
         }
+        return
 
-    # 5. LLAMAR AL LLM CON TIMEOUT Y RETRY
-    llm_response = None
-    llm_attempts = 0
-    max_attempts = 2
-    
-    while llm_attempts < max_attempts and not llm_response:
-        llm_attempts += 1
-        try:
-            logger.info(f"Intento {llm_attempts}/{max_attempts} de llamada al LLM")
-            
-            llm_response = await asyncio.wait_for(
-                llm_service.run_llm(
-                    question=input_data.question,
-                    context=context
-                ),
-                timeout=LLM_TIMEOUT_SECONDS
+    # 8. MODELO SEGÚN LA PREGUNTA Y CACHE SEMÁNTICO (pregunta parecida)
+    # El nivel depende del contexto armado; solo se reutilizan respuestas
+    # generadas con el mismo nivel (modelo y tope de tokens)
+    route = route_question(input_data.question, context.tokens, sum(context.items_used.values()))
+    logger.info(f"Modelo elegido: {route.model} ({route.tier}: {', '.join(route.reasons)})")
+
+    semantic_similarity = None
+    if question_embedding is not None and answer_key is not None and semantic_answer_cache.enabled:
+        match = semantic_answer_cache.lookup(
+            semantic_answer_cache.scope(answer_key), input_data.question, question_embedding, route.tier
+        )
+        semantic_similarity = match.similarity
+        if match.payload is not None:
+            logger.info(
+                f"Respuesta servida desde cache semántico (similitud {match.similarity:.3f}) "
+                f"- Session: {input_data.session_id}"
             )
-            
-            if not llm_response or not hasattr(llm_response, 'text') or not llm_response.text:
-                if llm_attempts < max_attempts:
-                    logger.warning(f"Respuesta LLM inválida, reintentando...")
-                    await asyncio.sleep(0.5)
-                    continue
-                else:
-                    raise ValueError("Respuesta del LLM vacía")
-            
-            if len(llm_response.text.strip()) < 10:
-                if llm_attempts < max_attempts:
-                    logger.warning(f"Respuesta LLM muy corta, reintentando...")
-                    await asyncio.sleep(0.5)
-                    continue
-                else:
-                    raise ValueError("Respuesta del LLM demasiado corta")
-            
-            break
-        
-        except asyncio.TimeoutError:
-            logger.error(f"⏱️ LLM timeout en intento {llm_attempts}")
-            if llm_attempts >= max_attempts:
-                fallback_text = _generate_fallback_response(clinical_data.records, input_data.question)
-                
-                return {
-                    "status": "success",
-                    "session_id": input_data.session_id,
-                    "sequence_chat_id": sequence_chat_id,
-                    "timestamp": get_iso_timestamp(),
-                    "patient_info": {
-                        "patient_id": patient_id,
-                        "full_name": full_name,
-                        "document_type": doc_type,
-                        "document_number": document_number
-                    },
-                    "answer": {
-                        "text": fallback_text,
-                        "confidence": 0.65,
-                        "model_used": "fallback-system"
-                    },
-                    "sources": [],
-                    "metadata": {
-                        "total_records_analyzed": total_records,
-                        "query_time_ms": int((time.time() - start_time) * 1000),
-                        "sources_used": 0,
-                        "context_tokens": 0
-                    }
-                }
-            else:
-                await asyncio.sleep(0.5)
-                continue
-        
-        except Exception as e:
-            logger.error(f"Error en intento {llm_attempts} del LLM: {e}")
-            
-            if llm_attempts >= max_attempts:
-                fallback_text = _generate_fallback_response(clinical_data.records, input_data.question)
-                
-                return {
-                    "status": "success",
-                    "session_id": input_data.session_id,
-                    "sequence_chat_id": sequence_chat_id,
-                    "timestamp": get_iso_timestamp(),
-                    "patient_info": {
-                        "patient_id": patient_id,
-                        "full_name": full_name,
-                        "document_type": doc_type,
-                        "document_number": document_number
-                    },
-                    "answer": {
-                        "text": fallback_text,
-                        "confidence": 0.65,
-                        "model_used": "fallback-system"
-                    },
-                    "sources": [],
-                    "metadata": {
-                        "total_records_analyzed": total_records,
-                        "query_time_ms": int((time.time() - start_time) * 1000),
-                        "sources_used": 0,
-                        "context_tokens": 0
-                    }
-                }
-            else:
-                await asyncio.sleep(0.5)
-                continue
+            yield _cached_event(
+                match.payload, input_data, sequence_chat_id, start_time, "semantic", match.similarity
+            )
+            return
+
+    # 9. LLAMAR AL LLM EN STREAMING CON TIMEOUT
+    # El turno lo da el control de admisión (concurrencia, tokens/minuto y
+    # cola con deadline); si no hay tiempo para obtenerlo se rechaza ya.
+    # Reintentos, hedging y circuit breaker los aplica llm_gateway antes del
+    # primer token; si el proveedor está caído se responde con el fallback.
+    yield {"type": "status", "message": "Generando respuesta"}
+    llm_response = None
+    llm_stream = None
+    time_to_first_token_ms = None
+    llm_deadline = loop.time() + LLM_TIMEOUT_SECONDS
+    if deadline is not None:
+        llm_deadline = min(llm_deadline, deadline)
+
+    estimated_tokens = llm_service.estimate_tokens(input_data.question, context.tokens, route.max_tokens)
+    try:
+        ticket = await llm_admission.acquire(estimated_tokens, deadline=llm_deadline)
+    except LLMAdmissionError as e:
+        yield _error_event(
+            input_data, sequence_chat_id,
+            "LLM_OVERLOADED",
+            "El servicio de IA está saturado, intente nuevamente en unos segundos",
+            str(e)
+        )
+        return
+
+    try:
+        llm_stream = await asyncio.wait_for(
+            llm_service.run_llm(
+                question=input_data.question,
+                context=context.patient_text,
+                max_tokens=route.max_tokens,
+                stream=True,
+                model=route.model,
+                question_context=context.question_text
+            ),
+            timeout=max(llm_deadline - loop.time(), 0)
+        )
+        deltas = llm_stream.__aiter__()
+        while True:
+            try:
+                delta = await asyncio.wait_for(
+                    deltas.__anext__(),
+                    timeout=max(llm_deadline - loop.time(), 0)
+                )
+            except StopAsyncIteration:
+                break
+            if time_to_first_token_ms is None:
+                time_to_first_token_ms = int((time.time() - start_time) * 1000)
+                yield {"type": "stream_start"}
+            yield {"type": "token", "token": delta}
 
-    # 6. CONSTRUIR SOURCES
+        llm_response = llm_stream.response
+
+    except LLMUnavailableError as e:
+        logger.warning(f"LLM no disponible, se usa el fallback: {e}")
+
+    except asyncio.TimeoutError:
+        logger.error("⏱️ LLM timeout")
+
+    except Exception as e:
+        logger.error(f"Error en la llamada al LLM: {type(e).__name__}: {e}")
+
+    finally:
+        # Con la respuesta completa se corrige la reserva con el uso real
+        ticket.release(
+            estimated_tokens - route.max_tokens + llm_response.tokens_used
+            if llm_response is not None else None
+        )
+        # Cortado a mitad (error, timeout o cliente desconectado): cerrar la
+        # conexión para que el proveedor deje de generar tokens
+        if llm_stream is not None and llm_response is None:
+            await llm_stream.aclose()
+
+    if time_to_first_token_ms is not None:
+        yield {"type": "stream_end"}
+
+    if llm_response is None:
+        # El texto del fallback reemplaza a los tokens parciales que se hayan enviado
+        fallback_text = _generate_fallback_response(clinical_data.records, input_data.question)
+        yield {
+            "type": "complete",
+            "status": "success",
+            "session_id": input_data.session_id,
+            "sequence_chat_id": sequence_chat_id,
+            "timestamp": get_iso_timestamp(),
+            "patient_info": patient_payload,
+            "answer": {
+                "text": fallback_text,
+                "confidence": 0.65,
+                "model_used": "fallback-system"
+            },
+            "sources": [],
+            "metadata": {
+                "total_records_analyzed": total_records,
+                "vector_chunks_used": len(similar_chunks),
+                "query_time_ms": int((time.time() - start_time) * 1000),
+                "sources_used": 0,
+                "context_tokens": context.tokens
+            }
+        }
+        return
+
+    # 10. CONSTRUIR SOURCES
     try:
         sources = build_sources_from_real_data(
             clinical_data.records, 
@@ -754,18 +945,14 @@ async def _process_query(
         logger.warning(f"Error construyendo sources: {type(e).__name__}")
         sources = []
 
-    # 7. RESPUESTA EXITOSA (Formato EXACTO según especificación)
+    # 11. RESPUESTA EXITOSA (Formato EXACTO según especificación)
     response = {
+        "type": "complete",
         "status": "success",
         "session_id": input_data.session_id,
         "sequence_chat_id": sequence_chat_id,
         "timestamp": get_iso_timestamp(),
-        "patient_info": {
-            "patient_id": patient_id,
-            "full_name": full_name,
-            "document_type": doc_type,
-            "document_number": document_number
-        },
+        "patient_info": patient_payload,
         "answer": {
             "text": llm_response.text,
             "confidence": getattr(llm_response, 'confidence', 0.94),
@@ -774,11 +961,79 @@ async def _process_query(
         "sources": sources,
         "metadata": {
             "total_records_analyzed": total_records,
+            "vector_chunks_used": len(similar_chunks),
             "query_time_ms": int((time.time() - start_time) * 1000),
             "sources_used": len(sources),
-            "context_tokens": getattr(llm_response, 'tokens_used', 0)
+            # Desde que llegó la pregunta y desde la llamada al LLM
+            "time_to_first_token_ms": time_to_first_token_ms,
+            "llm_time_to_first_token_ms": llm_stream.ttft_ms,
+            "context_tokens": context.tokens,
+            "completion_tokens": getattr(llm_response, 'tokens_used', 0),
+            # Tokens del prompt servidos desde el cache de prompts del proveedor
+            "prompt_tokens": llm_response.prompt_tokens,
+            "cached_tokens": llm_response.cached_tokens,
+            "model_tier": route.tier,
+            "model_route_reasons": list(route.reasons),
+            "llm_backend": llm_response.backend,
+            "cached": False,
+            # Pregunta guardada más parecida (para ajustar el umbral del cache semántico)
+            "cache_similarity": round(semantic_similarity, 4) if semantic_similarity is not None else None,
+            "semantic_cache_hit_rate": round(semantic_answer_cache.hit_rate, 3)
         }
     }
 
+    if answer_key is not None:
+        payload = _cacheable_payload(response)
+        if answer_cache.enabled:
+            answer_cache.put(answer_key, payload)
+        if question_embedding is not None and semantic_answer_cache.enabled:
+            semantic_answer_cache.put(
+                semantic_answer_cache.scope(answer_key), input_data.question, question_embedding,
+                payload, route.tier
+            )
+
     logger.info(f"Query completada exitosamente en {response['metadata']['query_time_ms']}ms")
-    return response
\ No newline at end of file
+    yield response
+
+
+# === EXPORTACIÓN DE HISTORIA CLÍNICA ===
+
+@router.get("/history/{document_type_id}/{document_number}/export")
+def export_patient_history(
+    document_type_id: int,
+    document_number: str,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Exporta la historia clínica completa del paciente en NDJSON.
+    Las filas se leen con cursor del servidor y se envían por lotes, así la
+    memoria del proceso no crece con el tamaño de la historia.
+    """
+    sanitized_doc_number = sanitize_document_number(document_number)
+    db = open_document_session(document_type_id, sanitized_doc_number, HISTORY_EXPORT_MAX_STALENESS_SECONDS)
+    patient = None
+    if db is not None:
+        try:
+            patient = get_patient_by_document(db, document_type_id, sanitized_doc_number)
+        finally:
+            db.close()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Paciente no encontrado")
+
+    logger.info(f"Exportando historia del paciente {patient.patient_id} para usuario {current_user.user_id}")
+
+    def ndjson_lines():
+        # Sesión propia, abierta mientras se envía el cuerpo
+        stream_db = open_patient_session(patient.patient_id, HISTORY_EXPORT_MAX_STALENESS_SECONDS)
+        try:
+            yield from iter_patient_history_ndjson(stream_db, patient.patient_id)
+        finally:
+            stream_db.close()
+
+    return StreamingResponse(
+        ndjson_lines(),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="historia_{patient.patient_id}.ndjson"'
+        }
+    )
\ No newline at end of file
@@ -4,7 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from typing import List
 from app.schemas.user import UserResponse, UserUpdate
-from app.database.database import get_db
+from app.database.database import get_db, get_read_db
 from app.services.user import UserService  # ← Import directo
 from app.core.security import get_current_user
 from app.models.user import User
@@ -14,6 +14,9 @@ router = APIRouter(
     tags=["Users"]
 )
 
+# Atraso tolerado por el listado de usuarios cuando lee de una réplica (segundos)
+LIST_USERS_MAX_STALENESS_SECONDS = 10
+
 
 @router.get(
     "/",
@@ -23,7 +26,7 @@ router = APIRouter(
 def list_users(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db(LIST_USERS_MAX_STALENESS_SECONDS)),
     current_user: User = Depends(get_current_user)
 ):
     """
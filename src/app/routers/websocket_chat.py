@@ -5,20 +5,17 @@ from typing import Optional
 import json
 import logging
 import asyncio
+from contextlib import aclosing
 from datetime import datetime, timezone
 
 from app.services.auth_utils import verify_token
-from app.services.clinical_service import fetch_patient_and_records
-from app.services.vector_search import search_similar_chunks
-from app.services.llm_service import llm_service
-from app.database.database import SessionLocal
+from app.routers.query import ClientDisconnected, QueryInput, query_events, run_until_disconnected
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 # Configuración de timeouts
-STREAMING_CHUNK_DELAY = 0.05
 MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # 10MB
 WEBSOCKET_TIMEOUT = 300  # 5 minutos
 
@@ -79,6 +76,45 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
+class ClientInbox:
+    """
+    Lee los mensajes del WebSocket en una tarea propia, así la desconexión
+    del cliente se detecta también mientras se procesa una query (y la
+    query se cancela en lugar de terminarse para nadie).
+    """
+
+    def __init__(self, websocket: WebSocket, max_pending: int):
+        self._websocket = websocket
+        self._messages: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.disconnected = asyncio.Event()
+        self._task = asyncio.create_task(self._read())
+
+    async def _read(self):
+        message = {"type": "websocket.disconnect", "code": status.WS_1006_ABNORMAL_CLOSURE}
+        try:
+            while True:
+                received = await self._websocket.receive()
+                if received["type"] == "websocket.disconnect":
+                    message = received
+                    break
+                await self._messages.put(received)
+        except Exception as e:
+            logger.info(f"Lectura del WebSocket terminada: {type(e).__name__}")
+        finally:
+            self.disconnected.set()
+        await self._messages.put(message)
+
+    async def receive_text(self) -> str:
+        """Como WebSocket.receive_text, desde la cola de mensajes recibidos."""
+        message = await self._messages.get()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        return message["text"]
+
+    def close(self):
+        self._task.cancel()
+
+
 def get_iso_timestamp() -> str:
     """Retorna timestamp en formato ISO 8601"""
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -152,6 +188,7 @@ async def websocket_endpoint(
     Requiere autenticación JWT via query parameter.
     """
     user_id = None
+    inbox = None
     
     try:
         # SEGURIDAD: Validar token antes de aceptar conexión
@@ -175,12 +212,14 @@ async def websocket_endpoint(
             "timestamp": get_iso_timestamp()
         })
         
+        inbox = ClientInbox(websocket, manager.max_messages_per_minute)
+        
         # Loop principal
         while True:
             try:
                 # Recibir mensaje con timeout
                 raw_data = await asyncio.wait_for(
-                    websocket.receive_text(),
+                    inbox.receive_text(),
                     timeout=WEBSOCKET_TIMEOUT
                 )
                 
@@ -243,8 +282,11 @@ async def websocket_endpoint(
                         })
                         continue
                     
-                    # Procesar query
-                    await process_query(websocket, data, user_id)
+                    # Procesar query (se cancela si el cliente se desconecta)
+                    await run_until_disconnected(
+                        process_query(websocket, data, user_id),
+                        inbox.disconnected.wait
+                    )
                 
                 else:
                     await manager.send_json(websocket, {
@@ -263,6 +305,10 @@ async def websocket_endpoint(
                 logger.info(f"Cliente {user_id} desconectado normalmente")
                 break
             
+            except ClientDisconnected:
+                logger.info(f"Cliente {user_id} desconectado durante una query, se canceló")
+                break
+            
             except Exception as e:
                 logger.error(f"Error procesando mensaje de usuario {user_id}: {str(e)}")
                 await manager.send_json(websocket, {
@@ -278,132 +324,32 @@ async def websocket_endpoint(
         logger.error(f"Error en WebSocket: {str(e)}")
     
     finally:
+        if inbox is not None:
+            inbox.close()
         if user_id:
             manager.disconnect(user_id)
 
 
 async def process_query(websocket: WebSocket, data: dict, user_id: int):
     """
-    Procesa una query y envía la respuesta con streaming.
+    Procesa una query y envía la respuesta con streaming: los mismos eventos
+    que POST /query/stream (status, stream_start, token, stream_end,
+    complete / error), cada uno como un frame apenas se genera.
     """
-    db = SessionLocal()
-    
     try:
         # Sanitizar inputs
-        question = sanitize_input(data["question"], max_length=1000)
-        document_number = sanitize_input(data["document_number"], max_length=50)
-        session_id = sanitize_input(data["session_id"], max_length=100)
-        
-        # Status: Buscando paciente
-        await manager.send_json(websocket, {
-            "type": "status",
-            "message": "Buscando información del paciente"
-        })
-        
-        # Buscar paciente
-        patient_info, clinical_data = fetch_patient_and_records(
-            db=db,
+        query_input = QueryInput(
+            user_id=str(user_id),
+            session_id=sanitize_input(data["session_id"], max_length=100),
             document_type_id=data["document_type_id"],
-            document_number=document_number
+            document_number=sanitize_input(data["document_number"], max_length=50),
+            question=sanitize_input(data["question"], max_length=1000)
         )
-        
-        if not patient_info:
-            await manager.send_json(websocket, {
-                "type": "error",
-                "error": {
-                    "code": "PATIENT_NOT_FOUND",
-                    "message": "Paciente no encontrado"
-                }
-            })
-            return
-        
-        # Status: Búsqueda vectorial
-        await manager.send_json(websocket, {
-            "type": "status",
-            "message": "Analizando registros médicos"
-        })
-        
-        # Búsqueda vectorial
-        similar_chunks = await search_similar_chunks(
-            patient_id=patient_info.patient_id,
-            question=question,
-            k=15,
-            min_score=0.3
-        )
-        
-        # Construir contexto
-        from app.routers.query import build_context_from_real_data
-        context = build_context_from_real_data(
-            patient_info=patient_info,
-            clinical_records=clinical_data.records,
-            similar_chunks=similar_chunks
-        )
-        
-        # Status: Generando respuesta
-        await manager.send_json(websocket, {
-            "type": "status",
-            "message": "Generando respuesta"
-        })
-        
-        # Inicio de streaming
-        await manager.send_json(websocket, {
-            "type": "stream_start"
-        })
-        
-        # Llamar al LLM
-        llm_response = await llm_service.run_llm(
-            question=question,
-            context=context
-        )
-        
-        # Enviar tokens uno por uno
-        if llm_response and llm_response.text:
-            words = llm_response.text.split()
-            for word in words:
-                await manager.send_json(websocket, {
-                    "type": "token",
-                    "token": word + " "
-                })
-                await asyncio.sleep(STREAMING_CHUNK_DELAY)
-        
-        # Fin de streaming
-        await manager.send_json(websocket, {
-            "type": "stream_end"
-        })
-        
-        # Construir sources
-        from app.routers.query import build_sources_from_real_data
-        sources = build_sources_from_real_data(
-            clinical_data.records,
-            similar_chunks,
-            sequence_counter=1
-        )
-        
-        # Respuesta completa
-        await manager.send_json(websocket, {
-            "type": "complete",
-            "session_id": session_id,
-            "timestamp": get_iso_timestamp(),
-            "patient_info": {
-                "patient_id": patient_info.patient_id,
-                "full_name": f"{patient_info.first_name} {patient_info.first_surname}",
-                "document_type": "CC",
-                "document_number": document_number
-            },
-            "answer": {
-                "text": llm_response.text,
-                "confidence": llm_response.confidence,
-                "model_used": llm_response.model_used
-            },
-            "sources": sources,
-            "metadata": {
-                "total_records_analyzed": len(clinical_data.records.appointments) + 
-                                        len(clinical_data.records.diagnoses) +
-                                        len(clinical_data.records.prescriptions),
-                "vector_chunks_used": len(similar_chunks),
-                "query_time_ms": 0
-            }
-        })
+
+        # aclosing: si un envío falla, la consulta se cierra ya y no al recolectarla
+        async with aclosing(query_events(query_input, query_input.document_number)) as events:
+            async for event in events:
+                await manager.send_json(websocket, event)
     
     except Exception as e:
         logger.error(f"Error procesando query: {str(e)}")
@@ -413,7 +359,4 @@ async def process_query(websocket: WebSocket, data: dict, user_id: int):
                 "code": "PROCESSING_ERROR",
                 "message": "Error procesando la solicitud"
             }
-        })
-    
-    finally:
-        db.close()
\ No newline at end of file
+        })
\ No newline at end of file
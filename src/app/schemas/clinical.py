@@ -1,6 +1,6 @@
 # src/app/schemas/clinical.py
 from pydantic import BaseModel, Field
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Iterable, Any, Dict
 from datetime import date, time, datetime
 
 # ============================================================================
@@ -26,11 +26,97 @@ class PatientInfo(BaseModel):
         from_attributes = True  # Antes era orm_mode = True
 
 
+# ============================================================================
+# Materialización rápida de filas confiables de la BD
+# ============================================================================
+
+# Defaults por clase, calculados una sola vez: {clase: (defaults, campos)}
+_ROW_DEFAULTS: dict = {}
+
+
+class RowDTO(BaseModel):
+    """
+    Base para DTOs que se construyen desde filas de nuestra propia BD.
+
+    Los métodos trusted/from_row/from_rows crean la instancia sin validación
+    ni coerción (igual que model_construct, pero sin su bucle por campo), así
+    que solo deben usarse con filas cuyas columnas ya tienen el nombre y tipo
+    del DTO. La entrada externa sigue pasando por el constructor normal.
+
+    Los defaults se comparten entre instancias: los RowDTO no deben declarar
+    defaults mutables (default_factory de listas o dicts).
+    """
+
+    @classmethod
+    def _row_defaults(cls) -> tuple:
+        cached = _ROW_DEFAULTS.get(cls)
+        if cached is None:
+            defaults = {
+                name: field.get_default(call_default_factory=True)
+                for name, field in cls.model_fields.items()
+                if not field.is_required()
+            }
+            cached = (defaults, frozenset(cls.model_fields))
+            _ROW_DEFAULTS[cls] = cached
+        return cached
+
+    @classmethod
+    def trusted(cls, **values):
+        """Crea una instancia desde valores confiables, sin validación."""
+        defaults, _ = cls._row_defaults()
+        data = defaults.copy()
+        data.update(values)
+        obj = cls.__new__(cls)
+        object.__setattr__(obj, "__dict__", data)
+        object.__setattr__(obj, "__pydantic_fields_set__", set(values))
+        object.__setattr__(obj, "__pydantic_extra__", None)
+        object.__setattr__(obj, "__pydantic_private__", None)
+        return obj
+
+    @classmethod
+    def from_row(cls, row: Any):
+        return cls.trusted(**dict(zip(row._fields, row)))
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Any]) -> list:
+        """
+        Materializa filas (Row de SQLAlchemy o cualquier tupla con _fields)
+        cuyas columnas coinciden con los campos del DTO.
+        """
+        defaults, field_names = cls._row_defaults()
+        new = cls.__new__
+        set_attr = object.__setattr__
+        items = []
+        keys = None
+        fields_set = None
+        needs_defaults = True
+
+        for row in rows:
+            if keys is None:
+                keys = row._fields
+                fields_set = set(keys) & field_names
+                # Si la query trae todos los campos no hace falta mezclar defaults
+                needs_defaults = fields_set != field_names
+            if needs_defaults:
+                data = defaults.copy()
+                data.update(zip(keys, row))
+            else:
+                data = dict(zip(keys, row))
+            obj = new(cls)
+            set_attr(obj, "__dict__", data)
+            set_attr(obj, "__pydantic_fields_set__", set(fields_set))
+            set_attr(obj, "__pydantic_extra__", None)
+            set_attr(obj, "__pydantic_private__", None)
+            items.append(obj)
+
+        return items
+
+
 # ============================================================================
 # P2-3: DTOs para registros clÃ­nicos
 # ============================================================================
 
-class AppointmentDTO(BaseModel):
+class AppointmentDTO(RowDTO):
     """DTO para citas mÃ©dicas con informaciÃ³n del doctor"""
     appointment_id: int
     patient_id: int
@@ -53,7 +139,7 @@ class AppointmentDTO(BaseModel):
         from_attributes = True
 
 
-class MedicalRecordDTO(BaseModel):
+class MedicalRecordDTO(RowDTO):
     """DTO para registros médicos"""
     medical_record_id: int
     patient_id: int
@@ -68,7 +154,7 @@ class MedicalRecordDTO(BaseModel):
         from_attributes = True
 
 
-class PrescriptionDTO(BaseModel):
+class PrescriptionDTO(RowDTO):
     """DTO para prescripciones con informaciÃ³n del medicamento"""
     prescription_id: int
     medical_record_id: int
@@ -77,7 +163,7 @@ class PrescriptionDTO(BaseModel):
     frequency: Optional[str] = None
     duration: Optional[str] = None
     instruction: Optional[str] = None
-    prescription_date: Optional[datetime] = None
+    prescription_date: Optional[date] = None  # Columna DATE
     alert_generated: Optional[bool] = False
     
     # âœ… Campos del medicamento (agregados mediante JOIN)
@@ -89,7 +175,7 @@ class PrescriptionDTO(BaseModel):
         from_attributes = True
 
 
-class DiagnosisDTO(BaseModel):
+class DiagnosisDTO(RowDTO):
     """DTO para diagnÃ³sticos"""
     record_diagnosis_id: int
     diagnosis_id: int
@@ -109,12 +195,41 @@ class DiagnosisDTO(BaseModel):
 # P2-4: Agrupador de todos los registros clÃ­nicos
 # ============================================================================
 
+class PatientSummaryDTO(BaseModel):
+    """
+    Resumen longitudinal guardado del paciente (ver app.services.patient_summary).
+    years: {"2019": {conteos, motivos, medicamentos, ..., "text"}}
+    conditions: {"E11": {descripción, fechas, conteo, ..., "text"}}
+    """
+    years: Dict[str, dict] = Field(default_factory=dict)
+    conditions: Dict[str, dict] = Field(default_factory=dict)
+    updated_at: Optional[datetime] = None
+
+
 class ClinicalRecords(BaseModel):
     """Agrupa todos los registros clÃ­nicos de un paciente"""
     appointments: List[AppointmentDTO] = Field(default_factory=list)
     medical_records: List[MedicalRecordDTO] = Field(default_factory=list)
     prescriptions: List[PrescriptionDTO] = Field(default_factory=list)
     diagnoses: List[DiagnosisDTO] = Field(default_factory=list)
+    # Historia anterior condensada (None si el paciente aún no tiene resumen)
+    summary: Optional[PatientSummaryDTO] = None
+
+
+# ============================================================================
+# Ventana de historia clínica (límites por tipo y rango de fechas)
+# ============================================================================
+
+class HistoryWindow(BaseModel):
+    """
+    Límites por tipo de registro y fecha mínima que se aplican directamente
+    en SQL. Un valor None significa "sin límite" (historia completa).
+    """
+    appointments_limit: Optional[int] = Field(default=None, ge=1)
+    medical_records_limit: Optional[int] = Field(default=None, ge=1)
+    prescriptions_limit: Optional[int] = Field(default=None, ge=1)
+    diagnoses_limit: Optional[int] = Field(default=None, ge=1)
+    since: Optional[date] = None
 
 
 # ============================================================================
@@ -125,4 +240,6 @@ class ClinicalDataResult(BaseModel):
     """Resultado completo de la bÃºsqueda de datos clÃ­nicos"""
     patient: Optional[PatientInfo] = None
     records: ClinicalRecords
-    has_data: bool = False
\ No newline at end of file
+    has_data: bool = False
+    # Huella de los datos leídos (ver clinical_service.compute_chart_version)
+    chart_version: Optional[str] = None
\ No newline at end of file
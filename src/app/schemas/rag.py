@@ -1,9 +1,9 @@
 # src/app/schemas/rag.py
 from datetime import datetime, date
-from pydantic import BaseModel
 from typing import Optional, Union
+from app.schemas.clinical import RowDTO
 
-class SimilarChunk(BaseModel):
+class SimilarChunk(RowDTO):
     """
     Schema para chunks similares encontrados en búsqueda vectorial.
     Incluye información del doctor cuando el source_type es 'appointment'.
@@ -0,0 +1,310 @@
+# src/app/services/answer_cache.py
+"""
+Cache de respuestas del RAG: coincidencia exacta y semántica.
+
+Varias personas que abren el mismo paciente suelen hacer la misma pregunta
+sobre la misma historia; la respuesta del LLM sería igual. Se guarda el
+evento complete entero (answer, sources, patient_info, metadata) con la clave:
+
+    (patient_id, chart_version, pregunta normalizada, versión del prompt,
+     formato y presupuesto del contexto)
+
+- chart_version (clinical_service.compute_chart_version) cambia con
+  cualquier fila de la historia o del resumen: una respuesta nunca se sirve
+  para datos distintos. Al ver una versión nueva de un paciente se descartan
+  sus respuestas anteriores.
+- La versión del prompt (LLMService.prompt_version) cubre plantilla, modelo
+  y parámetros de generación.
+- ANSWER_CACHE_TTL_SECONDS acota la vida de una entrada aunque nada cambie.
+
+Es un LRU en memoria por proceso, como fragment_cache de rag_context.
+
+semantic_answer_cache cubre las preguntas formuladas de otra manera
+("¿qué medicamentos toma?" / "lista de medicamentos actuales"): por paciente
+guarda un índice pequeño de (embedding de la pregunta, respuesta) para el
+mismo alcance que la clave exacta sin la pregunta, y devuelve la respuesta
+más parecida si la similitud coseno alcanza SEMANTIC_ANSWER_CACHE_THRESHOLD.
+Con pocas preguntas por paciente la búsqueda lineal basta.
+
+Dos preguntas casi idénticas pueden pedir datos distintos ("¿dosis de 500 mg?"
+/ "¿dosis de 850 mg?", "¿tiene alergias?" / "¿no tiene alergias?") y sus
+embeddings quedan muy cerca. Por eso solo se comparan preguntas con la misma
+firma (question_signature): números, referencias de tiempo y negaciones.
+
+Tampoco se reutiliza una respuesta generada con otro nivel de modelo
+(model_router): una respuesta de "fast", con su tope de tokens chico, no sirve
+para una pregunta que se enrutaría a "complex". La versión del prompt cubre
+la configuración del enrutamiento, no el nivel elegido para cada pregunta,
+así que el nivel se guarda con cada entrada y la búsqueda se hace después de
+enrutar.
+"""
+
+import copy
+import math
+import operator
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from app.database.db_config import settings
+
+# Signos que no cambian la pregunta al inicio o al final
+QUESTION_PUNCTUATION = " ¿?¡!.,;:"
+
+
+def normalize_question(question: str) -> str:
+    """Minúsculas, espacios colapsados y sin signos en los extremos."""
+    text = unicodedata.normalize("NFKC", question).casefold()
+    return " ".join(text.split()).strip(QUESTION_PUNCTUATION)
+
+
+# ============================================================================
+# Firma de la pregunta (cache semántico)
+# ============================================================================
+
+NUMBER_WORDS = {
+    "dos": "2", "tres": "3", "cuatro": "4", "cinco": "5", "seis": "6", "siete": "7",
+    "ocho": "8", "nueve": "9", "diez": "10", "once": "11", "doce": "12", "quince": "15",
+    "veinte": "20", "treinta": "30", "cien": "100", "mil": "1000",
+}
+MONTHS = {
+    "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto",
+    "septiembre", "setiembre", "octubre", "noviembre", "diciembre",
+}
+# Prefijos de palabras que fijan el momento o el orden de lo que se pregunta
+TEMPORAL_PREFIXES = ("ultim", "proxim", "siguiente", "anterior", "primer", "hoy", "ayer", "manana")
+NEGATIONS = {"no", "nunca", "jamas", "sin", "ni", "tampoco", "nada", "nadie"}
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def question_signature(question: str) -> tuple:
+    """
+    (números, referencias de tiempo, negaciones) de la pregunta, sin tildes
+    ni mayúsculas. El cache semántico solo reutiliza respuestas de preguntas
+    con la misma firma.
+    """
+    text = unicodedata.normalize("NFKD", question.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+
+    numbers = [number.replace(",", ".") for number in _NUMBER.findall(text)]
+    temporal = []
+    negations = []
+    for word in re.findall(r"[a-z]+", text):
+        if word in NUMBER_WORDS:
+            numbers.append(NUMBER_WORDS[word])
+        elif word in MONTHS:
+            temporal.append(word)
+        elif word in NEGATIONS or word.startswith("ningun"):
+            negations.append(word)
+        else:
+            temporal += [prefix for prefix in TEMPORAL_PREFIXES if word.startswith(prefix)]
+    return tuple(sorted(numbers)), tuple(sorted(temporal)), tuple(sorted(negations))
+
+
+class AnswerCache:
+    """LRU de respuestas completas con invalidación por versión de la historia."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # clave -> (guardada en monotonic, payload)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # patient_id -> (chart_version vigente, claves del paciente)
+        self._patients: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(patient_id: int, chart_version: str, question: str, prompt_version: str) -> tuple:
+        return (
+            patient_id,
+            chart_version,
+            normalize_question(question),
+            prompt_version,
+            settings.rag_context_format,
+            settings.rag_context_max_tokens,
+        )
+
+    def _check_version(self, patient_id: int, chart_version: str) -> Optional[Set[tuple]]:
+        """Claves vigentes del paciente; si su historia cambió descarta las viejas."""
+        current = self._patients.get(patient_id)
+        if current is None:
+            return None
+        if current[0] == chart_version:
+            return current[1]
+        for stale in current[1]:
+            self._entries.pop(stale, None)
+        del self._patients[patient_id]
+        self.invalidations += 1
+        return None
+
+    def _evict(self, key: tuple) -> None:
+        self._entries.pop(key, None)
+        tracked = self._patients.get(key[0])
+        if tracked is not None:
+            tracked[1].discard(key)
+            if not tracked[1]:
+                del self._patients[key[0]]
+
+    def get(self, key: tuple) -> Optional[dict]:
+        """Copia del payload guardado, o None."""
+        with self._lock:
+            self._check_version(key[0], key[1])
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                self._evict(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: tuple, payload: dict) -> None:
+        with self._lock:
+            keys = self._check_version(key[0], key[1])
+            if keys is None:
+                keys = set()
+                self._patients[key[0]] = (key[1], keys)
+            keys.add(key)
+            self._entries[key] = (time.monotonic(), copy.deepcopy(payload))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._evict(oldest)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._patients.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+class SemanticMatch(NamedTuple):
+    # Copia de la respuesta guardada si la similitud alcanzó el umbral
+    payload: Optional[dict]
+    # Mejor similitud encontrada (None si el paciente no tiene preguntas)
+    similarity: Optional[float]
+
+
+def _unit(vector: List[float]) -> Tuple[float, ...]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return tuple(x / norm for x in vector)
+
+
+class SemanticAnswerCache:
+    """Índice en memoria por paciente de preguntas ya respondidas."""
+
+    def __init__(self, max_patients: int, entries_per_patient: int, threshold: float, ttl_seconds: float):
+        self.max_patients = max_patients
+        self.entries_per_patient = entries_per_patient
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        # patient_id -> (alcance, [(guardada en monotonic, (nivel, firma), embedding unitario, payload)])
+        self._indexes: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_patients > 0 and self.entries_per_patient > 0
+
+    @staticmethod
+    def scope(answer_key: tuple) -> tuple:
+        """La clave exacta sin la pregunta normalizada."""
+        return answer_key[:2] + answer_key[3:]
+
+    def _entries(self, scope: tuple) -> Optional[list]:
+        """Preguntas vigentes del paciente; si su alcance cambió las descarta."""
+        index = self._indexes.get(scope[0])
+        if index is None:
+            return None
+        if index[0] != scope:
+            del self._indexes[scope[0]]
+            self.invalidations += 1
+            return None
+        now = time.monotonic()
+        index[1][:] = [entry for entry in index[1] if now - entry[0] <= self.ttl_seconds]
+        self._indexes.move_to_end(scope[0])
+        return index[1]
+
+    def lookup(self, scope: tuple, question: str, embedding: List[float], tier: str) -> SemanticMatch:
+        """Respuesta guardada más parecida con la misma firma y el mismo nivel de modelo."""
+        signature = (tier, question_signature(question))
+        query = _unit(embedding)
+        with self._lock:
+            self.lookups += 1
+            entries = self._entries(scope) or []
+            best_similarity = None
+            best_payload = None
+            for _, entry_signature, vector, payload in entries:
+                if entry_signature != signature:
+                    continue
+                similarity = sum(map(operator.mul, query, vector))
+                if best_similarity is None or similarity > best_similarity:
+                    best_similarity, best_payload = similarity, payload
+            if best_similarity is None or best_similarity < self.threshold:
+                return SemanticMatch(None, best_similarity)
+            self.hits += 1
+            return SemanticMatch(copy.deepcopy(best_payload), best_similarity)
+
+    def put(self, scope: tuple, question: str, embedding: List[float], payload: dict, tier: str) -> None:
+        signature = (tier, question_signature(question))
+        entry = (time.monotonic(), signature, _unit(embedding), copy.deepcopy(payload))
+        with self._lock:
+            entries = self._entries(scope)
+            if entries is None:
+                entries = []
+                self._indexes[scope[0]] = (scope, entries)
+            entries.append(entry)
+            del entries[:-self.entries_per_patient]
+            while len(self._indexes) > self.max_patients:
+                self._indexes.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "patients": len(self._indexes),
+            "entries": sum(len(index[1]) for index in self._indexes.values()),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hit_rate, 3),
+            "invalidations": self.invalidations,
+            "threshold": self.threshold,
+        }
+
+
+answer_cache = AnswerCache(settings.answer_cache_size, settings.answer_cache_ttl_seconds)
+semantic_answer_cache = SemanticAnswerCache(
+    settings.semantic_answer_cache_patients,
+    settings.semantic_answer_cache_entries_per_patient,
+    settings.semantic_answer_cache_threshold,
+    settings.answer_cache_ttl_seconds
+)
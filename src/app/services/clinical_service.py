@@ -1,9 +1,17 @@
 # src/app/services/clinical_service.py
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Iterator, NamedTuple
+from datetime import date
+from dateutil.relativedelta import relativedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import text, select
+import hashlib
+import json
 import logging
 
+from app.database.db_config import settings
+from app.database.sharding import open_document_session
+from app.services.reference_cache import reference_cache
+
 # Modelos SQLAlchemy
 from app.models.patient import Patient
 from app.models.appointment import Appointment
@@ -11,6 +19,7 @@ from app.models.medical_record import MedicalRecord
 from app.models.prescription import Prescription
 from app.models.diagnosis import Diagnosis
 from app.models.record_diagnosis import RecordDiagnosis
+from app.models.patient_summary import PatientSummary
 
 # Schemas Pydantic
 from app.schemas.clinical import (
@@ -20,11 +29,34 @@ from app.schemas.clinical import (
     PrescriptionDTO,
     DiagnosisDTO,
     ClinicalRecords,
-    ClinicalDataResult
+    ClinicalDataResult,
+    HistoryWindow,
+    PatientSummaryDTO
 )
 
 logger = logging.getLogger(__name__)
 
+# Ventana sin límites: para endpoints que necesitan la historia completa
+FULL_HISTORY = HistoryWindow()
+
+
+def default_history_window() -> HistoryWindow:
+    """
+    Construye la ventana por defecto a partir de Settings.
+    Los límites se aplican en SQL para no transferir filas que luego se descartan.
+    """
+    since = None
+    if settings.clinical_history_years:
+        since = date.today() - relativedelta(years=settings.clinical_history_years)
+
+    return HistoryWindow(
+        appointments_limit=settings.clinical_appointments_limit,
+        medical_records_limit=settings.clinical_medical_records_limit,
+        prescriptions_limit=settings.clinical_prescriptions_limit,
+        diagnoses_limit=settings.clinical_diagnoses_limit,
+        since=since
+    )
+
 # ============================================================================ 
 # P2-2: Función para obtener paciente por documento
 # ============================================================================
@@ -75,208 +107,428 @@ def get_patient_by_document(
 # ============================================================================ 
 # P2-3: Funciones para obtener datos clínicos por paciente
 # ============================================================================
+#
+# Cada tipo de registro tiene una función que arma la sentencia SQL y dos
+# formas de ejecutarla:
+# - get_*: fetchall para ventanas pequeñas (uso normal del RAG)
+# - iter_*: cursor del lado del servidor (stream_results/yield_per) para
+#   historias muy grandes; la memoria queda acotada por el tamaño del lote
+
+def _appointments_statement(since: Optional[date]):
+    date_filter = "AND appointment_date >= :since" if since else ""
+
+    # Solo columnas de appointments: doctor y especialidad se resuelven
+    # con el cache de referencia (sin JOIN ni DISTINCT ON por fila)
+    return text(f"""
+        SELECT
+            appointment_id,
+            patient_id,
+            doctor_id,
+            room_id,
+            appointment_date,
+            start_time,
+            end_time,
+            appointment_type,
+            status,
+            reason,
+            creation_date
+        FROM smart_health.appointments
+        WHERE patient_id = :patient_id
+            {date_filter}
+        ORDER BY appointment_date DESC, start_time DESC NULLS LAST, appointment_id DESC
+        LIMIT :limit
+    """)
+
+
+def _medical_records_statement(patient_id: int, limit: Optional[int], since: Optional[date]):
+    # Solo las columnas del DTO: evita instanciar entidades ORM por fila
+    stmt = select(
+        MedicalRecord.medical_record_id,
+        MedicalRecord.patient_id,
+        MedicalRecord.doctor_id,
+        MedicalRecord.primary_diagnosis_id,
+        MedicalRecord.registration_datetime,
+        MedicalRecord.record_type,
+        MedicalRecord.summary_text,
+        MedicalRecord.vital_signs,
+    ).where(MedicalRecord.patient_id == patient_id)
+    if since:
+        stmt = stmt.where(MedicalRecord.registration_datetime >= since)
+    stmt = stmt.order_by(
+        MedicalRecord.registration_datetime.desc(),
+        MedicalRecord.medical_record_id.desc()
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def _prescriptions_statement(since: Optional[date]):
+    date_filter = "AND p.prescription_date >= :since" if since else ""
+
+    return text(f"""
+        SELECT 
+            p.prescription_id,
+            p.medical_record_id,
+            p.medication_id,
+            p.dosage,
+            p.frequency,
+            p.duration,
+            p.instruction,
+            p.prescription_date,
+            p.alert_generated
+        FROM smart_health.prescriptions p
+        INNER JOIN smart_health.medical_records mr 
+            ON p.medical_record_id = mr.medical_record_id
+        WHERE mr.patient_id = :patient_id
+            {date_filter}
+        ORDER BY p.prescription_date DESC, p.prescription_id DESC
+        LIMIT :limit
+    """)
 
-def get_appointments_by_patient(db: Session, patient_id: int) -> List[AppointmentDTO]:
+
+def _diagnoses_statement(since: Optional[date]):
+    date_filter = "AND mr.registration_datetime >= :since" if since else ""
+
+    # ✅ Query con SQL directo para obtener la fecha del medical_record
+    return text(f"""
+        SELECT 
+            rd.record_diagnosis_id,
+            d.diagnosis_id,
+            d.icd_code,
+            d.description,
+            rd.diagnosis_type,
+            rd.note,
+            mr.registration_datetime AS diagnosis_date
+        FROM smart_health.diagnoses d
+        INNER JOIN smart_health.record_diagnoses rd 
+            ON d.diagnosis_id = rd.diagnosis_id
+        INNER JOIN smart_health.medical_records mr 
+            ON rd.medical_record_id = mr.medical_record_id
+        WHERE mr.patient_id = :patient_id
+            {date_filter}
+        ORDER BY mr.registration_datetime DESC, rd.record_diagnosis_id DESC
+        LIMIT :limit
+    """)
+
+
+def _with_doctor_info(appointments: List[AppointmentDTO]) -> List[AppointmentDTO]:
+    for apt in appointments:
+        doctor = reference_cache.get_doctor(apt.doctor_id)
+        if doctor:
+            apt.doctor_name = doctor.name
+            apt.specialty_name = doctor.specialty_name
+            apt.medical_license_number = doctor.medical_license_number
+    return appointments
+
+
+def _with_medication_info(prescriptions: List[PrescriptionDTO]) -> List[PrescriptionDTO]:
+    # Nombre y presentación del medicamento desde el cache de referencia
+    for presc in prescriptions:
+        medication = reference_cache.get_medication(presc.medication_id)
+        if medication:
+            presc.medication_name = medication.name
+            presc.active_ingredient = medication.active_ingredient
+            presc.pharmaceutical_form = medication.pharmaceutical_form
+    return prescriptions
+
+
+def _stream_rows(db: Session, statement, params: dict, batch_size: int) -> Iterator[list]:
+    """
+    Ejecuta la sentencia con un cursor del lado del servidor y entrega las
+    filas por lotes. El cursor se cierra aunque el consumidor no termine.
+    """
+    result = db.execute(
+        statement,
+        params,
+        execution_options={"stream_results": True, "yield_per": batch_size}
+    )
+    try:
+        for partition in result.partitions(batch_size):
+            yield partition
+    finally:
+        result.close()
+
+
+def get_appointments_by_patient(
+    db: Session,
+    patient_id: int,
+    limit: Optional[int] = None,
+    since: Optional[date] = None
+) -> List[AppointmentDTO]:
     """
-    Obtiene todas las citas de un paciente con información del doctor,
+    Obtiene las citas de un paciente con información del doctor,
     ordenadas por fecha descendente.
+
+    Args:
+        limit: Máximo de citas más recientes a traer (None = todas)
+        since: Fecha mínima de la cita (None = sin filtro)
     """
     try:
-        # Query optimizada con DISTINCT ON para evitar duplicados
-        # Toma la primera especialidad activa si el doctor tiene varias
-        query = text("""
-            SELECT DISTINCT ON (a.appointment_id)
-                a.appointment_id,
-                a.patient_id,
-                a.doctor_id,
-                a.room_id,
-                a.appointment_date,
-                a.start_time,
-                a.end_time,
-                a.appointment_type,
-                a.status,
-                a.reason,
-                a.creation_date,
-                d.first_name || ' ' || d.last_name AS doctor_name,
-                s.specialty_name,
-                d.medical_license_number
-            FROM smart_health.appointments a
-            INNER JOIN smart_health.doctors d ON a.doctor_id = d.doctor_id
-            LEFT JOIN smart_health.doctor_specialties ds ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
-            LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
-            WHERE a.patient_id = :patient_id
-            ORDER BY a.appointment_id, ds.certification_date DESC NULLS LAST
-        """)
-        
-        result = db.execute(query, {"patient_id": patient_id})
+        result = db.execute(
+            _appointments_statement(since),
+            {"patient_id": patient_id, "limit": limit, "since": since}
+        )
         rows = result.fetchall()
         
-        # Convertir a DTOs
-        appointments = []
-        for row in rows:
-            apt_dict = {
-                'appointment_id': row.appointment_id,
-                'patient_id': row.patient_id,
-                'doctor_id': row.doctor_id,
-                'room_id': row.room_id,
-                'appointment_date': row.appointment_date,
-                'start_time': row.start_time,
-                'end_time': row.end_time,
-                'appointment_type': row.appointment_type,
-                'status': row.status,
-                'reason': row.reason,
-                'creation_date': row.creation_date,
-                # Campos del doctor
-                'doctor_name': row.doctor_name,
-                'specialty_name': row.specialty_name,
-                'medical_license_number': row.medical_license_number,
-            }
-            appointments.append(AppointmentDTO(**apt_dict))
-        
-        # Ordenar por fecha después de eliminar duplicados
-        appointments.sort(key=lambda x: (x.appointment_date, x.start_time or x.creation_date), reverse=True)
-        
-        return appointments
+        # Filas confiables de la BD: materializar sin validación Pydantic
+        return _with_doctor_info(AppointmentDTO.from_rows(rows))
         
     except Exception:
         logger.exception("Error ejecutando query get_appointments_by_patient")
         raise
 
 
-def get_medical_records_by_patient(db: Session, patient_id: int) -> List[MedicalRecordDTO]:
+def iter_appointments_by_patient(
+    db: Session,
+    patient_id: int,
+    since: Optional[date] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[AppointmentDTO]:
+    """Versión en streaming de get_appointments_by_patient (sin límite de filas)."""
+    params = {"patient_id": patient_id, "limit": None, "since": since}
+    for rows in _stream_rows(db, _appointments_statement(since), params,
+                             batch_size or settings.clinical_stream_batch_size):
+        yield from _with_doctor_info(AppointmentDTO.from_rows(rows))
+
+
+def get_medical_records_by_patient(
+    db: Session,
+    patient_id: int,
+    limit: Optional[int] = None,
+    since: Optional[date] = None
+) -> List[MedicalRecordDTO]:
     """
-    Obtiene todos los registros médicos de un paciente, ordenados por fecha descendente.
+    Obtiene los registros médicos de un paciente, ordenados por fecha descendente.
+
+    Args:
+        limit: Máximo de registros más recientes a traer (None = todos)
+        since: Fecha mínima del registro (None = sin filtro)
     """
     try:
-        records = (
-            db.query(MedicalRecord)
-            .filter(MedicalRecord.patient_id == patient_id)
-            .order_by(MedicalRecord.registration_datetime.desc())
-            .all()
-        )
+        rows = db.execute(_medical_records_statement(patient_id, limit, since)).fetchall()
     except Exception:
         logger.exception("Error ejecutando query get_medical_records_by_patient")
         raise
 
-    return [MedicalRecordDTO.from_orm(rec) for rec in records]
+    return MedicalRecordDTO.from_rows(rows)
+
+
+def iter_medical_records_by_patient(
+    db: Session,
+    patient_id: int,
+    since: Optional[date] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[MedicalRecordDTO]:
+    """Versión en streaming de get_medical_records_by_patient (sin límite de filas)."""
+    for rows in _stream_rows(db, _medical_records_statement(patient_id, None, since), {},
+                             batch_size or settings.clinical_stream_batch_size):
+        yield from MedicalRecordDTO.from_rows(rows)
 
 
-def get_prescriptions_by_patient(db: Session, patient_id: int) -> List[PrescriptionDTO]:
+def get_prescriptions_by_patient(
+    db: Session,
+    patient_id: int,
+    limit: Optional[int] = None,
+    since: Optional[date] = None
+) -> List[PrescriptionDTO]:
     """
-    Obtiene todas las prescripciones de un paciente con el nombre del medicamento.
+    Obtiene las prescripciones de un paciente con el nombre del medicamento
+    (resuelto con el cache de referencia).
+
+    Args:
+        limit: Máximo de prescripciones más recientes a traer (None = todas)
+        since: Fecha mínima de la prescripción (None = sin filtro)
     """
     try:
-        query = text("""
-            SELECT 
-                p.prescription_id,
-                p.medical_record_id,
-                p.medication_id,
-                p.dosage,
-                p.frequency,
-                p.duration,
-                p.instruction,
-                p.prescription_date,
-                p.alert_generated,
-                COALESCE(m.commercial_name, 'Medicamento no especificado') AS medication_name,
-                m.active_ingredient,
-                m.presentation AS pharmaceutical_form
-            FROM smart_health.prescriptions p
-            INNER JOIN smart_health.medical_records mr 
-                ON p.medical_record_id = mr.medical_record_id
-            LEFT JOIN smart_health.medications m 
-                ON p.medication_id = m.medication_id
-            WHERE mr.patient_id = :patient_id
-            ORDER BY p.prescription_date DESC
-        """)
-        
-        result = db.execute(query, {"patient_id": patient_id})
+        result = db.execute(
+            _prescriptions_statement(since),
+            {"patient_id": patient_id, "limit": limit, "since": since}
+        )
         rows = result.fetchall()
         
-        prescriptions = []
-        for row in rows:
-            presc_dict = {
-                'prescription_id': row.prescription_id,
-                'medical_record_id': row.medical_record_id,
-                'medication_id': row.medication_id,
-                'dosage': row.dosage,
-                'frequency': row.frequency,
-                'duration': row.duration,
-                'instruction': row.instruction,
-                'prescription_date': row.prescription_date,
-                'alert_generated': row.alert_generated,
-                'medication_name': row.medication_name,
-                'active_ingredient': row.active_ingredient,
-                'pharmaceutical_form': row.pharmaceutical_form,
-            }
-            prescriptions.append(PrescriptionDTO(**presc_dict))
-        
-        return prescriptions
+        return _with_medication_info(PrescriptionDTO.from_rows(rows))
         
     except Exception:
         logger.exception("Error ejecutando query get_prescriptions_by_patient")
         raise
 
 
-def get_diagnoses_by_patient(db: Session, patient_id: int) -> List[DiagnosisDTO]:
+def iter_prescriptions_by_patient(
+    db: Session,
+    patient_id: int,
+    since: Optional[date] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[PrescriptionDTO]:
+    """Versión en streaming de get_prescriptions_by_patient (sin límite de filas)."""
+    params = {"patient_id": patient_id, "limit": None, "since": since}
+    for rows in _stream_rows(db, _prescriptions_statement(since), params,
+                             batch_size or settings.clinical_stream_batch_size):
+        yield from _with_medication_info(PrescriptionDTO.from_rows(rows))
+
+
+def get_diagnoses_by_patient(
+    db: Session,
+    patient_id: int,
+    limit: Optional[int] = None,
+    since: Optional[date] = None
+) -> List[DiagnosisDTO]:
     """
-    Obtiene todos los diagnósticos de un paciente con la fecha del registro médico.
+    Obtiene los diagnósticos de un paciente con la fecha del registro médico.
+
+    Args:
+        limit: Máximo de diagnósticos más recientes a traer (None = todos)
+        since: Fecha mínima del registro médico (None = sin filtro)
     """
     try:
-        # ✅ Query con SQL directo para obtener la fecha del medical_record
-        query = text("""
-            SELECT 
-                rd.record_diagnosis_id,
-                d.diagnosis_id,
-                d.icd_code,
-                d.description,
-                rd.diagnosis_type,
-                rd.note,
-                mr.registration_datetime AS diagnosis_date
-            FROM smart_health.diagnoses d
-            INNER JOIN smart_health.record_diagnoses rd 
-                ON d.diagnosis_id = rd.diagnosis_id
-            INNER JOIN smart_health.medical_records mr 
-                ON rd.medical_record_id = mr.medical_record_id
-            WHERE mr.patient_id = :patient_id
-            ORDER BY mr.registration_datetime DESC
-        """)
-        
-        result = db.execute(query, {"patient_id": patient_id})
+        result = db.execute(
+            _diagnoses_statement(since),
+            {"patient_id": patient_id, "limit": limit, "since": since}
+        )
         rows = result.fetchall()
         
-        # Convertir a DTOs
-        diagnoses = []
-        for row in rows:
-            diag_dict = {
-                'record_diagnosis_id': row.record_diagnosis_id,
-                'diagnosis_id': row.diagnosis_id,
-                'icd_code': row.icd_code,
-                'description': row.description,
-                'diagnosis_type': row.diagnosis_type,
-                'note': row.note,
-                # ✅ Fecha del diagnóstico (del medical_record)
-                'diagnosis_date': row.diagnosis_date,
-            }
-            diagnoses.append(DiagnosisDTO(**diag_dict))
-        
-        return diagnoses
+        return DiagnosisDTO.from_rows(rows)
         
     except Exception:
         logger.exception("Error ejecutando query get_diagnoses_by_patient")
         raise
 
 
+def iter_diagnoses_by_patient(
+    db: Session,
+    patient_id: int,
+    since: Optional[date] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[DiagnosisDTO]:
+    """Versión en streaming de get_diagnoses_by_patient (sin límite de filas)."""
+    params = {"patient_id": patient_id, "limit": None, "since": since}
+    for rows in _stream_rows(db, _diagnoses_statement(since), params,
+                             batch_size or settings.clinical_stream_batch_size):
+        yield from DiagnosisDTO.from_rows(rows)
+
+
+def get_summary_by_patient(db: Session, patient_id: int) -> Optional[PatientSummaryDTO]:
+    """
+    Resumen longitudinal guardado del paciente (historia anterior a la
+    ventana), o None si todavía no se generó (ver app.services.patient_summary).
+    """
+    try:
+        row = db.execute(
+            select(PatientSummary.summary, PatientSummary.updated_at)
+            .where(PatientSummary.patient_id == patient_id)
+        ).first()
+    except Exception:
+        logger.exception("Error ejecutando query get_summary_by_patient")
+        raise
+
+    if row is None:
+        return None
+    return PatientSummaryDTO(
+        years=row.summary.get("years", {}),
+        conditions=row.summary.get("conditions", {}),
+        updated_at=row.updated_at
+    )
+
+
+# ============================================================================ 
+# Streaming de historias clínicas completas
+# ============================================================================
+
+class ClinicalRecordStreams(NamedTuple):
+    """
+    Mismos campos que ClinicalRecords, pero cada uno es un iterador perezoso
+    respaldado por un cursor del lado del servidor. Se consume una sola vez,
+    requiere que la sesión siga abierta mientras se itera y debe cerrarse
+    (close) antes que la sesión si no se recorre completo.
+    """
+    appointments: Iterator[AppointmentDTO]
+    medical_records: Iterator[MedicalRecordDTO]
+    prescriptions: Iterator[PrescriptionDTO]
+    diagnoses: Iterator[DiagnosisDTO]
+
+    def close(self) -> None:
+        """Cierra los cursores de los iteradores que no se consumieron completos."""
+        for items in self:
+            items.close()
+
+
+def stream_clinical_records(
+    db: Session,
+    patient_id: int,
+    since: Optional[date] = None,
+    batch_size: Optional[int] = None
+) -> ClinicalRecordStreams:
+    """
+    Abre la historia completa de un paciente como iteradores. Las queries
+    solo se ejecutan cuando se empieza a consumir cada iterador.
+    """
+    return ClinicalRecordStreams(
+        appointments=iter_appointments_by_patient(db, patient_id, since, batch_size),
+        medical_records=iter_medical_records_by_patient(db, patient_id, since, batch_size),
+        prescriptions=iter_prescriptions_by_patient(db, patient_id, since, batch_size),
+        diagnoses=iter_diagnoses_by_patient(db, patient_id, since, batch_size)
+    )
+
+
+def iter_patient_history_ndjson(
+    db: Session,
+    patient_id: int,
+    since: Optional[date] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[str]:
+    """
+    Exporta la historia completa como NDJSON (una línea JSON por registro),
+    sin cargarla entera en memoria.
+    """
+    streams = stream_clinical_records(db, patient_id, since, batch_size)
+    sections = (
+        ("appointment", streams.appointments),
+        ("medical_record", streams.medical_records),
+        ("prescription", streams.prescriptions),
+        ("diagnosis", streams.diagnoses),
+    )
+    for record_type, items in sections:
+        for item in items:
+            payload = item.model_dump(mode="json")
+            yield json.dumps({"type": record_type, "data": payload}, ensure_ascii=False) + "\n"
+
+
 # ============================================================================ 
 # Función principal que integra todo (usada por P1)
 # ============================================================================
 
+def compute_chart_version(patient: PatientInfo, records: ClinicalRecords) -> str:
+    """
+    Huella de la historia clínica leída: cambia si cambia cualquier fila, o si
+    una fila entra o sale de la ventana. Es la clave de los caches por paciente
+    (fragmentos de contexto), que así nunca sirven datos viejos.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(tuple(patient.__dict__.values())).encode())
+    for rows in (records.appointments, records.medical_records, records.prescriptions, records.diagnoses):
+        digest.update(b"|")
+        for row in rows:
+            digest.update(repr(tuple(row.__dict__.values())).encode())
+    if records.summary is not None:
+        # El resumen cambia de updated_at cada vez que se actualiza
+        digest.update(b"|" + repr(records.summary.updated_at).encode())
+    return digest.hexdigest()
+
+
 def fetch_patient_and_records(
     db: Session,
     document_type_id: int,
-    document_number: str
+    document_number: str,
+    window: Optional[HistoryWindow] = None,
+    full_history: bool = False
 ) -> Tuple[Optional[PatientInfo], ClinicalDataResult]:
     """
-    Función principal que obtiene paciente + todos sus registros clínicos.
+    Función principal que obtiene paciente + sus registros clínicos.
+
+    Args:
+        window: Límites por tipo y fecha mínima. Si es None se usa
+            default_history_window() (configurable en Settings).
+        full_history: Si es True ignora la ventana y trae la historia completa.
 
     Returns:
         Tupla con:
@@ -294,18 +546,34 @@ def fetch_patient_and_records(
             has_data=False
         )
 
-    # 2. Obtener todos los registros clínicos
-    appointments = get_appointments_by_patient(db, patient.patient_id)
-    medical_records = get_medical_records_by_patient(db, patient.patient_id)
-    prescriptions = get_prescriptions_by_patient(db, patient.patient_id)
-    diagnoses = get_diagnoses_by_patient(db, patient.patient_id)
+    # 2. Obtener los registros clínicos dentro de la ventana
+    if full_history:
+        window = FULL_HISTORY
+    elif window is None:
+        window = default_history_window()
+
+    appointments = get_appointments_by_patient(
+        db, patient.patient_id, limit=window.appointments_limit, since=window.since
+    )
+    medical_records = get_medical_records_by_patient(
+        db, patient.patient_id, limit=window.medical_records_limit, since=window.since
+    )
+    prescriptions = get_prescriptions_by_patient(
+        db, patient.patient_id, limit=window.prescriptions_limit, since=window.since
+    )
+    diagnoses = get_diagnoses_by_patient(
+        db, patient.patient_id, limit=window.diagnoses_limit, since=window.since
+    )
+    # La historia anterior a la ventana llega condensada en el resumen
+    summary = None if full_history else get_summary_by_patient(db, patient.patient_id)
 
     # 3. Agrupar en ClinicalRecords
     records = ClinicalRecords(
         appointments=appointments,
         medical_records=medical_records,
         prescriptions=prescriptions,
-        diagnoses=diagnoses
+        diagnoses=diagnoses,
+        summary=summary
     )
 
     # 4. Determinar si hay datos (P2-5)
@@ -320,5 +588,38 @@ def fetch_patient_and_records(
     return patient, ClinicalDataResult(
         patient=patient,
         records=records,
-        has_data=has_data
-    )
\ No newline at end of file
+        has_data=has_data,
+        chart_version=compute_chart_version(patient, records)
+    )
+
+
+def fetch_patient_and_records_by_document(
+    document_type_id: int,
+    document_number: str,
+    max_staleness: Optional[float] = None,
+    window: Optional[HistoryWindow] = None,
+    full_history: bool = False
+) -> Tuple[Optional[PatientInfo], ClinicalDataResult]:
+    """
+    Igual que fetch_patient_and_records, pero abre la sesión en la BD (shard
+    o réplica) que tiene al paciente y la cierra al terminar, sin retener la
+    conexión mientras se espera al LLM.
+
+    Args:
+        max_staleness: Atraso tolerado si la lectura va a una réplica (segundos)
+    """
+    db = open_document_session(document_type_id, document_number, max_staleness)
+    if db is None:
+        # Documento fuera del directorio de shards
+        return None, ClinicalDataResult(
+            patient=None,
+            records=ClinicalRecords(),
+            has_data=False
+        )
+
+    try:
+        return fetch_patient_and_records(
+            db, document_type_id, document_number, window=window, full_history=full_history
+        )
+    finally:
+        db.close()
\ No newline at end of file
@@ -0,0 +1,235 @@
+# src/app/services/llm_admission.py
+"""
+Control de admisión de las llamadas al LLM (por worker).
+
+Antes de llamar al proveedor cada solicitud pide un turno con
+llm_admission.admit(tokens, deadline). Se admite cuando se cumplen las dos
+condiciones:
+
+- Concurrencia: menos de LLM_MAX_CONCURRENCY llamadas en curso.
+- Presupuesto de tokens por minuto: los tokens reservados en los últimos 60 s
+  más los de esta solicitud (prompt estimado + max_tokens, como los cuenta el
+  proveedor) no superan LLM_TOKENS_PER_MINUTE.
+
+Mientras no se cumplan la solicitud espera en una cola de a lo sumo
+LLM_ADMISSION_QUEUE_SIZE turnos. Se rechaza de inmediato con
+LLMAdmissionError (sin ocupar un turno) si la cola está llena o si ya no
+queda tiempo para terminar antes de su deadline: la llamada necesita al menos
+LLM_ADMISSION_MIN_SERVICE_SECONDS una vez admitida. Así un pico produce
+rechazos rápidos y claros en lugar de una ola de 429 y timeouts de 45 s.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from app.database.db_config import settings
+
+logger = logging.getLogger(__name__)
+
+# Ventana del presupuesto de tokens (segundos)
+TOKEN_WINDOW_SECONDS = 60.0
+
+
+class LLMAdmissionError(Exception):
+    """La solicitud no se admite: cola llena, sin presupuesto o sin tiempo."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        # queue_full | token_budget | deadline
+        self.reason = reason
+
+
+class AdmissionTicket:
+    """Turno admitido; release() lo devuelve (una sola vez)."""
+
+    def __init__(self, controller: "AdmissionController", reservation: list):
+        self._controller = controller
+        self._reservation = reservation
+        self._released = False
+
+    @property
+    def tokens(self) -> int:
+        return self._reservation[1]
+
+    def release(self, tokens_used: Optional[int] = None) -> None:
+        """
+        Libera el turno. Con tokens_used (uso real informado por el
+        proveedor) se corrige la reserva del presupuesto.
+        """
+        if self._released:
+            return
+        self._released = True
+        if tokens_used is not None:
+            self._reservation[1] = tokens_used
+        self._controller._release()
+
+
+class AdmissionController:
+    """Semáforo de concurrencia + presupuesto de tokens/minuto + cola acotada."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        tokens_per_minute: int,
+        queue_size: int,
+        min_service_seconds: float
+    ):
+        self.max_concurrency = max_concurrency
+        # 0 = sin presupuesto de tokens
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_size = queue_size
+        self.min_service_seconds = min_service_seconds
+
+        self.active = 0
+        self.waiting = 0
+        # Reservas [monotonic, tokens] de la última ventana
+        self._reservations: deque = deque()
+        self._condition: Optional[asyncio.Condition] = None
+        self.metrics: Dict[str, int] = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_token_budget": 0,
+            "rejected_deadline": 0,
+        }
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Se crea dentro del event loop que la usa
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    # ------------------------------------------------------------------
+    # Presupuesto de tokens
+    # ------------------------------------------------------------------
+
+    def _tokens_in_window(self, now: float) -> int:
+        while self._reservations and now - self._reservations[0][0] >= TOKEN_WINDOW_SECONDS:
+            self._reservations.popleft()
+        return sum(tokens for _, tokens in self._reservations)
+
+    def _token_wait(self, tokens: int, now: float) -> float:
+        """Segundos hasta que tokens entren en el presupuesto (0 = ya entran)."""
+        if not self.tokens_per_minute:
+            return 0.0
+        excess = self._tokens_in_window(now) + tokens - self.tokens_per_minute
+        if excess <= 0:
+            return 0.0
+        # Las reservas más antiguas salen primero de la ventana
+        freed = 0
+        for reserved_at, reserved in self._reservations:
+            freed += reserved
+            if freed >= excess:
+                return reserved_at + TOKEN_WINDOW_SECONDS - now
+        return TOKEN_WINDOW_SECONDS
+
+    # ------------------------------------------------------------------
+    # Admisión
+    # ------------------------------------------------------------------
+
+    def _reject(self, reason: str, message: str) -> LLMAdmissionError:
+        self.metrics[f"rejected_{reason}"] += 1
+        logger.warning(f"Llamada al LLM rechazada ({reason}): {message}")
+        return LLMAdmissionError(reason, message)
+
+    async def acquire(self, tokens: int, deadline: Optional[float] = None) -> AdmissionTicket:
+        """
+        Espera un turno para una llamada de tokens estimados. deadline es un
+        instante de time.monotonic(), el mismo reloj que loop.time()
+        (None = sin límite).
+        """
+        if self.tokens_per_minute:
+            # Una solicitud mayor que el presupuesto entero se admite sola
+            tokens = min(tokens, self.tokens_per_minute)
+
+        async with self.condition:
+            queued = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - now - self.min_service_seconds
+                        if wait <= 0:
+                            raise self._reject(
+                                "deadline",
+                                "No queda tiempo para obtener turno y completar la llamada al LLM"
+                            )
+
+                    token_wait = self._token_wait(tokens, now)
+                    if self.active < self.max_concurrency and token_wait == 0:
+                        break
+
+                    if not queued:
+                        if self.waiting >= self.queue_size:
+                            raise self._reject(
+                                "queue_full",
+                                f"{self.waiting} solicitudes ya esperan turno para el LLM"
+                            )
+                        queued = True
+                        self.waiting += 1
+                        self.metrics["queued"] += 1
+
+                    if wait is not None and token_wait > wait:
+                        raise self._reject(
+                            "token_budget",
+                            f"El presupuesto de {self.tokens_per_minute} tokens/minuto "
+                            f"no alcanza antes del límite de tiempo"
+                        )
+                    if token_wait:
+                        wait = token_wait if wait is None else min(wait, token_wait)
+
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                if queued:
+                    self.waiting -= 1
+
+            self.active += 1
+            self.metrics["admitted"] += 1
+            reservation = [now, tokens]
+            self._reservations.append(reservation)
+            return AdmissionTicket(self, reservation)
+
+    def _release(self) -> None:
+        self.active -= 1
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self) -> None:
+        async with self.condition:
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def admit(self, tokens: int, deadline: Optional[float] = None) -> AsyncIterator[AdmissionTicket]:
+        ticket = await self.acquire(tokens, deadline)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def status(self) -> Dict[str, int]:
+        """Estado y métricas (para /health)."""
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "tokens_in_window": self._tokens_in_window(time.monotonic()),
+            "tokens_per_minute": self.tokens_per_minute,
+            **self.metrics,
+        }
+
+
+# Instancia global (el control es por proceso/worker)
+llm_admission = AdmissionController(
+    max_concurrency=settings.llm_max_concurrency,
+    tokens_per_minute=settings.llm_tokens_per_minute,
+    queue_size=settings.llm_admission_queue_size,
+    min_service_seconds=settings.llm_admission_min_service_seconds
+)
@@ -1,19 +1,17 @@
 # src/app/services/llm_client.py
-from openai import AsyncOpenAI
 from typing import Dict, List
 import logging
 from app.database.db_config import settings
+from app.services.llm_gateway import llm_gateway
+from app.services.llm_admission import llm_admission
+from app.services.rag_context import count_tokens
 
 logger = logging.getLogger(__name__)
 
 class LLMClient:
-    """Cliente para interactuar con OpenAI GPT"""
+    """Cliente para interactuar con OpenAI GPT (sobre el gateway compartido)"""
     
     def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=settings.openai_api_key,
-            timeout=settings.llm_timeout
-        )
         self.model = settings.llm_model
         self.temperature = settings.llm_temperature
         self.max_tokens = settings.llm_max_tokens
@@ -23,32 +21,24 @@ class LLMClient:
         Genera respuesta del LLM.
         """
         try:
-            # Preparar parámetros base
-            params = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-            }
-            
-            # gpt-5-nano solo acepta temperature=1 (default)
-            # Para otros modelos, usar el configurado
-            if not self.model.startswith("gpt-5"):
-                params["temperature"] = self.temperature
-            
-            # Usar el parámetro correcto según el modelo
-            if self.model.startswith(("gpt-5", "gpt-4.1", "gpt-4o")):
-                params["max_completion_tokens"] = self.max_tokens
-            else:
-                params["max_tokens"] = self.max_tokens
-            
-            response = await self.client.chat.completions.create(**params)
+            # Comparte el control de admisión con las respuestas del RAG (sin deadline)
+            estimated_tokens = count_tokens(system_prompt) + count_tokens(prompt) + self.max_tokens
+            async with llm_admission.admit(estimated_tokens) as ticket:
+                response = await llm_gateway.chat(
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    model=self.model
+                )
+                ticket.release(response.total_tokens)
             
             result = {
-                "text": response.choices[0].message.content,
-                "model_used": response.model,
-                "tokens_used": response.usage.total_tokens
+                "text": response.text,
+                "model_used": response.model_used,
+                "tokens_used": response.total_tokens
             }
             
             logger.info(f"✅ LLM generó respuesta. Tokens usados: {result['tokens_used']}")
@@ -82,14 +72,8 @@ async def get_embedding(text: str) -> List[float]:
         Lista de floats representando el vector embedding
     """
     try:
-        client = AsyncOpenAI(api_key=settings.openai_api_key)
-        
-        response = await client.embeddings.create(
-            model="text-embedding-3-small",  # Modelo de embeddings de OpenAI
-            input=text
-        )
-        
-        embedding = response.data[0].embedding
+        # Cliente y conexiones compartidos (antes se creaba uno por llamada)
+        embedding = await llm_gateway.embed(text)
         logger.info(f"🔢 Embedding generado: {len(embedding)} dimensiones")
         
         return embedding
@@ -0,0 +1,636 @@
+# src/app/services/llm_gateway.py
+"""
+Gateway único hacia el proveedor del LLM (OpenAI).
+
+Todo el proceso comparte un solo AsyncOpenAI montado sobre un solo
+httpx.AsyncClient, con límites de pool, keep-alive y HTTP/2 tomados de
+Settings. Así las respuestas del RAG (llm_service), los resúmenes
+(llm_client) y los embeddings (vector_search) reutilizan las mismas
+conexiones TLS en lugar de abrir una por cliente o por llamada.
+
+- chat: completion entera -> ChatResult
+- chat_stream: completion en streaming (iterador async de chunks del SDK)
+- embed: embedding de un texto
+
+El cliente se crea en el primer uso y se cierra en el shutdown de la app
+(aclose).
+
+Backends (LLM_BACKENDS): uno o más endpoints compatibles con OpenAI (la API
+de OpenAI, un servidor de inferencia on-prem, llm_stub_server para correr
+sin red), cada uno con su propio AsyncOpenAI sobre el mismo pool HTTP, su
+breaker y sus latencias. Cada llamada los prueba en orden de prioridad; entre
+los de igual prioridad el orden se sortea según su peso. Si un backend tiene
+el breaker abierto o agota sus reintentos con errores transitorios, la
+llamada pasa al siguiente. Los embeddings solo van a backends que sirven
+LLM_EMBEDDING_MODEL: los vectores guardados en la BD son de ese modelo.
+
+Resiliencia por backend (las tres llamadas pasan por _resilient):
+- Hedging: si un intento no respondió (en streaming: no llegó el primer
+  chunk) en el percentil LLM_HEDGE_PERCENTILE de las latencias recientes,
+  se lanza un segundo intento igual; gana el primero que responde y el otro
+  se cancela.
+- Reintentos de errores transitorios (conexión, timeout, 429, 5xx) con
+  backoff exponencial con jitter completo.
+- Circuit breaker: tras LLM_BREAKER_FAILURE_THRESHOLD fallos seguidos las
+  llamadas fallan de inmediato con LLMUnavailableError (el RAG responde con
+  su fallback) hasta que pasan LLM_BREAKER_RESET_SECONDS y una prueba sale bien.
+- status(): métricas de intentos, hedges ganados, reintentos, cambios de
+  backend y estado de cada breaker (se publican en /health).
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from app.database.db_config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Latencias recientes por tipo de llamada para calcular el percentil del hedge
+LATENCY_WINDOW = 200
+# Muestras mínimas antes de usar el percentil (antes: delay por defecto)
+MIN_LATENCY_SAMPLES = 20
+
+
+class LLMUnavailableError(Exception):
+    """El circuit breaker está abierto: el proveedor se considera caído."""
+
+
+class ChatResult(NamedTuple):
+    text: str
+    model_used: str
+    # Tokens de la completion y totales (prompt + completion)
+    completion_tokens: int
+    total_tokens: int
+    # Tokens del prompt y cuántos de ellos vinieron del cache de prompts
+    # del proveedor (prefijo ya visto)
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    # Backend que respondió
+    backend: str = ""
+
+
+def cached_prompt_tokens(usage: Any) -> int:
+    """usage.prompt_tokens_details.cached_tokens, o 0 si el proveedor no lo informa."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+class LatencyTracker:
+    """Ventana de latencias exitosas de un tipo de llamada."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: deque = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if len(self._samples) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def hedge_delay(self) -> float:
+        p = self.percentile(settings.llm_hedge_percentile)
+        if p is None:
+            return settings.llm_hedge_default_delay_seconds
+        return max(p, settings.llm_hedge_min_delay_seconds)
+
+
+class CircuitBreaker:
+    """
+    closed -> (N fallos seguidos) -> open -> (reset_seconds) -> half_open
+    half_open deja pasar una sola llamada de prueba: si sale bien vuelve a
+    closed, si falla vuelve a open.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                raise LLMUnavailableError("Proveedor del LLM no disponible (circuit breaker abierto)")
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise LLMUnavailableError("Proveedor del LLM en prueba (circuit breaker semiabierto)")
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("Circuit breaker del LLM cerrado: el proveedor respondió")
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+                logger.error(
+                    f"Circuit breaker del LLM abierto tras {self.consecutive_failures} fallos; "
+                    f"nueva prueba en {self.reset_seconds}s"
+                )
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """La prueba terminó sin veredicto (error no transitorio o cancelación)."""
+        self._probe_in_flight = False
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Errores del proveedor que justifican reintentar (y cuentan para el breaker)."""
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """Backoff exponencial con jitter completo para el reintento número attempt (1, 2...)."""
+    ceiling = min(settings.llm_backoff_max_seconds, settings.llm_backoff_base_seconds * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling)
+
+
+class _StreamStart(NamedTuple):
+    """Stream abierto con su primer chunk ya leído."""
+    stream: Any
+    chunks: AsyncIterator
+    first: Any
+    backend: str
+    model: str
+
+
+class ChatStream:
+    """Chunks de una completion en streaming, con el backend y el modelo que la atienden."""
+
+    def __init__(self, chunks: AsyncIterator, backend: str, model: str):
+        self._chunks = chunks
+        self.backend = backend
+        self.model = model
+
+    def __aiter__(self):
+        return self._chunks
+
+    async def aclose(self) -> None:
+        await self._chunks.aclose()
+
+
+# ============================================================================
+# Backends
+# ============================================================================
+
+class LLMBackend:
+    """Endpoint compatible con OpenAI con su cliente, breaker y latencias."""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: Optional[str] = None,
+        model: Optional[str] = None,
+        embedding_model: Optional[str] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        priority: int = 0,
+        weight: float = 1.0,
+        api_key: Optional[str] = None
+    ):
+        self.name = name
+        # None = URL por defecto del SDK (api.openai.com)
+        self.base_url = base_url
+        # None = el modelo pedido (LLM_MODEL o el nivel de model_router);
+        # un servidor on-prem suele servir un solo modelo
+        self.model = model
+        self.embedding_model = embedding_model
+        self.timeout = timeout if timeout is not None else settings.llm_timeout
+        self.connect_timeout = connect_timeout if connect_timeout is not None else settings.llm_connect_timeout
+        # Menor = se prueba antes; el peso reparte entre los de igual prioridad
+        self.priority = priority
+        self.weight = weight
+        self.api_key = api_key
+        self.breaker = CircuitBreaker(
+            settings.llm_breaker_failure_threshold,
+            settings.llm_breaker_reset_seconds
+        )
+        self.latency: Dict[str, LatencyTracker] = {}
+        self._client: Optional[AsyncOpenAI] = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url or "default",
+            "model": self.model,
+            "priority": self.priority,
+            "weight": self.weight,
+            "breaker_state": self.breaker.state,
+            "breaker_times_opened": self.breaker.times_opened,
+            "hedge_delay_ms": {
+                kind: int(tracker.hedge_delay() * 1000) for kind, tracker in self.latency.items()
+            },
+        }
+
+
+# Opciones de cada entrada de LLM_BACKENDS -> conversión
+_BACKEND_OPTIONS: Dict[str, Callable[[str], Any]] = {
+    "model": str,
+    "embedding_model": str,
+    "timeout": float,
+    "connect_timeout": float,
+    "priority": int,
+    "weight": float,
+    "api_key_env": str,
+}
+
+
+def _parse_backend(entry: str, position: int) -> LLMBackend:
+    """'nombre=base_url;opción=valor;...' -> LLMBackend (prioridad por defecto: posición)."""
+    head, *pairs = entry.split(";")
+    name, _, base_url = head.partition("=")
+    options: Dict[str, Any] = {"priority": position}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        key = key.strip()
+        if key not in _BACKEND_OPTIONS or not value.strip():
+            raise ValueError(
+                f"Opción inválida en LLM_BACKENDS: {pair!r} "
+                f"(opciones: {', '.join(_BACKEND_OPTIONS)})"
+            )
+        options[key] = _BACKEND_OPTIONS[key](value.strip())
+    if not name.strip():
+        raise ValueError(f"Entrada inválida en LLM_BACKENDS: {entry!r} (formato nombre=base_url;opción=valor)")
+    api_key_env = options.pop("api_key_env", None)
+    if api_key_env:
+        options["api_key"] = os.getenv(api_key_env)
+    return LLMBackend(name.strip(), base_url.strip() or None, **options)
+
+
+def build_backends(spec: Optional[str] = None) -> List[LLMBackend]:
+    """Backends de LLM_BACKENDS; vacío = solo OpenAI con la configuración LLM_*."""
+    spec = settings.llm_backends if spec is None else spec
+    entries = [entry.strip() for entry in spec.split(",") if entry.strip()]
+    if not entries:
+        return [LLMBackend("openai")]
+    backends = [_parse_backend(entry, position) for position, entry in enumerate(entries)]
+    if len({backend.name for backend in backends}) != len(backends):
+        raise ValueError("LLM_BACKENDS tiene nombres repetidos")
+    return backends
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class LLMGateway:
+    """Cliente compartido del proveedor del LLM."""
+
+    def __init__(self, backends: Optional[List[LLMBackend]] = None):
+        self.model = settings.llm_model
+        self.embedding_model = settings.llm_embedding_model
+        self.backends = backends if backends is not None else build_backends()
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self.metrics: Dict[str, int] = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "failures": 0,
+            "hedges_launched": 0,
+            "hedges_won": 0,
+            "rejected_by_breaker": 0,
+            "backend_fallbacks": 0,
+        }
+
+    # ------------------------------------------------------------------
+    # Clientes
+    # ------------------------------------------------------------------
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None:
+            http2 = settings.llm_http2
+            if http2 and not _http2_available():
+                logger.warning("HTTP/2 pedido pero el paquete h2 no está instalado; se usa HTTP/1.1")
+                http2 = False
+
+            self._http_client = httpx.AsyncClient(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=settings.llm_max_connections,
+                    max_keepalive_connections=settings.llm_max_keepalive_connections,
+                    keepalive_expiry=settings.llm_keepalive_expiry_seconds
+                ),
+                timeout=httpx.Timeout(settings.llm_timeout, connect=settings.llm_connect_timeout)
+            )
+            logger.info(
+                f"LLM gateway inicializado: backends {[backend.name for backend in self.backends]}, "
+                f"{'HTTP/2' if http2 else 'HTTP/1.1'}, pool {settings.llm_max_connections} "
+                f"({settings.llm_max_keepalive_connections} keep-alive)"
+            )
+        return self._http_client
+
+    def client_for(self, backend: LLMBackend) -> AsyncOpenAI:
+        """Cliente del backend; todos comparten el pool HTTP del gateway."""
+        if backend._client is None:
+            backend._client = AsyncOpenAI(
+                api_key=backend.api_key or settings.openai_api_key,
+                base_url=backend.base_url,
+                http_client=self.http_client,
+                max_retries=settings.llm_sdk_max_retries,
+                timeout=httpx.Timeout(backend.timeout, connect=backend.connect_timeout)
+            )
+        return backend._client
+
+    async def aclose(self) -> None:
+        """Cierra el pool de conexiones (shutdown de la app)."""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        self._http_client = None
+        for backend in self.backends:
+            backend._client = None
+
+    # ------------------------------------------------------------------
+    # Resiliencia
+    # ------------------------------------------------------------------
+
+    def status(self) -> Dict[str, Any]:
+        """Métricas y estado de cada backend (para /health)."""
+        return {
+            **self.metrics,
+            "backends": {backend.name: backend.status() for backend in self.backends},
+        }
+
+    def _candidates(self, kind: str) -> List[LLMBackend]:
+        """
+        Backends en el orden en que se prueban: por prioridad y, dentro de
+        una misma prioridad, sorteados según su peso.
+        """
+        backends = self.backends
+        if kind == "embed":
+            backends = [b for b in backends if (b.embedding_model or self.embedding_model) == self.embedding_model]
+        return sorted(
+            backends,
+            key=lambda b: (b.priority, -random.random() ** (1.0 / b.weight) if b.weight > 0 else 0.0)
+        )
+
+    async def _hedged(
+        self,
+        backend: LLMBackend,
+        kind: str,
+        attempt: Callable[[], Awaitable[Any]],
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> Any:
+        """
+        Ejecuta attempt y, si no termina dentro del delay del hedge, lanza un
+        segundo intento en paralelo. Devuelve el primer resultado exitoso y
+        cancela el otro (discard libera un resultado perdedor ya obtenido).
+        """
+        tracker = backend.latency.setdefault(kind, LatencyTracker())
+        started: Dict[asyncio.Task, float] = {}
+
+        def launch() -> asyncio.Task:
+            self.metrics["attempts"] += 1
+            task = asyncio.ensure_future(attempt())
+            started[task] = time.perf_counter()
+            return task
+
+        primary = launch()
+        pending = {primary}
+        winner = None
+        errors = []
+        try:
+            if settings.llm_hedge_enabled:
+                done, pending = await asyncio.wait(pending, timeout=tracker.hedge_delay())
+                if not done:
+                    self.metrics["hedges_launched"] += 1
+                    pending.add(launch())
+                else:
+                    pending = done
+
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and winner is None:
+                        winner = task
+                    elif task.exception() is not None:
+                        errors.append(task.exception())
+
+            if winner is None:
+                raise errors[0]
+
+            tracker.record(time.perf_counter() - started[winner])
+            if winner is not primary:
+                self.metrics["hedges_won"] += 1
+            return winner.result()
+
+        finally:
+            for task in started:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif discard is not None and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    async def _resilient(
+        self,
+        kind: str,
+        attempt: Callable[[LLMBackend], Awaitable[Any]],
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> Any:
+        """
+        Prueba los backends en orden hasta que uno responda. Los errores no
+        transitorios (400, cancelación) se propagan sin pasar al siguiente.
+        """
+        self.metrics["calls"] += 1
+        candidates = self._candidates(kind)
+        if not candidates:
+            raise LLMUnavailableError(f"Ningún backend del LLM atiende llamadas {kind}")
+
+        for position, backend in enumerate(candidates):
+            try:
+                return await self._on_backend(backend, kind, attempt, discard)
+            except BaseException as e:
+                if not isinstance(e, LLMUnavailableError) and not _is_transient(e):
+                    raise
+                if position == len(candidates) - 1:
+                    raise
+                self.metrics["backend_fallbacks"] += 1
+                logger.warning(
+                    f"LLM {kind}: backend {backend.name} no disponible ({type(e).__name__}), "
+                    f"se pasa a {candidates[position + 1].name}"
+                )
+
+    async def _on_backend(
+        self,
+        backend: LLMBackend,
+        kind: str,
+        attempt: Callable[[LLMBackend], Awaitable[Any]],
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> Any:
+        """Breaker + reintentos con backoff + hedging alrededor de una llamada a un backend."""
+        try:
+            backend.breaker.before_call()
+        except LLMUnavailableError:
+            self.metrics["rejected_by_breaker"] += 1
+            raise
+
+        for attempt_number in range(1, settings.llm_max_attempts + 1):
+            try:
+                result = await self._hedged(backend, kind, lambda: attempt(backend), discard)
+            except BaseException as e:
+                if not _is_transient(e):
+                    backend.breaker.release_probe()
+                    raise
+                self.metrics["failures"] += 1
+                backend.breaker.record_failure()
+                if attempt_number == settings.llm_max_attempts or backend.breaker.state == "open":
+                    raise
+                delay = backoff_delay(attempt_number)
+                logger.warning(
+                    f"LLM {kind} ({backend.name}): {type(e).__name__} en el intento {attempt_number}, "
+                    f"reintento en {delay:.2f}s"
+                )
+                self.metrics["retries"] += 1
+                await asyncio.sleep(delay)
+            else:
+                backend.breaker.record_success()
+                return result
+
+    # ------------------------------------------------------------------
+    # Parámetros
+    # ------------------------------------------------------------------
+
+    def _chat_params(
+        self,
+        backend: LLMBackend,
+        messages: list,
+        max_tokens: Optional[int],
+        temperature: Optional[float],
+        model: Optional[str]
+    ) -> dict:
+        model = backend.model or model or self.model
+        params = {"model": model, "messages": messages}
+
+        # gpt-5 solo acepta temperature=1 (default)
+        if not model.startswith("gpt-5"):
+            params["temperature"] = settings.llm_temperature if temperature is None else temperature
+
+        # Usar el parámetro correcto según el modelo
+        max_tokens = max_tokens or settings.llm_max_tokens
+        if model.startswith(("gpt-5", "gpt-4.1", "gpt-4o")):
+            params["max_completion_tokens"] = max_tokens
+        else:
+            params["max_tokens"] = max_tokens
+        return params
+
+    # ------------------------------------------------------------------
+    # Llamadas
+    # ------------------------------------------------------------------
+
+    async def chat(
+        self,
+        messages: list,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        model: Optional[str] = None
+    ) -> ChatResult:
+        async def create(backend: LLMBackend) -> tuple:
+            params = self._chat_params(backend, messages, max_tokens, temperature, model)
+            return backend, await self.client_for(backend).chat.completions.create(**params)
+
+        backend, response = await self._resilient("chat", create)
+        if not response.choices:
+            raise ValueError("La API retornó una respuesta vacía.")
+
+        usage = response.usage
+        return ChatResult(
+            text=response.choices[0].message.content or "",
+            model_used=response.model or backend.model or model or self.model,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            total_tokens=getattr(usage, "total_tokens", 0) or 0,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            cached_tokens=cached_prompt_tokens(usage),
+            backend=backend.name
+        )
+
+    async def chat_stream(
+        self,
+        messages: list,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        model: Optional[str] = None
+    ) -> ChatStream:
+        """
+        Chunks de la completion (ChatStream); el último trae el uso de tokens
+        (include_usage). Retorna cuando ya llegó el primer chunk: reintentos,
+        hedging y cambio de backend cubren hasta ese punto, no la mitad de
+        una respuesta.
+        """
+        async def open_stream(backend: LLMBackend) -> _StreamStart:
+            params = self._chat_params(backend, messages, max_tokens, temperature, model)
+            stream = await self.client_for(backend).chat.completions.create(
+                **params,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            chunks = stream.__aiter__()
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                # Error o cancelación (hedge perdedor): liberar la conexión
+                await stream.close()
+                raise
+            return _StreamStart(stream, chunks, first, backend.name, params["model"])
+
+        async def close_stream(start: _StreamStart) -> None:
+            await start.stream.close()
+
+        start = await self._resilient("stream", open_stream, discard=close_stream)
+        return ChatStream(self._resume(start), start.backend, start.model)
+
+    @staticmethod
+    async def _resume(start: _StreamStart) -> AsyncIterator:
+        try:
+            if start.first is not None:
+                yield start.first
+            async for chunk in start.chunks:
+                yield chunk
+        finally:
+            await start.stream.close()
+
+    async def embed(self, text: str) -> List[float]:
+        response = await self._resilient(
+            "embed",
+            lambda backend: self.client_for(backend).embeddings.create(model=self.embedding_model, input=text)
+        )
+        return response.data[0].embedding
+
+
+# Instancia global: única dueña de las conexiones al proveedor
+llm_gateway = LLMGateway()
@@ -1,104 +1,252 @@
 # src/app/services/llm_service.py
+"""
+Respuestas del RAG con el LLM.
 
-import os
+El prompt se arma siempre en el mismo orden para que el proveedor pueda
+reutilizar su prefijo entre preguntas (cache de prompts de OpenAI, que
+descuenta los tokens ya vistos):
+
+1. SYSTEM_PROMPT: constante, idéntico byte a byte en toda llamada.
+2. El bloque del paciente (BuiltContext.patient_text): determinista para
+   una misma versión de la historia (orden total en las consultas SQL,
+   secciones en orden fijo y presupuesto independiente de la pregunta).
+3. Al final lo que cambia por pregunta: los chunks de la búsqueda semántica
+   y la pregunta.
+
+Los tokens que el proveedor sirvió desde su cache llegan en
+LLMResponse.cached_tokens.
+"""
+
+import hashlib
 import logging
-from typing import Optional
-from openai import AsyncOpenAI
+import time
+from typing import AsyncGenerator, AsyncIterator, List, Optional, Union
 from pydantic import BaseModel
-from dotenv import load_dotenv
 
-# Cargar variables de entorno
-load_dotenv()
+from app.database.db_config import settings
+from app.services.llm_gateway import ChatStream, cached_prompt_tokens, llm_gateway
+from app.services.model_router import routing_signature
+from app.services.rag_context import count_tokens
 
 logger = logging.getLogger(__name__)
 
+# Constante: cualquier byte distinto invalida el cache de prompts del proveedor
+SYSTEM_PROMPT = (
+    "Eres un asistente médico especializado en analizar historias clínicas.\n"
+    "Debes responder exclusivamente con base en el contexto proporcionado.\n\n"
+    "REGLAS DE FORMATO:\n"
+    "- Usa Markdown.\n"
+    "- Negritas para fechas, medicamentos y diagnósticos.\n"
+    "- Listas numeradas para eventos.\n"
+    "- Viñetas para detalles.\n"
+    "- No inventes información.\n"
+    "- Usa ICD-10 cuando esté disponible.\n"
+    "- Respuestas claras, ordenadas y cronológicas.\n"
+)
+
+
 class LLMResponse(BaseModel):
     """Respuesta estructurada del LLM."""
     text: str
     confidence: float = 0.85
     model_used: str = "gpt-4"
     tokens_used: int = 0
+    # Tokens del prompt y los servidos desde el cache de prompts del proveedor
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    # Backend de LLM_BACKENDS que respondió
+    backend: str = ""
+
+
+class LLMStream:
+    """
+    Respuesta del LLM en streaming: se itera con `async for` y entrega los
+    fragmentos de texto a medida que llegan. Al terminar, `response` tiene
+    la respuesta completa (LLMResponse) y `ttft_ms` el tiempo hasta el
+    primer fragmento desde la llamada a la API.
+    """
+
+    def __init__(self, chunks: ChatStream, started_at: float):
+        self._chunks = chunks
+        self.model = chunks.model
+        self.backend = chunks.backend
+        self.started_at = started_at
+        self.ttft_ms: Optional[int] = None
+        self.response: Optional[LLMResponse] = None
+        self._parts: List[str] = []
+        self._tokens_used = 0
+        self._prompt_tokens = 0
+        self._cached_tokens = 0
+        # Generador entregado por __aiter__: aclose() también lo cierra
+        self._iterator: Optional[AsyncGenerator[str, None]] = None
+
+    def __aiter__(self):
+        self._iterator = self._iterate()
+        return self._iterator
+
+    async def aclose(self) -> None:
+        """Cierra el iterador y la conexión del streaming sin leer el resto de la respuesta."""
+        try:
+            if self._iterator is not None:
+                await self._iterator.aclose()
+        finally:
+            await self._chunks.aclose()
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        async for chunk in self._chunks:
+            # Con include_usage el último chunk trae el uso y ninguna choice
+            if getattr(chunk, "usage", None) is not None:
+                self._tokens_used = getattr(chunk.usage, "completion_tokens", 0) or 0
+                self._prompt_tokens = getattr(chunk.usage, "prompt_tokens", 0) or 0
+                self._cached_tokens = cached_prompt_tokens(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if self.ttft_ms is None:
+                self.ttft_ms = int((time.perf_counter() - self.started_at) * 1000)
+            self._parts.append(delta)
+            yield delta
+
+        response_text = "".join(self._parts)
+        if len(response_text.strip()) < 10:
+            raise ValueError("La respuesta generada no es válida.")
+
+        logger.info(
+            f"Streaming del LLM completo. Tokens usados: {self._tokens_used}, "
+            f"prompt en cache: {self._cached_tokens}/{self._prompt_tokens}, "
+            f"primer token en {self.ttft_ms} ms"
+        )
+        self.response = LLMResponse(
+            text=response_text.strip(),
+            confidence=0.85,
+            model_used=self.model,
+            tokens_used=self._tokens_used,
+            prompt_tokens=self._prompt_tokens,
+            cached_tokens=self._cached_tokens,
+            backend=self.backend
+        )
 
 
 class LLMService:
     """Servicio para interactuar con OpenAI GPT API."""
 
     def __init__(self):
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY no está configurada en .env")
-        
-        self.client = AsyncOpenAI(api_key=api_key)
-        self.model = "gpt-4o-mini"
-        self.max_tokens = 2000
+        # Conexiones compartidas del gateway; modelo y límites desde Settings
+        self.model = settings.llm_model
+        self.max_tokens = settings.rag_answer_max_tokens
+        self.temperature = settings.rag_answer_temperature
+        # Huella de todo lo que, además del contexto y la pregunta, determina
+        # la respuesta (clave del cache de respuestas)
+        self.prompt_version = hashlib.blake2b(
+            repr((
+                self._messages("{question}", "{context}", "{question_context}"), self.model, self.temperature, self.max_tokens,
+                routing_signature(), settings.llm_backends
+            )).encode(),
+            digest_size=8
+        ).hexdigest()
         
         logger.info(f"LLM Service inicializado. Modelo: {self.model}")
 
+    @staticmethod
+    def prefix_messages(context: str) -> list:
+        """Mensajes comunes a toda pregunta sobre el mismo contexto del paciente."""
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"CONTEXTO CLÍNICO:\n{context}"}
+        ]
+
+    def _messages(self, question: str, context: str, question_context: str = "") -> list:
+        # Lo que cambia por pregunta va al final, después del prefijo
+        user_message = (
+            (f"{question_context}\n" if question_context else "") +
+            f"PREGUNTA DEL USUARIO:\n{question}\n\n"
+            "Responde únicamente con la información del contexto."
+        )
+        return self.prefix_messages(context) + [{"role": "user", "content": user_message}]
+
+    def estimate_tokens(self, question: str, context_tokens: int, max_tokens: Optional[int] = None) -> int:
+        """
+        Tokens que el proveedor descuenta del límite por minuto: prompt
+        (contexto ya medido + instrucciones y pregunta) más max_tokens.
+        """
+        prompt_tokens = sum(count_tokens(m["content"]) for m in self._messages(question, "", ""))
+        return context_tokens + prompt_tokens + (max_tokens or self.max_tokens)
+
     async def run_llm(
         self,
         question: str,
         context: str,
-        max_tokens: Optional[int] = None
-    ) -> LLMResponse:
+        max_tokens: Optional[int] = None,
+        stream: bool = False,
+        model: Optional[str] = None,
+        question_context: str = ""
+    ) -> Union[LLMResponse, LLMStream]:
         """
         Genera una respuesta usando el modelo del LLM según el contexto clínico entregado.
+
+        context es el bloque estable del paciente y question_context lo
+        recuperado para esta pregunta, que va después junto a la pregunta.
+
+        Con stream=True devuelve un LLMStream apenas la API acepta la
+        solicitud, sin esperar a que termine la generación. model y
+        max_tokens permiten usar el nivel elegido por model_router.
         """
         
         if max_tokens is None:
             max_tokens = self.max_tokens
+        if model is None:
+            model = self.model
 
-        system_prompt = (
-            "Eres un asistente médico especializado en analizar historias clínicas.\n"
-            "Debes responder exclusivamente con base en el contexto proporcionado.\n\n"
-            "REGLAS DE FORMATO:\n"
-            "- Usa Markdown.\n"
-            "- Negritas para fechas, medicamentos y diagnósticos.\n"
-            "- Listas numeradas para eventos.\n"
-            "- Viñetas para detalles.\n"
-            "- No inventes información.\n"
-            "- Usa ICD-10 cuando esté disponible.\n"
-            "- Respuestas claras, ordenadas y cronológicas.\n"
-        )
+        messages = self._messages(question, context, question_context)
 
-        user_message = (
-            f"CONTEXTO CLÍNICO:\n{context}\n\n"
-            f"PREGUNTA DEL USUARIO:\n{question}\n\n"
-            "Responde únicamente con la información del contexto."
-        )
+        if stream:
+            try:
+                logger.info("Llamando a la API de OpenAI (streaming).")
+                started_at = time.perf_counter()
+                chunks = await llm_gateway.chat_stream(
+                    messages,
+                    max_tokens=max_tokens,
+                    temperature=self.temperature,
+                    model=model
+                )
+                return LLMStream(chunks, started_at)
+            except Exception as e:
+                logger.error(f"Error en la llamada al LLM: {type(e).__name__}: {str(e)}")
+                raise
 
         try:
             logger.info("Llamando a la API de OpenAI.")
             logger.debug(f"Longitud del contexto: {len(context)} caracteres.")
 
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                max_completion_tokens=max_tokens,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.3,
+            response = await llm_gateway.chat(
+                messages,
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+                model=model
             )
 
-            if not response.choices:
-                raise ValueError("La API retornó una respuesta vacía.")
-
-            response_text = response.choices[0].message.content
+            response_text = response.text
 
             if not isinstance(response_text, str) or len(response_text.strip()) < 10:
                 raise ValueError("La respuesta generada no es válida.")
 
-            tokens_used = 0
-            if hasattr(response, "usage") and response.usage is not None:
-                tokens_used = getattr(response.usage, "completion_tokens", 0)
+            tokens_used = response.completion_tokens
 
-            logger.info(f"Respuesta del LLM recibida. Tokens usados: {tokens_used}")
+            logger.info(
+                f"Respuesta del LLM recibida. Tokens usados: {tokens_used}, "
+                f"prompt en cache: {response.cached_tokens}/{response.prompt_tokens}"
+            )
 
             return LLMResponse(
                 text=response_text.strip(),
                 confidence=0.85,
-                model_used=self.model,
-                tokens_used=tokens_used
+                model_used=response.model_used,
+                tokens_used=tokens_used,
+                prompt_tokens=response.prompt_tokens,
+                cached_tokens=response.cached_tokens,
+                backend=response.backend
             )
 
         except Exception as e:
@@ -0,0 +1,314 @@
+# src/app/services/llm_stub_server.py
+"""
+Servidor local compatible con la API de OpenAI, para correr todo el RAG sin
+red ni costo (benchmarks, pruebas, desarrollo sin OPENAI_API_KEY).
+
+Implementa lo que usa llm_gateway:
+- POST /v1/chat/completions: respuesta extractiva y determinista (las
+  líneas del contexto que más palabras comparten con la pregunta), entera o
+  en streaming SSE con el uso de tokens al final (include_usage).
+- POST /v1/embeddings: bolsa de palabras con hashing, normalizada, en la
+  dimensión pedida (1536 por defecto, la de las columnas vector); textos con
+  palabras en común quedan cerca. Formato float o base64.
+- GET /v1/models
+
+Simula también el cache de prompts del proveedor: si el prefijo (todos los
+mensajes menos el último) ya se vio, informa sus tokens en
+usage.prompt_tokens_details.cached_tokens, en bloques de 128 y desde 1024
+tokens como OpenAI.
+
+Los embeddings no son los de OpenAI: la búsqueda vectorial solo es útil si
+los embeddings guardados en la BD también se generaron con este servidor.
+
+Uso (desde src/):
+    python -m app.services.llm_stub_server [--port 8089] [--latency-ms 200] [--token-delay-ms 20]
+
+y en el .env:
+    LLM_BACKENDS=local=http://127.0.0.1:8089/v1
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import sys
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_MODEL = "stub-rag"
+EMBEDDING_DIMENSIONS = 1536
+# Misma aproximación que rag_context sin tiktoken
+CHARS_PER_TOKEN = 4
+# Cache de prompts como el de OpenAI: desde 1024 tokens, en bloques de 128
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK = 128
+PROMPT_CACHE_ENTRIES = 1000
+# Líneas del contexto que entran en la respuesta
+ANSWER_LINES = 3
+
+NO_ANSWER = "No encuentro información sobre eso en la historia clínica del paciente."
+
+
+def _words(text: str) -> List[str]:
+    """Palabras en minúsculas y sin tildes."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.findall(r"\w+", text)
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN) if text else 0
+
+
+# ============================================================================
+# Respuestas
+# ============================================================================
+
+def _split_prompt(messages: List[dict]) -> Tuple[str, str]:
+    """(pregunta, contexto) a partir de los mensajes del chat."""
+    contents = [str(m.get("content") or "") for m in messages if m.get("role") != "system"]
+    last = contents.pop() if contents else ""
+    # llm_service pone la pregunta al final del último mensaje
+    before, marker, question = last.rpartition("PREGUNTA DEL USUARIO:")
+    if not marker:
+        before, question = "", last
+    # Sin las instrucciones que siguen a la pregunta
+    question = question.strip().split("\n\n", 1)[0]
+    return question, "\n".join(contents + [before])
+
+
+def answer_for(messages: List[dict], max_tokens: Optional[int] = None) -> str:
+    """Líneas del contexto con más palabras de la pregunta, en su orden original."""
+    question, context = _split_prompt(messages)
+    keywords = {word for word in _words(question) if len(word) > 3}
+    scored = []
+    for position, line in enumerate(context.splitlines()):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        score = len(keywords & set(_words(line)))
+        if score:
+            scored.append((score, position, line))
+
+    best = sorted(sorted(scored, reverse=True)[:ANSWER_LINES], key=lambda item: item[1])
+    if not best:
+        text = NO_ANSWER
+    else:
+        text = "Según la historia clínica:\n" + "\n".join(f"- {line.lstrip('-* ')}" for _, _, line in best)
+
+    if max_tokens:
+        words = text.split(" ")
+        if len(words) > max_tokens:
+            text = " ".join(words[:max_tokens])
+    return text
+
+
+class PromptCache:
+    """Prefijos de prompt ya vistos (LRU)."""
+
+    def __init__(self, max_entries: int = PROMPT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+
+    def cached_tokens(self, messages: List[dict]) -> int:
+        prefix = messages[:-1]
+        if not prefix:
+            return 0
+        key = hashlib.blake2b(json.dumps(prefix, ensure_ascii=False).encode(), digest_size=16).hexdigest()
+        seen = key in self._seen
+        self._seen[key] = None
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+        tokens = sum(_tokens(str(m.get("content") or "")) for m in prefix)
+        if not seen or tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return tokens - tokens % PROMPT_CACHE_BLOCK
+
+
+# ============================================================================
+# Embeddings
+# ============================================================================
+
+def embedding_for(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> List[float]:
+    """Bolsa de palabras con hashing (signo incluido), normalizada."""
+    vector = [0.0] * dimensions
+    for word in _words(text):
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dimensions] += 1.0 if (value >> 63) & 1 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector))
+    if not norm:
+        # Texto sin palabras: un vector fijo, no el vector cero
+        vector[0], norm = 1.0, 1.0
+    return [x / norm for x in vector]
+
+
+def _encode(vector: List[float], encoding_format: str):
+    if encoding_format == "base64":
+        return base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+    return vector
+
+
+# ============================================================================
+# App
+# ============================================================================
+
+def create_app(
+    latency_ms: float = 0.0,
+    token_delay_ms: float = 0.0,
+    fail_rate: float = 0.0,
+    model: str = DEFAULT_MODEL
+) -> FastAPI:
+    """
+    latency_ms: espera antes de responder (o antes del primer chunk).
+    token_delay_ms: espera entre chunks en streaming.
+    fail_rate: fracción de solicitudes que responden 503 (para probar
+    reintentos y cambio de backend).
+    """
+    app = FastAPI(title="SmartHealth LLM stub", docs_url=None, redoc_url=None)
+    prompt_cache = PromptCache()
+
+    def unavailable() -> Optional[JSONResponse]:
+        if fail_rate and random.random() < fail_rate:
+            return JSONResponse(
+                {"error": {"message": "Falla simulada", "type": "server_error"}},
+                status_code=503
+            )
+        return None
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": model, "object": "model", "owned_by": "smarthealth"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        failure = unavailable()
+        if failure is not None:
+            return failure
+
+        messages = body.get("messages") or []
+        max_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+        answer = answer_for(messages, max_tokens)
+        prompt_tokens = sum(_tokens(str(m.get("content") or "")) for m in messages)
+        completion_tokens = len(answer.split())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": prompt_cache.cached_tokens(messages)},
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model_used = body.get("model") or model
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model_used,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta: dict, finish_reason: Optional[str] = None) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model_used,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def events() -> AsyncIterator[str]:
+            yield chunk({"role": "assistant", "content": ""})
+            for i, word in enumerate(answer.split(" ")):
+                if token_delay_ms and i:
+                    await asyncio.sleep(token_delay_ms / 1000)
+                yield chunk({"content": word if i == 0 else " " + word})
+            yield chunk({}, "stop")
+            if include_usage:
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model_used,
+                    "choices": [],
+                    "usage": usage,
+                }
+                yield f"data: {json.dumps(data)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        failure = unavailable()
+        if failure is not None:
+            return failure
+
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dimensions = body.get("dimensions") or EMBEDDING_DIMENSIONS
+        encoding_format = body.get("encoding_format") or "float"
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+
+        tokens = sum(_tokens(str(text)) for text in inputs)
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": _encode(embedding_for(str(text), dimensions), encoding_format)}
+                for i, text in enumerate(inputs)
+            ],
+            "model": body.get("model") or model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Servidor local compatible con la API de OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Espera antes de responder")
+    parser.add_argument("--token-delay-ms", type=float, default=0.0, help="Espera entre chunks del streaming")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fracción de respuestas 503")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Modelo informado si la solicitud no trae uno")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    app = create_app(args.latency_ms, args.token_delay_ms, args.fail_rate, args.model)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
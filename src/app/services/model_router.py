@@ -0,0 +1,85 @@
+# src/app/services/model_router.py
+"""
+Elección del modelo y del tope de tokens de salida por pregunta.
+
+Con rasgos baratos de la pregunta y del contexto ya armado se elige un nivel:
+
+- fast: consulta puntual ("¿cuándo fue...?", "¿qué dosis...?") corta y sin
+  síntesis -> LLM_FAST_MODEL con LLM_FAST_MAX_TOKENS.
+- complex: pregunta longitudinal o de síntesis (resumen, evolución,
+  comparación, rangos de fechas...) sobre muchos registros o un contexto
+  grande, o una pregunta muy larga -> LLM_COMPLEX_MODEL con
+  LLM_COMPLEX_MAX_TOKENS.
+- standard: el resto -> LLM_MODEL con RAG_ANSWER_MAX_TOKENS.
+
+Con LLM_ROUTING_ENABLED=false todas las preguntas usan standard.
+"""
+
+import re
+from typing import NamedTuple, Tuple
+
+from app.database.db_config import settings
+from app.services.template_answers import normalize_for_intent
+
+# Preguntas puntuales: empiezan pidiendo un dato concreto
+_LOOKUP = re.compile(
+    r"(?:cual|cuales|cuando|quien|donde|cuanto|cuantos|cuantas|que dosis|"
+    r"que medicamento|que diagnostico|tiene|hay|es|esta)\b"
+)
+# Síntesis a lo largo de la historia
+_SYNTHESIS = re.compile(
+    r"\b(?:resum\w*|evolucion\w*|historia|historial|compar\w*|tendencia\w*|"
+    r"cronolog\w*|a lo largo|desde|entre|durante|todos|todas|ultimos \d+|"
+    r"anos|por que|explica\w*|analiz\w*|relacion\w*|cambi\w*|progres\w*|"
+    r"(?:19|20)\d{2})\b"
+)
+
+
+class ModelRoute(NamedTuple):
+    tier: str
+    model: str
+    max_tokens: int
+    # Rasgos que decidieron el nivel (para metadata y logs)
+    reasons: Tuple[str, ...]
+
+
+def _tier(name: str, reasons: Tuple[str, ...]) -> ModelRoute:
+    if name == "fast":
+        return ModelRoute(name, settings.llm_fast_model, settings.llm_fast_max_tokens, reasons)
+    if name == "complex":
+        return ModelRoute(name, settings.llm_complex_model, settings.llm_complex_max_tokens, reasons)
+    return ModelRoute("standard", settings.llm_model, settings.rag_answer_max_tokens, reasons)
+
+
+def route_question(question: str, context_tokens: int, records_in_context: int) -> ModelRoute:
+    """Nivel de modelo para una pregunta con su contexto ya construido."""
+    if not settings.llm_routing_enabled:
+        return _tier("standard", ("routing_disabled",))
+
+    text = normalize_for_intent(question)
+    words = len(text.split())
+    synthesis = _SYNTHESIS.search(text) is not None
+    large_context = context_tokens >= settings.llm_route_complex_context_tokens
+    many_records = records_in_context >= settings.llm_route_complex_min_records
+
+    if words >= settings.llm_route_complex_min_words:
+        return _tier("complex", ("long_question",))
+    if synthesis and (large_context or many_records):
+        reasons = ("synthesis",) + (("large_context",) if large_context else ()) + (
+            ("many_records",) if many_records else ()
+        )
+        return _tier("complex", reasons)
+    if not synthesis and words <= settings.llm_route_fast_max_words and _LOOKUP.match(text):
+        return _tier("fast", ("lookup",))
+    return _tier("standard", ("synthesis",) if synthesis else ("default",))
+
+
+def routing_signature() -> tuple:
+    """Configuración del enrutamiento (parte de la versión del prompt)."""
+    return (
+        settings.llm_routing_enabled,
+        settings.llm_fast_model, settings.llm_fast_max_tokens,
+        settings.llm_complex_model, settings.llm_complex_max_tokens,
+        settings.llm_route_fast_max_words, settings.llm_route_complex_min_words,
+        settings.llm_route_complex_min_records, settings.llm_route_complex_context_tokens,
+    )
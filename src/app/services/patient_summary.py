@@ -0,0 +1,514 @@
+# src/app/services/patient_summary.py
+"""
+Resúmenes clínicos longitudinales por paciente, mantenidos de forma incremental.
+
+Para pacientes con historias largas el contexto RAG solo lleva los registros
+recientes (ventana de clinical_service) y, para lo anterior, el resumen
+guardado en smart_health.patient_summaries:
+- years: una entrada por año con conteos, motivos de consulta, medicamentos
+  y condiciones más frecuentes, más un texto breve.
+- conditions: una entrada por código ICD-10 con primera y última fecha,
+  cantidad de registros, tipos, últimas notas y un texto breve.
+
+Cada resumen guarda el último id incorporado de cada tabla clínica. Al
+actualizar solo se leen las filas nuevas, se suman a los agregados y se
+vuelve a redactar el texto de los años y condiciones que cambiaron. Las
+ediciones de filas ya incorporadas no se detectan: usar --rebuild.
+
+Las marcas son ids de secuencia, que se asignan antes del commit: una fila
+de una transacción que confirma después de que otra con un id mayor ya se
+incorporó queda fuera del resumen (está debajo de la marca). Con cargas
+concurrentes largas, programar un --rebuild periódico de los pacientes
+afectados.
+
+El texto lo redacta un backend (PATIENT_SUMMARY_BACKEND):
+- "stub": local y determinista, a partir de los agregados.
+- "llm": llm_client, con el texto anterior y las entradas nuevas.
+
+Uso (desde src/):
+    python -m app.services.patient_summary run [--limit 100] [--backend llm]
+    python -m app.services.patient_summary run --patient-id 42 [--rebuild]
+
+Con PATIENT_SUMMARY_REFRESH_SECONDS > 0 la API ejecuta la misma pasada en
+segundo plano (ver main.py); las consultas corren en hilos y la sesión se
+cierra mientras el backend redacta.
+"""
+
+import argparse
+import asyncio
+import copy
+import logging
+import sys
+from collections import defaultdict
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.database.cancellation import run_cancellable
+from app.database.database import SessionLocal, engine
+from app.database.db_config import settings
+from app.database.sharding import shard_router
+from app.models.patient_summary import PatientSummary
+from app.services.reference_cache import reference_cache
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "smart_health"
+# Filas por lote al leer registros nuevos
+BATCH_SIZE = 1000
+# Motivos / medicamentos / condiciones que se conservan por año
+TOP_ITEMS = 20
+# Cuántos de ellos aparecen en el texto
+TOP_IN_TEXT = 3
+# Últimas notas que se conservan por condición
+MAX_NOTES = 3
+# Entradas nuevas por año o condición que recibe el backend en una llamada
+MAX_NEW_ENTRIES = 40
+# Largo máximo de un texto libre (motivo, resumen, nota) en las entradas
+MAX_ENTRY_CHARS = 160
+
+
+# ============================================================================
+# Backends de redacción
+# ============================================================================
+
+def _top(counter: Dict[str, int], n: int = TOP_IN_TEXT) -> str:
+    items = sorted(counter.items(), key=lambda kv: (-kv[1], kv[0]))[:n]
+    return ", ".join(f"{name} ({count})" for name, count in items)
+
+
+class StubSummaryBackend:
+    """Redacta los textos a partir de los agregados, sin llamadas externas."""
+
+    name = "stub"
+
+    async def year_text(self, year: str, bucket: dict, previous: str, entries: List[str]) -> str:
+        counts = [
+            (bucket.get("appointments", 0), "citas"),
+            (bucket.get("medical_records", 0), "registros médicos"),
+            (bucket.get("prescriptions", 0), "prescripciones"),
+            (bucket.get("diagnoses", 0), "diagnósticos"),
+        ]
+        parts = [", ".join(f"{count} {label}" for count, label in counts if count) or "Sin actividad"]
+        for key, label in (
+            ("reasons", "Motivos"),
+            ("medications", "Medicamentos"),
+            ("conditions", "Condiciones"),
+        ):
+            if bucket.get(key):
+                parts.append(f"{label}: {_top(bucket[key])}")
+        return ". ".join(parts) + "."
+
+    async def condition_text(self, code: str, condition: dict, previous: str, entries: List[str]) -> str:
+        first, last = condition.get("first_date"), condition.get("last_date")
+        period = f"el {first}" if first == last else f"entre {first} y {last}"
+        parts = [f"{condition.get('count', 0)} registros {period}"]
+        if condition.get("types"):
+            parts.append(f"Tipo: {_top(condition['types'])}")
+        if condition.get("notes"):
+            parts.append(f"Última nota: {condition['notes'][-1]}")
+        return ". ".join(parts) + "."
+
+
+class LLMSummaryBackend:
+    """
+    Redacta con el LLM: recibe el texto anterior y solo las entradas nuevas,
+    así que cada actualización cuesta lo mismo sin importar el largo de la
+    historia. Si el LLM falla se usa el texto del stub para esa entrada.
+    """
+
+    name = "llm"
+
+    SYSTEM_PROMPT = (
+        "Eres un asistente clínico que mantiene resúmenes longitudinales de "
+        "historias clínicas. Responde solo con el resumen actualizado, en "
+        "español, en un máximo de 3 oraciones, sin inventar datos."
+    )
+
+    def __init__(self):
+        self.fallback = StubSummaryBackend()
+
+    async def _update(self, subject: str, facts: str, previous: str, entries: List[str]) -> Optional[str]:
+        from app.services.llm_client import llm_client
+
+        prompt = (
+            f"{subject}\n\n"
+            f"Resumen anterior:\n{previous or '(sin resumen)'}\n\n"
+            f"Registros nuevos:\n" + "\n".join(f"- {entry}" for entry in entries) + "\n\n"
+            f"Datos agregados actuales: {facts}\n\n"
+            "Actualiza el resumen incorporando los registros nuevos."
+        )
+        try:
+            response = await llm_client.generate(prompt=prompt, system_prompt=self.SYSTEM_PROMPT)
+        except Exception as e:
+            logger.warning(f"LLM no disponible para resumir ({subject}): {e}")
+            return None
+        return (response.get("text") or "").strip() or None
+
+    async def year_text(self, year: str, bucket: dict, previous: str, entries: List[str]) -> str:
+        facts = await self.fallback.year_text(year, bucket, previous, entries)
+        text_ = await self._update(f"Año {year} de la historia clínica.", facts, previous, entries)
+        return text_ or facts
+
+    async def condition_text(self, code: str, condition: dict, previous: str, entries: List[str]) -> str:
+        facts = await self.fallback.condition_text(code, condition, previous, entries)
+        subject = f"Condición {condition.get('description')} (ICD-10 {code})."
+        text_ = await self._update(subject, facts, previous, entries)
+        return text_ or facts
+
+
+SUMMARY_BACKENDS = {
+    "stub": StubSummaryBackend,
+    "llm": LLMSummaryBackend,
+}
+
+
+def get_backend(name: Optional[str] = None):
+    name = name or settings.patient_summary_backend
+    if name not in SUMMARY_BACKENDS:
+        raise ValueError(f"Backend de resúmenes desconocido: {name}")
+    return SUMMARY_BACKENDS[name]()
+
+
+# ============================================================================
+# Lectura de registros nuevos
+# ============================================================================
+
+# (tipo, columna de la marca en patient_summaries, columna id, SQL)
+_NEW_ROWS = [
+    ("appointment", "last_appointment_id", "appointment_id", f"""
+        SELECT appointment_id, appointment_date AS event_date, status, reason
+        FROM {SCHEMA}.appointments
+        WHERE patient_id = :patient_id AND appointment_id > :after
+        ORDER BY appointment_id
+    """),
+    ("medical_record", "last_medical_record_id", "medical_record_id", f"""
+        SELECT medical_record_id, registration_datetime AS event_date, record_type, summary_text
+        FROM {SCHEMA}.medical_records
+        WHERE patient_id = :patient_id AND medical_record_id > :after
+        ORDER BY medical_record_id
+    """),
+    ("prescription", "last_prescription_id", "prescription_id", f"""
+        SELECT p.prescription_id,
+               COALESCE(p.prescription_date, mr.registration_datetime) AS event_date,
+               p.medication_id, p.dosage, p.frequency
+        FROM {SCHEMA}.prescriptions p
+        INNER JOIN {SCHEMA}.medical_records mr ON p.medical_record_id = mr.medical_record_id
+        WHERE mr.patient_id = :patient_id AND p.prescription_id > :after
+        ORDER BY p.prescription_id
+    """),
+    ("diagnosis", "last_record_diagnosis_id", "record_diagnosis_id", f"""
+        SELECT rd.record_diagnosis_id, mr.registration_datetime AS event_date,
+               d.icd_code, d.description, rd.diagnosis_type, rd.note
+        FROM {SCHEMA}.record_diagnoses rd
+        INNER JOIN {SCHEMA}.diagnoses d ON rd.diagnosis_id = d.diagnosis_id
+        INNER JOIN {SCHEMA}.medical_records mr ON rd.medical_record_id = mr.medical_record_id
+        WHERE mr.patient_id = :patient_id AND rd.record_diagnosis_id > :after
+        ORDER BY rd.record_diagnosis_id
+    """),
+]
+
+
+def _new_rows(db: Session, sql: str, patient_id: int, after: int) -> Iterator:
+    result = db.execute(
+        text(sql),
+        {"patient_id": patient_id, "after": after},
+        execution_options={"stream_results": True, "yield_per": BATCH_SIZE}
+    )
+    try:
+        for partition in result.partitions(BATCH_SIZE):
+            yield from partition
+    finally:
+        result.close()
+
+
+def _short(value) -> str:
+    value = " ".join(str(value or "").split())
+    return value if len(value) <= MAX_ENTRY_CHARS else value[:MAX_ENTRY_CHARS - 1] + "…"
+
+
+def _bump(counter: Dict[str, int], key) -> None:
+    if key:
+        key = _short(key)
+        counter[key] = counter.get(key, 0) + 1
+
+
+# ============================================================================
+# Actualización incremental
+# ============================================================================
+
+class _SummaryUpdate:
+    """Aplica filas nuevas sobre una copia del resumen y anota qué cambió."""
+
+    def __init__(self, summary: dict):
+        self.summary = summary
+        self.summary.setdefault("years", {})
+        self.summary.setdefault("conditions", {})
+        # (sección, clave) -> entradas nuevas para el backend
+        self.entries: Dict[Tuple[str, str], List[str]] = defaultdict(list)
+
+    def _year(self, event_date) -> Tuple[str, dict]:
+        year = str(event_date.year)
+        return year, self.summary["years"].setdefault(year, {})
+
+    def _note(self, section: str, key: str, entry: str) -> None:
+        entries = self.entries[(section, key)]
+        if len(entries) < MAX_NEW_ENTRIES:
+            entries.append(entry)
+        # Las que no entran igual quedan en los agregados (conteos, top)
+
+    def apply(self, kind: str, row) -> None:
+        if row.event_date is None:
+            return
+        day = str(row.event_date)[:10]
+        year, bucket = self._year(row.event_date)
+
+        if kind == "appointment":
+            bucket["appointments"] = bucket.get("appointments", 0) + 1
+            _bump(bucket.setdefault("reasons", {}), row.reason)
+            self._note("years", year, f"{day} cita ({row.status}): {_short(row.reason)}")
+
+        elif kind == "medical_record":
+            bucket["medical_records"] = bucket.get("medical_records", 0) + 1
+            _bump(bucket.setdefault("record_types", {}), row.record_type)
+            self._note("years", year, f"{day} registro {row.record_type or ''}: {_short(row.summary_text)}")
+
+        elif kind == "prescription":
+            medication = reference_cache.get_medication(row.medication_id)
+            name = medication.name if medication else f"Medicamento {row.medication_id}"
+            bucket["prescriptions"] = bucket.get("prescriptions", 0) + 1
+            _bump(bucket.setdefault("medications", {}), name)
+            self._note("years", year, f"{day} prescripción: {name} {row.dosage or ''} {row.frequency or ''}".rstrip())
+
+        elif kind == "diagnosis":
+            bucket["diagnoses"] = bucket.get("diagnoses", 0) + 1
+            _bump(bucket.setdefault("conditions", {}), row.icd_code)
+            condition = self.summary["conditions"].setdefault(row.icd_code, {
+                "description": row.description,
+                "first_date": day,
+                "last_date": day,
+                "count": 0,
+            })
+            condition["first_date"] = min(condition["first_date"], day)
+            condition["last_date"] = max(condition["last_date"], day)
+            condition["count"] += 1
+            _bump(condition.setdefault("types", {}), row.diagnosis_type)
+            if row.note:
+                condition["notes"] = (condition.get("notes", []) + [_short(row.note)])[-MAX_NOTES:]
+            entry = f"{day} diagnóstico {row.diagnosis_type or ''}: {row.description}"
+            self._note("conditions", row.icd_code, entry + (f" — {_short(row.note)}" if row.note else ""))
+            self._note("years", year, entry)
+
+    async def redact(self, backend) -> None:
+        """Vuelve a redactar el texto de cada año y condición con filas nuevas."""
+        for (section, key), entries in self.entries.items():
+            entry = self.summary[section][key]
+            previous = entry.get("text", "")
+            if section == "years":
+                entry["text"] = await backend.year_text(key, entry, previous, entries)
+            else:
+                entry["text"] = await backend.condition_text(key, entry, previous, entries)
+
+        # Los contadores se recortan al final: durante la pasada son exactos
+        for bucket in self.summary["years"].values():
+            for key in ("reasons", "record_types", "medications", "conditions"):
+                if key in bucket:
+                    top = sorted(bucket[key].items(), key=lambda kv: (-kv[1], kv[0]))[:TOP_ITEMS]
+                    bucket[key] = dict(top)
+
+
+def _read_new_rows(open_session: Callable[[], Session], patient_id: int, rebuild: bool):
+    """
+    Lee el resumen guardado y las filas posteriores a sus marcas. La sesión
+    se cierra antes de redactar: no queda una transacción abierta mientras
+    se espera al backend.
+    Devuelve (update, marcas nuevas, si alguna marca avanzó o no hay resumen).
+    """
+    db = open_session()
+    try:
+        stored = None if rebuild else db.get(PatientSummary, patient_id)
+        update = _SummaryUpdate(copy.deepcopy(stored.summary) if stored else {})
+        watermarks = {}
+        for kind, watermark, id_column, sql in _NEW_ROWS:
+            last_id = getattr(stored, watermark) if stored else 0
+            for row in _new_rows(db, sql, patient_id, last_id):
+                update.apply(kind, row)
+                last_id = max(last_id, getattr(row, id_column))
+            watermarks[watermark] = last_id
+        advanced = stored is None or any(
+            last_id != getattr(stored, watermark) for watermark, last_id in watermarks.items()
+        )
+        return update, watermarks, advanced
+    finally:
+        db.close()
+
+
+def _save_summary(open_session: Callable[[], Session], patient_id: int, values: dict) -> None:
+    db = open_session()
+    try:
+        db.execute(
+            insert(PatientSummary)
+            .values(patient_id=patient_id, **values)
+            .on_conflict_do_update(
+                index_elements=[PatientSummary.patient_id],
+                set_={**values, "updated_at": text("now()")}
+            )
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def update_patient_summary(
+    open_session: Callable[[], Session],
+    patient_id: int,
+    backend=None,
+    rebuild: bool = False
+) -> bool:
+    """
+    Incorpora al resumen del paciente las filas posteriores a sus marcas.
+    open_session abre una sesión de escritura en la BD (shard) del paciente;
+    las consultas corren en un hilo (run_cancellable) para no bloquear el
+    event loop de la API.
+
+    Las marcas se guardan siempre que avancen, aunque ninguna fila nueva
+    tenga fecha (y no cambie ningún texto): si no, el paciente seguiría
+    pendiente en cada pasada. Devuelve False si no había filas nuevas.
+    """
+    backend = backend or get_backend()
+    update, watermarks, advanced = await run_cancellable(_read_new_rows, open_session, patient_id, rebuild)
+    if not advanced:
+        return False
+
+    await update.redact(backend)
+
+    values = {"summary": update.summary, "backend": backend.name, **watermarks}
+    await run_cancellable(_save_summary, open_session, patient_id, values)
+    logger.info(
+        f"Resumen del paciente {patient_id} actualizado ({backend.name}): "
+        f"{len(update.entries)} años/condiciones redactados"
+    )
+    return True
+
+
+def pending_patients(db: Session, limit: Optional[int] = None) -> List[int]:
+    """Pacientes con registros posteriores a su resumen (o sin resumen)."""
+    rows = db.execute(text(f"""
+        SELECT p.patient_id
+        FROM {SCHEMA}.patients p
+        LEFT JOIN {SCHEMA}.patient_summaries s ON s.patient_id = p.patient_id
+        WHERE EXISTS (
+                SELECT 1 FROM {SCHEMA}.appointments a
+                WHERE a.patient_id = p.patient_id
+                  AND a.appointment_id > COALESCE(s.last_appointment_id, 0)
+            )
+           OR EXISTS (
+                SELECT 1 FROM {SCHEMA}.medical_records mr
+                WHERE mr.patient_id = p.patient_id
+                  AND (
+                      mr.medical_record_id > COALESCE(s.last_medical_record_id, 0)
+                      OR EXISTS (
+                          SELECT 1 FROM {SCHEMA}.prescriptions pr
+                          WHERE pr.medical_record_id = mr.medical_record_id
+                            AND pr.prescription_id > COALESCE(s.last_prescription_id, 0)
+                      )
+                      OR EXISTS (
+                          SELECT 1 FROM {SCHEMA}.record_diagnoses rd
+                          WHERE rd.medical_record_id = mr.medical_record_id
+                            AND rd.record_diagnosis_id > COALESCE(s.last_record_diagnosis_id, 0)
+                      )
+                  )
+            )
+        ORDER BY p.patient_id
+        LIMIT :limit
+    """), {"limit": limit}).fetchall()
+    return [row.patient_id for row in rows]
+
+
+# ============================================================================
+# Pasadas sobre todas las BD
+# ============================================================================
+
+def _session_factories() -> Iterator[Tuple[str, Callable[[], Session]]]:
+    """Sesiones de escritura: una por shard, o el primario sin sharding."""
+    if not shard_router.enabled:
+        yield "principal", SessionLocal
+        return
+    for shard_name in shard_router.shards:
+        yield shard_name, partial(shard_router.session_for_shard, shard_name)
+
+
+def _session_factory_for_patient(patient_id: int) -> Callable[[], Session]:
+    if not shard_router.enabled:
+        return SessionLocal
+    return partial(shard_router.session_for_shard, shard_router.shard_for_patient(patient_id))
+
+
+def _pending_in(open_session: Callable[[], Session], limit: Optional[int]) -> List[int]:
+    db = open_session()
+    try:
+        return pending_patients(db, limit)
+    finally:
+        db.close()
+
+
+async def refresh_pending(limit: Optional[int] = None, backend=None) -> int:
+    """Actualiza hasta limit pacientes pendientes por BD. Devuelve cuántos cambiaron."""
+    backend = backend or get_backend()
+    updated = 0
+    for name, open_session in _session_factories():
+        for patient_id in await run_cancellable(_pending_in, open_session, limit):
+            try:
+                updated += await update_patient_summary(open_session, patient_id, backend)
+            except Exception:
+                logger.exception(f"Error resumiendo al paciente {patient_id} en {name}")
+    return updated
+
+
+async def summary_refresh_loop(interval_seconds: float) -> None:
+    """Tarea en segundo plano de la API (PATIENT_SUMMARY_REFRESH_SECONDS)."""
+    while True:
+        try:
+            updated = await refresh_pending(settings.patient_summary_batch_size)
+            if updated:
+                logger.info(f"Resúmenes clínicos actualizados: {updated}")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error en la actualización periódica de resúmenes")
+        await asyncio.sleep(interval_seconds)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Resúmenes clínicos por paciente")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Crear o actualizar resúmenes pendientes")
+    run.add_argument("--patient-id", type=int, default=None, help="Solo este paciente")
+    run.add_argument("--limit", type=int, default=settings.patient_summary_batch_size,
+                     help="Pacientes pendientes por BD")
+    run.add_argument("--rebuild", action="store_true", help="Rehacer el resumen desde cero (con --patient-id)")
+    run.add_argument("--backend", choices=sorted(SUMMARY_BACKENDS), default=None)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    engine.echo = False
+    for shard_engine in shard_router.shards.values():
+        shard_engine.echo = False
+
+    backend = get_backend(args.backend)
+    if args.patient_id is not None:
+        open_session = _session_factory_for_patient(args.patient_id)
+        changed = asyncio.run(update_patient_summary(open_session, args.patient_id, backend, args.rebuild))
+        logger.info(f"Paciente {args.patient_id}: {'actualizado' if changed else 'sin registros nuevos'}")
+    else:
+        logger.info(f"Resúmenes actualizados: {asyncio.run(refresh_pending(args.limit, backend))}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
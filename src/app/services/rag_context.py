@@ -6,103 +6,651 @@ y los transforma en:
 - Un contexto en texto plano para el LLM (GPT-4o-mini).
 - Una lista de fuentes estructuradas.
 - Metadatos de rendimiento y trazabilidad.
+
+El contexto se arma con un presupuesto de tokens (RAG_CONTEXT_MAX_TOKENS):
+- Cada ítem (una cita, una prescripción, un chunk...) se renderiza y se
+  cuenta una sola vez con un encoder de tiktoken cacheado por proceso.
+- El presupuesto se reparte entre secciones por prioridad: primero cada
+  sección usa su cuota, luego lo que sobra se asigna en orden de prioridad.
+- Si un ítem no entra se descarta completo (junto con los siguientes de su
+  sección): nunca se corta una línea a la mitad.
+
+RAG_CONTEXT_FORMAT elige la serialización: "markdown" (etiquetas por ítem) o
+"compact" (una tabla por sección, ~la mitad de tokens). Comparar ambos con
+evaluate_context_formats.py.
+
+Todo menos la búsqueda semántica es igual en cada pregunta sobre el mismo
+paciente: esos fragmentos (renderizados y contados) se cachean por paciente
+y versión de la historia clínica (chart_version) en fragment_cache.
+
+El bloque del paciente (BuiltContext.patient_text) tampoco depende de la
+pregunta al repartir el presupuesto: la búsqueda semántica tiene su cuota
+reservada y solo toma lo que el paciente no usó, nunca al revés. Con la misma
+historia el bloque es idéntico byte a byte entre preguntas y el proveedor
+puede reutilizar el prefijo del prompt (ver llm_service).
+
+La historia anterior a los registros recientes entra como resumen
+(ClinicalRecords.summary, ver patient_summary): una sección por condición y
+otra por año, solo con los años que los registros recientes no cubren.
 """
 
-import tiktoken
-from datetime import date
-from typing import List, Dict, Any
-from src.app.schemas.clinical import PatientInfo, ClinicalRecords
-from src.app.schemas.rag import SimilarChunk
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from app.database.db_config import settings
+from app.schemas.clinical import PatientInfo, ClinicalRecords
+from app.schemas.rag import SimilarChunk
+
+logger = logging.getLogger(__name__)
+
+# Aproximación de caracteres por token si la codificación no está disponible
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+
+# ============================================================================
+# Conteo de tokens
+# ============================================================================
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding_name: Optional[str] = None):
+    """
+    Encoder de tiktoken compartido por todo el proceso. None si no se puede
+    cargar (sin tiktoken o sin acceso para descargar la codificación).
+    """
+    encoding_name = encoding_name or settings.rag_context_encoding
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(
+            f"Codificación {encoding_name} no disponible ({type(e).__name__}); "
+            f"se estiman {CHARS_PER_TOKEN_ESTIMATE} caracteres por token"
+        )
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoder = get_encoder()
+    if encoder is None:
+        return -(-len(text) // CHARS_PER_TOKEN_ESTIMATE)
+    return len(encoder.encode(text))
+
+
+# ============================================================================
+# Renderizado de ítems
+# ============================================================================
 
 def calculate_age(birth_date: date) -> int:
     """Calcula la edad a partir de la fecha de nacimiento."""
     today = date.today()
     return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
 
-def build_context(
-    patient: PatientInfo,
-    records: ClinicalRecords,
-    similar_chunks: List[SimilarChunk],
-    max_tokens: int = 4000
-) -> tuple[str, int]:
-    parts = []
-    name_parts = [
-        patient.first_name,
-        patient.middle_name,
-        patient.first_surname,
-        patient.second_surname
+
+def _take(items: Optional[Iterable], n: int) -> list:
+    """Primeros n elementos de una lista o de un iterador (sin consumir el resto)."""
+    return list(islice(items or (), n))
+
+
+def render_patient_header(patient_info: PatientInfo) -> str:
+    age = "No disponible"
+    if patient_info.birth_date:
+        try:
+            birth_date = (
+                patient_info.birth_date
+                if isinstance(patient_info.birth_date, date)
+                else datetime.strptime(patient_info.birth_date, "%Y-%m-%d").date()
+            )
+            age = calculate_age(birth_date)
+        except Exception as e:
+            logger.warning(f"Error calculando edad: {e}")
+
+    first_name = getattr(patient_info, 'first_name', 'Nombre')
+    first_surname = getattr(patient_info, 'first_surname', 'Apellido')
+    document_number = getattr(patient_info, 'document_number', 'No disponible')
+    gender = getattr(patient_info, 'gender', None) or "No registrado"
+    email = getattr(patient_info, 'email', None) or "No registrado"
+
+    return (
+        "\n### INFORMACIÓN BÁSICA DEL PACIENTE\n"
+        f"Nombre: {first_name} {first_surname}\n"
+        f"Edad: {age}\n"
+        f"Documento: {document_number}\n"
+        f"Género: {gender}\n"
+        f"Email: {email}\n\n"
+    )
+
+
+def render_appointment(apt) -> str:
+    apt_date = getattr(apt, 'appointment_date', 'Fecha no disponible')
+    apt_status = getattr(apt, 'status', None) or 'No disponible'
+    apt_reason = getattr(apt, 'reason', None) or 'No especificado'
+    apt_type = getattr(apt, 'appointment_type', None) or 'Consulta'
+    doctor_name = getattr(apt, 'doctor_name', None)
+    specialty = getattr(apt, 'specialty_name', None)
+
+    lines = [
+        f"**Cita {apt_date}**",
+        f"- Tipo: {apt_type}",
+        f"- Estado: {apt_status}",
+        f"- Motivo: {apt_reason}",
     ]
-    full_name = " ".join(part for part in name_parts if part is not None)
-    age = calculate_age(patient.birth_date)
-
-    parts.append("### Información Básica del Paciente")
-    parts.append(f"Nombre: {full_name}")
-    parts.append(f"Edad: {age} años")
-    parts.append(f"Género: {patient.gender}")
-    parts.append(f"Documento: {patient.document_number} (Tipo ID: {patient.document_type_id})")
-
-    if records.appointments:
-        parts.append("\n### Citas Médicas Recientes")
-        sorted_appts = sorted(
-            records.appointments,
-            key=lambda x: (x.appointment_date, x.start_time or x.end_time or date.min),
-            reverse=True
-        )[:5]
-        for appt in sorted_appts:
-            time_str = f" a las {appt.start_time}" if appt.start_time else ""
-            reason_str = f": {appt.reason}" if appt.reason else ""
-            
-            # ✅ Agregar información del doctor si está disponible
-            doctor_info = ""
-            if appt.doctor_name:
-                doctor_info = f" con {appt.doctor_name}"
-                if appt.specialty_name:
-                    doctor_info += f" ({appt.specialty_name})"
-            
-            parts.append(f"- {appt.appointment_date}{time_str}{doctor_info}{reason_str}")
-
-    if records.diagnoses:
-        parts.append("\n### Diagnósticos Registrados")
-        for dx in records.diagnoses:
-            desc = dx.description or f"Código CIE: {dx.icd_code or 'N/A'}"
-            parts.append(f"- {desc}")
-
-    if records.prescriptions:
-        parts.append("\n### Medicamentos Recetados")
-        for rx in records.prescriptions:
-            if rx.instruction:
-                parts.append(f"- {rx.instruction}")
-            else:
-                med_info = f"Medicamento ID {rx.medication_id}"
-                if rx.dosage:
-                    med_info += f", dosis: {rx.dosage}"
-                parts.append(f"- {med_info}")
-
-    if similar_chunks:
-        parts.append("\n### Información Adicional Relevante")
-        sorted_chunks = sorted(similar_chunks, key=lambda x: x.relevance_score, reverse=True)
-        for chunk in sorted_chunks:
-            parts.append(f"[Relevancia: {chunk.relevance_score:.2f}] {chunk.chunk_text}")
-            date_str = f" ({chunk.date.strftime('%Y-%m-%d')})" if chunk.date else ""
-            
-            # ✅ Agregar info del doctor si es appointment
-            doctor_info = ""
-            if chunk.source_type == "appointment" and chunk.doctor_name:
-                doctor_info = f", Doctor: {chunk.doctor_name}"
-                if chunk.specialty_name:
-                    doctor_info += f" ({chunk.specialty_name})"
-            
-            parts.append(f"[Fuente: {chunk.source_type} ID {chunk.source_id}{date_str}{doctor_info}]")
-            parts.append("")
+    if doctor_name:
+        lines.append(f"- Doctor: {doctor_name}" + (f" ({specialty})" if specialty else ""))
+    return "\n".join(lines) + "\n\n"
+
+
+def render_medical_record(rec) -> str:
+    desc = (
+        getattr(rec, "summary_text", None) or
+        getattr(rec, "description", None) or
+        getattr(rec, "details", None) or
+        getattr(rec, "notes", None) or
+        "Sin descripción"
+    )
+    rec_date = getattr(rec, 'registration_datetime', 'Fecha no disponible')
+    rec_type = getattr(rec, 'record_type', 'Tipo no especificado')
+    return (
+        f"- Fecha: {rec_date}\n"
+        f"  Tipo: {rec_type}\n"
+        f"  Descripción: {desc}\n\n"
+    )
+
+
+def render_prescription(presc) -> str:
+    medication = getattr(presc, 'medication_name', 'Medicamento sin nombre')
+    dosage = getattr(presc, 'dosage', '')
+    frequency = getattr(presc, 'frequency', '')
+    duration = getattr(presc, 'duration', None)
+    instruction = getattr(presc, 'instruction', None)
+    presc_date = getattr(presc, 'prescription_date', None)
+
+    lines = [f"**{medication}**"]
+    if dosage or frequency:
+        lines.append(f"- Dosis: {dosage} {frequency}")
+    if duration:
+        lines.append(f"- Duración: {duration}")
+    if instruction:
+        lines.append(f"- Indicaciones: {instruction}")
+    if presc_date:
+        lines.append(f"- Fecha de prescripción: {presc_date}")
+    return "\n".join(lines) + "\n\n"
+
+
+def render_diagnosis(diag) -> str:
+    diag_desc = getattr(diag, 'description', 'Diagnóstico sin descripción')
+    icd_code = getattr(diag, 'icd_code', 'Sin código')
+    diag_type = getattr(diag, 'diagnosis_type', 'Tipo no especificado')
+    note = getattr(diag, 'note', None)
+    diag_date = getattr(diag, 'diagnosis_date', None)
+
+    lines = [
+        f"**{diag_desc}**",
+        f"- Código ICD-10: {icd_code}",
+        f"- Tipo: {diag_type}",
+    ]
+    if diag_date:
+        lines.append(f"- Fecha: {diag_date}")
+    if note:
+        lines.append(f"- Nota: {note}")
+    return "\n".join(lines) + "\n\n"
+
+
+def render_summary_condition(item) -> str:
+    code, condition = item
+    return f"**{condition.get('description')}** ({code}): {condition.get('text', '')}\n\n"
+
+
+def render_summary_year(item) -> str:
+    year, bucket = item
+    return f"**{year}**: {bucket.get('text', '')}\n\n"
+
+
+def render_chunk(chunk) -> str:
+    chunk_text = getattr(chunk, 'chunk_text', 'Texto no disponible')
+    relevance = getattr(chunk, 'relevance_score', 0.0)
+    source_type = getattr(chunk, 'source_type', 'Desconocida')
+    chunk_date = getattr(chunk, 'date', 'Sin fecha')
+    return (
+        f"- [Relevancia: {relevance:.2f}] {chunk_text}\n"
+        f"  Fuente: {source_type} - Fecha: {chunk_date}\n\n"
+    )
+
+
+# ----------------------------------------------------------------------------
+# Formato compacto: una tabla por sección (fila de encabezado + una línea por
+# registro) en lugar de repetir etiquetas en cada ítem
+# ----------------------------------------------------------------------------
+
+def _cell(value) -> str:
+    if value is None or value == "":
+        return "-"
+    if isinstance(value, datetime):
+        # Los segundos y microsegundos no aportan a la respuesta
+        return value.strftime("%Y-%m-%d %H:%M")
+    return str(value).replace("|", "/").replace("\n", " ").strip()
+
+
+def _row(*values) -> str:
+    return "|".join(_cell(value) for value in values) + "\n"
+
+
+def render_patient_header_compact(patient_info: PatientInfo) -> str:
+    full = render_patient_header(patient_info).strip().splitlines()[1:]
+    return "### PACIENTE\n" + "; ".join(line.strip() for line in full) + "\n\n"
+
+
+def render_appointment_compact(apt) -> str:
+    doctor_name = getattr(apt, 'doctor_name', None)
+    specialty = getattr(apt, 'specialty_name', None)
+    doctor = f"{doctor_name} ({specialty})" if doctor_name and specialty else doctor_name
+    return _row(
+        getattr(apt, 'appointment_date', None),
+        getattr(apt, 'appointment_type', None) or 'Consulta',
+        getattr(apt, 'status', None),
+        getattr(apt, 'reason', None),
+        doctor
+    )
+
+
+def render_medical_record_compact(rec) -> str:
+    desc = (
+        getattr(rec, "summary_text", None) or
+        getattr(rec, "description", None) or
+        getattr(rec, "details", None) or
+        getattr(rec, "notes", None)
+    )
+    return _row(getattr(rec, 'registration_datetime', None), getattr(rec, 'record_type', None), desc)
+
+
+def render_prescription_compact(presc) -> str:
+    return _row(
+        getattr(presc, 'medication_name', None),
+        getattr(presc, 'dosage', None),
+        getattr(presc, 'frequency', None),
+        getattr(presc, 'duration', None),
+        getattr(presc, 'instruction', None),
+        getattr(presc, 'prescription_date', None)
+    )
+
+
+def render_diagnosis_compact(diag) -> str:
+    return _row(
+        getattr(diag, 'description', None),
+        getattr(diag, 'icd_code', None),
+        getattr(diag, 'diagnosis_type', None),
+        getattr(diag, 'diagnosis_date', None),
+        getattr(diag, 'note', None)
+    )
+
+
+def render_summary_condition_compact(item) -> str:
+    code, condition = item
+    return _row(code, condition.get('description'), condition.get('text'))
+
+
+def render_summary_year_compact(item) -> str:
+    year, bucket = item
+    return _row(year, bucket.get('text'))
+
+
+def render_chunk_compact(chunk) -> str:
+    relevance = getattr(chunk, 'relevance_score', 0.0)
+    return _row(
+        f"{relevance:.2f}",
+        getattr(chunk, 'source_type', None),
+        getattr(chunk, 'date', None),
+        getattr(chunk, 'chunk_text', None)
+    )
+
+
+# ============================================================================
+# Secciones y presupuesto
+# ============================================================================
+
+class SectionSpec(NamedTuple):
+    key: str
+    title: str
+    render: Callable[[Any], str]
+    max_items: int
+    # Fracción del presupuesto reservada en la primera pasada
+    share: float
+    # Texto al cierre de la sección (separador con la siguiente)
+    footer: str = ""
+
+
+# Orden en que aparecen en el contexto
+SECTIONS = [
+    SectionSpec(
+        "summary_conditions", "### CONDICIONES (RESUMEN DE TODA LA HISTORIA)\n",
+        render_summary_condition, 15, 0.10
+    ),
+    SectionSpec("appointments", "### CITAS MÉDICAS RECIENTES\n", render_appointment, 10, 0.15),
+    SectionSpec("medical_records", "### REGISTROS MÉDICOS\n", render_medical_record, 10, 0.10),
+    SectionSpec("prescriptions", "### MEDICAMENTOS Y PRESCRIPCIONES\n", render_prescription, 15, 0.15),
+    SectionSpec("diagnoses", "### DIAGNÓSTICOS\n", render_diagnosis, 15, 0.10),
+    SectionSpec(
+        "summary_years", "### HISTORIA ANTERIOR (RESUMEN POR AÑO)\n",
+        render_summary_year, 20, 0.15
+    ),
+    SectionSpec(
+        "similar_chunks",
+        "### INFORMACIÓN ADICIONAL RELEVANTE (BÚSQUEDA SEMÁNTICA)\n",
+        render_chunk, 5, 0.25
+    ),
+]
+
+COMPACT_SECTIONS = [
+    SectionSpec(
+        "summary_conditions",
+        "### CONDICIONES (RESUMEN DE TODA LA HISTORIA)\ncódigo ICD-10|condición|resumen\n",
+        render_summary_condition_compact, 15, 0.10, "\n"
+    ),
+    SectionSpec(
+        "appointments",
+        "### CITAS MÉDICAS RECIENTES\nfecha|tipo|estado|motivo|doctor\n",
+        render_appointment_compact, 10, 0.15, "\n"
+    ),
+    SectionSpec(
+        "medical_records",
+        "### REGISTROS MÉDICOS\nfecha|tipo|descripción\n",
+        render_medical_record_compact, 10, 0.10, "\n"
+    ),
+    SectionSpec(
+        "prescriptions",
+        "### MEDICAMENTOS Y PRESCRIPCIONES\nmedicamento|dosis|frecuencia|duración|indicaciones|fecha\n",
+        render_prescription_compact, 15, 0.15, "\n"
+    ),
+    SectionSpec(
+        "diagnoses",
+        "### DIAGNÓSTICOS\ndescripción|código ICD-10|tipo|fecha|nota\n",
+        render_diagnosis_compact, 15, 0.10, "\n"
+    ),
+    SectionSpec(
+        "summary_years",
+        "### HISTORIA ANTERIOR (RESUMEN POR AÑO)\naño|resumen\n",
+        render_summary_year_compact, 20, 0.15, "\n"
+    ),
+    SectionSpec(
+        "similar_chunks",
+        "### INFORMACIÓN ADICIONAL RELEVANTE (BÚSQUEDA SEMÁNTICA)\nrelevancia|fuente|fecha|texto\n",
+        render_chunk_compact, 5, 0.25, "\n"
+    ),
+]
+
+# RAG_CONTEXT_FORMAT -> (encabezado del paciente, secciones)
+CONTEXT_FORMATS = {
+    "markdown": (render_patient_header, SECTIONS),
+    "compact": (render_patient_header_compact, COMPACT_SECTIONS),
+}
+
+# Orden en que las secciones del paciente reciben presupuesto: lo más
+# compacto y lo más consultado primero; los años viejos al final
+SECTION_PRIORITY = [
+    "diagnoses", "summary_conditions", "prescriptions",
+    "appointments", "medical_records", "summary_years",
+]
+
+# Única sección que depende de la pregunta; el resto se cachea por paciente.
+# Va siempre al final del contexto
+QUESTION_SECTION = "similar_chunks"
+
+
+class SectionFragment(NamedTuple):
+    """Ítems de una sección ya renderizados y contados (inmutable, cacheable)."""
+    spec: SectionSpec
+    texts: Tuple[str, ...]
+    costs: Tuple[int, ...]
+    # Tokens de título + cierre, que se pagan si entra al menos un ítem
+    overhead: int
+
+
+def render_fragment(spec: SectionSpec, items: Optional[Iterable]) -> SectionFragment:
+    texts = tuple(spec.render(item) for item in _take(items, spec.max_items))
+    return SectionFragment(
+        spec,
+        texts,
+        tuple(count_tokens(text) for text in texts),
+        count_tokens(spec.title) + count_tokens(spec.footer)
+    )
+
+
+# Fecha de cada tipo de registro reciente, para saber qué años ya cubren
+_RECORD_DATES = [
+    ("appointments", "appointment_date"),
+    ("medical_records", "registration_datetime"),
+    ("prescriptions", "prescription_date"),
+    ("diagnoses", "diagnosis_date"),
+]
+
+
+def summary_items(clinical_records: Union[ClinicalRecords, Any]) -> Dict[str, list]:
+    """
+    Ítems de las secciones de resumen: condiciones (la más reciente primero)
+    y años hasta el del registro reciente más antiguo inclusive, del más
+    nuevo al más viejo (si no entran todos se descartan los más viejos).
+    """
+    summary = getattr(clinical_records, "summary", None)
+    if summary is None:
+        return {"summary_conditions": [], "summary_years": []}
+
+    oldest = None
+    for key, date_attr in _RECORD_DATES:
+        for item in getattr(clinical_records, key, None) or ():
+            value = getattr(item, date_attr, None)
+            if value is not None and (oldest is None or value.year < oldest):
+                oldest = value.year
+
+    conditions = sorted(
+        summary.conditions.items(),
+        key=lambda item: (item[1].get("last_date") or "", item[0]),
+        reverse=True
+    )
+    years = sorted(
+        (item for item in summary.years.items() if oldest is None or int(item[0]) <= oldest),
+        key=lambda item: int(item[0]),
+        reverse=True
+    )
+    return {"summary_conditions": conditions, "summary_years": years}
+
+
+class PatientFragments(NamedTuple):
+    """Encabezado y secciones clínicas de un paciente, iguales para toda pregunta."""
+    header: str
+    header_tokens: int
+    sections: Dict[str, SectionFragment]
+
+
+def render_patient_fragments(
+    patient_info: PatientInfo,
+    clinical_records: Union[ClinicalRecords, Any],
+    context_format: str
+) -> PatientFragments:
+    render_header, specs = CONTEXT_FORMATS[context_format]
+    header = render_header(patient_info)
+    summaries = summary_items(clinical_records)
+    sections = {}
+    for spec in specs:
+        if spec.key == QUESTION_SECTION:
+            continue
+        items = summaries[spec.key] if spec.key in summaries else getattr(clinical_records, spec.key, None)
+        sections[spec.key] = render_fragment(spec, items)
+    return PatientFragments(header, count_tokens(header), sections)
 
-    full_text = "\n".join(parts)
-    encoder = tiktoken.get_encoding("cl100k_base")
-    tokens = encoder.encode(full_text)
-    if len(tokens) > max_tokens:
-        tokens = tokens[:max_tokens]
-        full_text = encoder.decode(tokens)
 
-    return full_text, len(tokens)
+class FragmentCache:
+    """
+    LRU de PatientFragments por (paciente, versión de la historia, formato).
+    La versión (ClinicalDataResult.chart_version) cambia con cualquier fila
+    leída, así que una entrada nunca queda desactualizada: solo deja de usarse.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, PatientFragments]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key: tuple, render: Callable[[], PatientFragments]) -> PatientFragments:
+        with self._lock:
+            fragments = self._entries.get(key)
+            if fragments is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return fragments
+            self.misses += 1
+
+        fragments = render()
+        with self._lock:
+            self._entries[key] = fragments
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragments
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+fragment_cache = FragmentCache(settings.rag_context_fragment_cache_size)
+
+
+class _Section:
+    """Selección de ítems de un fragmento para un contexto concreto."""
+
+    def __init__(self, fragment: SectionFragment):
+        self.fragment = fragment
+        self.included = 0
+        self.tokens = 0
+
+    def next_cost(self) -> Optional[int]:
+        if self.included >= len(self.fragment.texts):
+            return None
+        cost = self.fragment.costs[self.included]
+        return cost + (self.fragment.overhead if self.included == 0 else 0)
+
+    def fill(self, limit: int) -> int:
+        """Agrega ítems enteros mientras entren en limit. Devuelve los tokens agregados."""
+        added = 0
+        while True:
+            cost = self.next_cost()
+            if cost is None or added + cost > limit:
+                break
+            self.included += 1
+            added += cost
+        self.tokens += added
+        return added
+
+    def render(self) -> str:
+        if not self.included:
+            return ""
+        spec = self.fragment.spec
+        return spec.title + "".join(self.fragment.texts[:self.included]) + spec.footer
+
+
+class BuiltContext(NamedTuple):
+    text: str
+    # Suma de los tokens de cada fragmento incluido. Todos terminan en salto
+    # de línea, donde cl100k ya corta, así que coincide con contar el texto
+    # completo salvo por algún salto doble entre secciones (cota superior)
+    tokens: int
+    # Ítems incluidos y descartados por sección
+    items_used: Dict[str, int]
+    items_dropped: Dict[str, int]
+    # text = patient_text + question_text. patient_text (encabezado y
+    # secciones clínicas) es igual para toda pregunta con la misma historia
+    patient_text: str
+    question_text: str
+
+
+def build_context(
+    patient_info: PatientInfo,
+    clinical_records: Union[ClinicalRecords, Any],
+    similar_chunks: Optional[List[SimilarChunk]],
+    max_tokens: Optional[int] = None,
+    context_format: Optional[str] = None,
+    chart_version: Optional[str] = None
+) -> BuiltContext:
+    """
+    Construye el contexto clínico dentro de max_tokens
+    (None = RAG_CONTEXT_MAX_TOKENS) en el formato pedido: "markdown" o
+    "compact" (None = RAG_CONTEXT_FORMAT).
+
+    Con chart_version, el encabezado y las secciones clínicas se toman del
+    cache de fragmentos del paciente: por pregunta solo se renderiza y cuenta
+    la sección de búsqueda semántica.
+
+    Las secciones del paciente se llenan sin la cuota de la búsqueda
+    semántica, que después recibe su cuota más lo que sobró: la selección
+    del paciente no depende de los chunks de la pregunta.
+
+    Acepta ClinicalRecords (listas) o ClinicalRecordStreams (iteradores con
+    cursor del servidor): de cada sección solo se leen las filas que pueden
+    entrar en el contexto.
+    """
+    budget = max_tokens if max_tokens is not None else settings.rag_context_max_tokens
+    context_format = context_format or settings.rag_context_format
+    if context_format not in CONTEXT_FORMATS:
+        raise ValueError(f"Formato de contexto desconocido: {context_format}")
+    _, specs = CONTEXT_FORMATS[context_format]
+
+    def render() -> PatientFragments:
+        return render_patient_fragments(patient_info, clinical_records, context_format)
+
+    if chart_version is not None and fragment_cache.max_entries > 0:
+        key = (patient_info.patient_id, chart_version, context_format)
+        patient_fragments = fragment_cache.get_or_render(key, render)
+    else:
+        patient_fragments = render()
+
+    question_spec = next(spec for spec in specs if spec.key == QUESTION_SECTION)
+    question_quota = int(budget * question_spec.share)
+
+    sections = {key: _Section(fragment) for key, fragment in patient_fragments.sections.items()}
+    by_priority = [sections[key] for key in SECTION_PRIORITY]
+    remaining = budget - patient_fragments.header_tokens - question_quota
+
+    # 1. Cada sección del paciente dentro de su cuota
+    for section in by_priority:
+        quota = int(budget * section.fragment.spec.share)
+        remaining -= section.fill(min(quota, max(remaining, 0)))
+
+    # 2. Lo que sobró, en orden de prioridad
+    for section in by_priority:
+        remaining -= section.fill(max(remaining, 0))
+
+    # 3. La búsqueda semántica: su cuota más lo que el paciente no usó
+    question_section = _Section(render_fragment(question_spec, similar_chunks))
+    remaining -= question_section.fill(max(remaining + question_quota, 0))
+    sections[QUESTION_SECTION] = question_section
+
+    patient_text = patient_fragments.header + "".join(
+        sections[spec.key].render() for spec in specs if spec.key != QUESTION_SECTION
+    )
+    question_text = question_section.render()
+    text = patient_text + question_text
+    tokens = patient_fragments.header_tokens + sum(section.tokens for section in sections.values())
+    items_used = {key: section.included for key, section in sections.items()}
+    items_dropped = {
+        key: len(section.fragment.texts) - section.included
+        for key, section in sections.items()
+        if len(section.fragment.texts) > section.included
+    }
+    if items_dropped:
+        logger.info(f"Contexto sobre {budget} tokens, ítems descartados: {items_dropped}")
+
+    return BuiltContext(text, tokens, items_used, items_dropped, patient_text, question_text)
 
 
 def build_sources(
@@ -0,0 +1,169 @@
+# src/app/services/reference_cache.py
+"""
+Cache en memoria de datos de referencia (doctores, especialidades, medicamentos).
+
+Son tablas pequeñas que cambian poco. Resolverlas aquí por id permite que las
+queries calientes de clinical_service y vector_search devuelvan solo ids y se
+ahorren los JOIN con doctors / doctor_specialties / specialties / medications
+y el DISTINCT ON por certification_date.
+
+Refresco:
+- Periódico: al consultar, si pasaron más de REFERENCE_CACHE_TTL_SECONDS.
+- Por fallo de búsqueda: un id desconocido (doctor o medicamento nuevo)
+  fuerza una recarga, como máximo una vez cada MISS_REFRESH_INTERVAL segundos.
+- Manual: invalidate() desde cualquier proceso que modifique esas tablas.
+"""
+
+import logging
+import threading
+from functools import partial
+import time
+from typing import Callable, Dict, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.database.database import open_read_session
+from app.database.db_config import settings
+
+logger = logging.getLogger(__name__)
+
+# Mínimo de segundos entre recargas provocadas por ids desconocidos
+MISS_REFRESH_INTERVAL = 5.0
+
+DEFAULT_MEDICATION_NAME = "Medicamento no especificado"
+
+
+class DoctorRef(NamedTuple):
+    name: str
+    specialty_name: Optional[str]
+    medical_license_number: Optional[str]
+
+
+class MedicationRef(NamedTuple):
+    name: str
+    active_ingredient: Optional[str]
+    pharmaceutical_form: Optional[str]
+
+
+class ReferenceDataCache:
+    """Diccionarios id -> referencia con recarga periódica y segura entre hilos."""
+
+    def __init__(self, session_factory: Callable[[], Session], ttl_seconds: int):
+        self._session_factory = session_factory
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._doctors: Dict[int, DoctorRef] = {}
+        self._medications: Dict[int, MedicationRef] = {}
+        self._loaded_at = 0.0
+
+    # ------------------------------------------------------------------
+    # Carga
+    # ------------------------------------------------------------------
+
+    def refresh(self) -> None:
+        """Recarga las tablas de referencia y reemplaza los diccionarios."""
+        db = self._session_factory()
+        try:
+            doctor_rows = db.execute(text("""
+                SELECT DISTINCT ON (d.doctor_id)
+                    d.doctor_id,
+                    d.first_name || ' ' || d.last_name AS doctor_name,
+                    s.specialty_name,
+                    d.medical_license_number
+                FROM smart_health.doctors d
+                LEFT JOIN smart_health.doctor_specialties ds
+                       ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
+                LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
+                ORDER BY d.doctor_id, ds.certification_date DESC NULLS LAST
+            """)).fetchall()
+
+            medication_rows = db.execute(text("""
+                SELECT
+                    medication_id,
+                    commercial_name,
+                    active_ingredient,
+                    presentation
+                FROM smart_health.medications
+            """)).fetchall()
+        except Exception:
+            logger.exception("Error recargando cache de datos de referencia")
+            raise
+        finally:
+            db.close()
+
+        doctors = {
+            row.doctor_id: DoctorRef(row.doctor_name, row.specialty_name, row.medical_license_number)
+            for row in doctor_rows
+        }
+        medications = {
+            row.medication_id: MedicationRef(
+                row.commercial_name or DEFAULT_MEDICATION_NAME,
+                row.active_ingredient,
+                row.presentation
+            )
+            for row in medication_rows
+        }
+
+        # Reemplazo atómico: los lectores ven el dict viejo o el nuevo, nunca uno a medias
+        self._doctors = doctors
+        self._medications = medications
+        self._loaded_at = time.monotonic()
+        logger.info(
+            f"Cache de referencia cargado: {len(doctors)} doctores, {len(medications)} medicamentos"
+        )
+
+    def invalidate(self) -> None:
+        """Marca el cache como vencido; la próxima consulta lo recarga."""
+        self._loaded_at = 0.0
+
+    def _ensure_fresh(self, force: bool = False) -> None:
+        age = time.monotonic() - self._loaded_at
+        if not force and age < self._ttl_seconds:
+            return
+        if force and age < MISS_REFRESH_INTERVAL:
+            return
+
+        with self._lock:
+            # Otro hilo pudo haber recargado mientras esperábamos el lock
+            age = time.monotonic() - self._loaded_at
+            if (not force and age < self._ttl_seconds) or (force and age < MISS_REFRESH_INTERVAL):
+                return
+            try:
+                self.refresh()
+            except Exception:
+                # Si hay datos viejos se siguen usando; se reintenta en el próximo fallo
+                if not self._loaded_at:
+                    raise
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def get_doctor(self, doctor_id: Optional[int]) -> Optional[DoctorRef]:
+        if doctor_id is None:
+            return None
+        self._ensure_fresh()
+        ref = self._doctors.get(doctor_id)
+        if ref is None:
+            self._ensure_fresh(force=True)
+            ref = self._doctors.get(doctor_id)
+        return ref
+
+    def get_medication(self, medication_id: Optional[int]) -> Optional[MedicationRef]:
+        if medication_id is None:
+            return None
+        self._ensure_fresh()
+        ref = self._medications.get(medication_id)
+        if ref is None:
+            self._ensure_fresh(force=True)
+            ref = self._medications.get(medication_id)
+        return ref
+
+
+# Instancia global del cache
+reference_cache = ReferenceDataCache(
+    # Datos de referencia: tolera en la réplica tanto atraso como el TTL del cache
+    session_factory=partial(open_read_session, settings.reference_cache_ttl_seconds),
+    ttl_seconds=settings.reference_cache_ttl_seconds
+)
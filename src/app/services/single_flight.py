@@ -0,0 +1,133 @@
+# src/app/services/single_flight.py
+"""
+Single-flight para secuencias de eventos asíncronas.
+
+Si llega una solicitud con la misma clave que otra todavía en curso
+(doble clic, reintentos del cliente, dos pestañas), no se vuelve a ejecutar:
+se suma como seguidora y recibe los mismos eventos que la primera (los ya
+emitidos y luego los nuevos, en orden).
+
+La secuencia corre en una tarea propia del vuelo, no en la de la solicitud
+que la inició: si ese cliente se desconecta, los demás siguen recibiendo
+eventos. La tarea se cancela solo cuando ya no queda ningún suscriptor. Al
+terminar el vuelo la clave se libera; las solicitudes posteriores empiezan
+uno nuevo (y normalmente encuentran la respuesta en el cache).
+"""
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """Ejecución compartida: eventos emitidos y estado."""
+
+    def __init__(self):
+        self.events: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self) -> None:
+        await self._changed.wait()
+
+
+class FlightSubscription:
+    """Iterador de los eventos de un vuelo para un suscriptor."""
+
+    def __init__(self, group: "SingleFlight", key: Hashable, flight: _Flight, leader: bool):
+        self._group = group
+        self._key = key
+        self._flight = flight
+        self._index = 0
+        self._closed = False
+        # False: se sumó a un vuelo que ya estaba en curso
+        self.leader = leader
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        flight = self._flight
+        while True:
+            if self._index < len(flight.events):
+                event = flight.events[self._index]
+                self._index += 1
+                return event
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                raise StopAsyncIteration
+            await flight.wait()
+
+    async def aclose(self) -> None:
+        """Deja el vuelo; si era el último suscriptor, cancela la ejecución."""
+        if self._closed:
+            return
+        self._closed = True
+        flight = self._flight
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            logger.info(f"Single-flight sin suscriptores, se cancela: {self._key}")
+            self._group.metrics["cancelled"] += 1
+            self._group._forget(self._key, flight)
+            flight.task.cancel()
+
+
+class SingleFlight:
+    """Agrupa ejecuciones concurrentes con la misma clave."""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.metrics: Dict[str, int] = {"leaders": 0, "followers": 0, "cancelled": 0}
+
+    def join(self, key: Hashable, factory: Callable[[], AsyncIterator]) -> FlightSubscription:
+        """
+        Suscribe a la ejecución en curso de key o, si no hay, inicia
+        factory() en una tarea nueva. El suscriptor debe llamar aclose().
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.ensure_future(self._run(key, flight, factory()))
+            self.metrics["leaders"] += 1
+        else:
+            self.metrics["followers"] += 1
+            logger.info(f"Solicitud unida a una ejecución en curso: {key}")
+        flight.subscribers += 1
+        return FlightSubscription(self, key, flight, leader)
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _run(self, key: Hashable, flight: _Flight, events: AsyncIterator) -> None:
+        try:
+            async for event in events:
+                flight.events.append(event)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(key, flight)
+            flight.notify()
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def status(self) -> Dict[str, int]:
+        return {"in_flight": len(self._flights), **self.metrics}
@@ -0,0 +1,226 @@
+# src/app/services/template_answers.py
+"""
+Respuestas por plantilla para preguntas puramente estructuradas.
+
+Preguntas como "¿cuál fue su última cita?", "¿qué medicamentos tiene
+recetados?" o "¿qué diagnósticos tiene?" se responden directamente desde
+ClinicalRecords, sin búsqueda vectorial ni LLM, en milisegundos.
+
+La detección es conservadora: la pregunta normalizada (sin tildes ni signos)
+tiene que coincidir ENTERA con uno de los patrones de INTENT_PATTERNS. Con
+cualquier calificador adicional ("... y en qué dosis", "... desde 2020",
+"¿por qué ...?") no hay plantilla y la pregunta sigue al LLM.
+
+answer_from_template(question, records) -> TemplateAnswer | None
+"""
+
+import logging
+import re
+import unicodedata
+from datetime import date, datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from app.schemas.clinical import ClinicalRecords
+
+logger = logging.getLogger(__name__)
+
+# Referencia opcional al paciente al final de la pregunta
+_SUBJECT = r"(?: (?:del|el|al|la|de la|de el) paciente)?"
+_APPOINTMENT = r"cita(?: medica)?"
+
+INTENT_PATTERNS: Dict[str, List[str]] = {
+    "last_appointment": [
+        rf"(?:cual|cuando) (?:fue|es) (?:su|la) ultima {_APPOINTMENT}{_SUBJECT}",
+        rf"(?:su |la )?ultima {_APPOINTMENT}{_SUBJECT}",
+    ],
+    "next_appointment": [
+        rf"(?:cual|cuando) es (?:su|la) (?:proxima|siguiente) {_APPOINTMENT}{_SUBJECT}",
+        rf"(?:su |la )?(?:proxima|siguiente) {_APPOINTMENT}{_SUBJECT}",
+        rf"(?:tiene|hay) (?:alguna )?citas? (?:programadas?|pendientes?){_SUBJECT}",
+    ],
+    "medications": [
+        rf"(?:que|cuales) (?:medicamentos|medicinas|farmacos) "
+        rf"(?:tiene (?:recetados|prescritos|formulados)|toma|esta tomando|"
+        rf"le (?:han )?(?:recetado|prescrito|formulado)){_SUBJECT}",
+        rf"(?:cuales son )?(?:sus |los )?(?:lista de )?(?:medicamentos|medicinas)"
+        rf"(?: actuales| recetados| prescritos)?{_SUBJECT}",
+    ],
+    "diagnoses": [
+        rf"(?:que|cuales) (?:diagnosticos|enfermedades) tiene{_SUBJECT}",
+        rf"(?:cuales son )?(?:sus |los )?diagnosticos(?: actuales| principales)?{_SUBJECT}",
+    ],
+}
+
+_COMPILED = {
+    intent: [re.compile(pattern) for pattern in patterns]
+    for intent, patterns in INTENT_PATTERNS.items()
+}
+
+# Estados (normalizados) de citas que no se realizaron
+NOT_HELD_STATUSES = ("cancelada", "cancelado", "no asistio", "no_show", "no show", "inasistencia")
+COMPLETED_STATUSES = ("completada",)
+
+
+class TemplateAnswer(NamedTuple):
+    intent: str
+    text: str
+    # Registros citados en la respuesta (para construir sources)
+    records: ClinicalRecords
+
+
+def normalize_for_intent(question: str) -> str:
+    """Minúsculas, sin tildes, sin signos de puntuación y espacios colapsados."""
+    text = unicodedata.normalize("NFKD", question.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def detect_intent(question: str) -> Optional[str]:
+    text = normalize_for_intent(question)
+    for intent, patterns in _COMPILED.items():
+        if any(pattern.fullmatch(text) for pattern in patterns):
+            return intent
+    return None
+
+
+# ============================================================================
+# Plantillas
+# ============================================================================
+
+def _day(value) -> str:
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value) if value else "fecha no registrada"
+
+
+def _appointment_line(apt) -> str:
+    line = f"**{_day(apt.appointment_date)}**"
+    if apt.start_time:
+        line += f" a las {apt.start_time.strftime('%H:%M')}"
+    if apt.doctor_name:
+        line += f" con {apt.doctor_name}"
+        if apt.specialty_name:
+            line += f" ({apt.specialty_name})"
+    details = []
+    if apt.reason:
+        details.append(f"motivo: {apt.reason}")
+    if apt.status:
+        details.append(f"estado: {apt.status}")
+    if details:
+        line += f" — {', '.join(details)}"
+    return line
+
+
+def _status(apt) -> str:
+    return normalize_for_intent(apt.status or "")
+
+
+def _last_appointment(records: ClinicalRecords) -> TemplateAnswer:
+    today = date.today()
+    # Las citas vienen de la más reciente a la más antigua
+    past = [
+        apt for apt in records.appointments
+        if apt.appointment_date <= today and _status(apt) not in NOT_HELD_STATUSES
+    ]
+    if not past:
+        return TemplateAnswer("last_appointment", "No hay citas anteriores registradas para el paciente.", ClinicalRecords())
+    apt = past[0]
+    return TemplateAnswer(
+        "last_appointment",
+        f"La última cita del paciente fue el {_appointment_line(apt)}.",
+        ClinicalRecords(appointments=[apt])
+    )
+
+
+def _next_appointment(records: ClinicalRecords) -> TemplateAnswer:
+    today = date.today()
+    upcoming = sorted(
+        (apt for apt in records.appointments
+         if apt.appointment_date >= today and _status(apt) not in NOT_HELD_STATUSES + COMPLETED_STATUSES),
+        key=lambda apt: apt.appointment_date
+    )
+    if not upcoming:
+        return TemplateAnswer("next_appointment", "El paciente no tiene citas programadas.", ClinicalRecords())
+    lines = [f"El paciente tiene {len(upcoming)} cita(s) programada(s):"]
+    lines += [f"{i}. {_appointment_line(apt)}" for i, apt in enumerate(upcoming, 1)]
+    return TemplateAnswer("next_appointment", "\n".join(lines), ClinicalRecords(appointments=upcoming))
+
+
+def _medications(records: ClinicalRecords) -> TemplateAnswer:
+    # Una línea por medicamento, con su prescripción más reciente
+    latest = {}
+    for presc in records.prescriptions:
+        latest.setdefault(presc.medication_name, presc)
+    if not latest:
+        return TemplateAnswer("medications", "No hay medicamentos recetados en los registros del paciente.", ClinicalRecords())
+
+    lines = [f"Medicamentos en las prescripciones registradas del paciente ({len(latest)}):"]
+    for i, presc in enumerate(latest.values(), 1):
+        line = f"{i}. **{presc.medication_name}**"
+        dose = " ".join(part for part in (presc.dosage, presc.frequency) if part)
+        if dose:
+            line += f" {dose}"
+        if presc.duration:
+            line += f", durante {presc.duration}"
+        line += f" (recetado el **{_day(presc.prescription_date)}**)"
+        if presc.instruction:
+            line += f"\n   - Indicación: {presc.instruction}"
+        lines.append(line)
+    return TemplateAnswer("medications", "\n".join(lines), ClinicalRecords(prescriptions=list(latest.values())))
+
+
+def _diagnoses(records: ClinicalRecords) -> TemplateAnswer:
+    # Un ítem por código, con su registro más reciente
+    latest = {}
+    for diag in records.diagnoses:
+        latest.setdefault(diag.icd_code, diag)
+
+    lines = []
+    if latest:
+        lines.append(f"Diagnósticos registrados del paciente ({len(latest)}):")
+        for i, diag in enumerate(latest.values(), 1):
+            line = f"{i}. **{diag.description}** (ICD-10: {diag.icd_code})"
+            if diag.diagnosis_type:
+                line += f" — {diag.diagnosis_type}"
+            line += f", **{_day(diag.diagnosis_date)}**"
+            lines.append(line)
+
+    # Condiciones anteriores a la ventana, del resumen longitudinal
+    summary = records.summary
+    older = [
+        (code, condition) for code, condition in (summary.conditions.items() if summary else ())
+        if code not in latest
+    ]
+    if older:
+        older.sort(key=lambda item: item[1].get("last_date") or "", reverse=True)
+        lines.append("\nAntecedentes en la historia anterior:")
+        for code, condition in older:
+            lines.append(
+                f"- **{condition.get('description', code)}** (ICD-10: {code}), "
+                f"{condition.get('count', 0)} registro(s), último el **{condition.get('last_date')}**"
+            )
+
+    if not lines:
+        return TemplateAnswer("diagnoses", "No hay diagnósticos registrados para el paciente.", ClinicalRecords())
+    return TemplateAnswer("diagnoses", "\n".join(lines), ClinicalRecords(diagnoses=list(latest.values())))
+
+
+_TEMPLATES: Dict[str, Callable[[ClinicalRecords], TemplateAnswer]] = {
+    "last_appointment": _last_appointment,
+    "next_appointment": _next_appointment,
+    "medications": _medications,
+    "diagnoses": _diagnoses,
+}
+
+
+def answer_from_template(question: str, records: ClinicalRecords) -> Optional[TemplateAnswer]:
+    """Respuesta por plantilla si la pregunta es puramente estructurada; si no, None."""
+    intent = detect_intent(question)
+    if intent is None:
+        return None
+    answer = _TEMPLATES[intent](records)
+    logger.info(f"Pregunta respondida por plantilla ({intent})")
+    return answer
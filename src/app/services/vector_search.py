@@ -1,9 +1,11 @@
-from typing import List
+from typing import List, Optional
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 from app.schemas.rag import SimilarChunk
 from app.services.llm_client import get_embedding
-from app.database.database import SessionLocal
+from app.services.reference_cache import reference_cache
+from app.database.sharding import open_patient_session
+from app.database.cancellation import run_cancellable
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,6 +15,8 @@ DEFAULT_TOP_K = 15
 MAX_PER_TABLE = 10
 DEFAULT_YEARS_BACK = 5
 DEFAULT_MIN_SCORE = 0.3
+# Los embeddings se generan en batch: unos segundos de atraso en la réplica no importan
+READ_MAX_STALENESS_SECONDS = 30
 
 
 async def search_similar_chunks(
@@ -21,55 +25,71 @@ async def search_similar_chunks(
     k: int = DEFAULT_TOP_K,
     min_score: float = DEFAULT_MIN_SCORE,
     allowed_sources: list[str] | None = None,
+    question_embedding: Optional[List[float]] = None,
 ) -> List[SimilarChunk]:
     """
     Devuelve los k chunks más relevantes para la pregunta de un paciente.
+    question_embedding evita volver a generar el embedding si el llamador
+    ya lo tiene (p.ej. el router, que lo usa también en el cache semántico).
 
     Fuentes consultadas:
     - appointments
     - medical_records
     - diagnoses
     - prescriptions
+
+    Las consultas corren en un hilo: si se cancela la espera (timeout o
+    cliente desconectado) se cancelan también en la BD.
     """
 
     # Generar embedding de la pregunta
-    question_embedding = await get_embedding(question)
+    if question_embedding is None:
+        question_embedding = await get_embedding(question)
 
     if isinstance(question_embedding, list):
         embedding_str = '[' + ','.join(map(str, question_embedding)) + ']'
     else:
         embedding_str = question_embedding
 
-    db: Session = SessionLocal()
+    return await run_cancellable(
+        _search_chunks, patient_id, embedding_str, k, min_score, allowed_sources
+    )
+
+
+def _search_chunks(
+    patient_id: int,
+    embedding_str: str,
+    k: int,
+    min_score: float,
+    allowed_sources: list[str] | None,
+) -> List[SimilarChunk]:
+    """Consultas de similitud sobre las cuatro tablas (síncrono)."""
+    db: Session = open_patient_session(patient_id, READ_MAX_STALENESS_SECONDS)
     try:
+        # Las filas vienen de nuestra BD: SimilarChunk.trusted evita
+        # la validación Pydantic por cada hit
         chunks: List[SimilarChunk] = []
 
         # ================================
         # 1. APPOINTMENTS
         # ================================
         try:
+            # Sin JOIN a doctors/specialties: el doctor se resuelve con el
+            # cache de referencia, así el ORDER BY es solo por distancia
             sql_appointments = text("""
-                SELECT DISTINCT ON (a.appointment_id)
-                    a.appointment_id AS source_id,
-                    a.patient_id AS patient_id,
-                    a.reason AS text,
-                    a.appointment_date AS date,
-                    d.first_name || ' ' || d.last_name AS doctor_name,
-                    s.specialty_name,
-                    d.medical_license_number,
-                    1 - (a.reason_embedding <-> CAST(:q_emb AS vector)) AS relevance_score
-                FROM smart_health.appointments a
-                INNER JOIN smart_health.doctors d ON a.doctor_id = d.doctor_id
-                LEFT JOIN smart_health.doctor_specialties ds 
-                       ON d.doctor_id = ds.doctor_id AND ds.is_active = TRUE
-                LEFT JOIN smart_health.specialties s ON ds.specialty_id = s.specialty_id
-                WHERE a.patient_id = :patient_id
-                    AND a.reason_embedding IS NOT NULL
-                    AND a.reason IS NOT NULL
-                    AND a.appointment_date >= NOW() - INTERVAL '5 years'
-                ORDER BY a.appointment_id, 
-                         ds.certification_date DESC NULLS LAST, 
-                         a.reason_embedding <-> CAST(:q_emb AS vector)
+                SELECT
+                    appointment_id AS source_id,
+                    patient_id AS patient_id,
+                    doctor_id,
+                    reason AS text,
+                    appointment_date AS date,
+                    1 - (reason_embedding <-> CAST(:q_emb AS vector)) AS relevance_score
+                FROM smart_health.appointments
+                WHERE patient_id = :patient_id
+                    AND reason_embedding IS NOT NULL
+                    AND reason IS NOT NULL
+                    AND appointment_date >= NOW() - INTERVAL '5 years'
+                ORDER BY reason_embedding <-> CAST(:q_emb AS vector)
                 LIMIT :limit_value
             """)
 
@@ -83,17 +103,18 @@ async def search_similar_chunks(
             ).fetchall()
 
             for row in rows:
+                doctor = reference_cache.get_doctor(row.doctor_id)
                 chunks.append(
-                    SimilarChunk(
+                    SimilarChunk.trusted(
                         source_type="appointment",
                         source_id=row.source_id,
                         patient_id=row.patient_id,
                         chunk_text=row.text,
                         date=row.date,
                         relevance_score=float(row.relevance_score),
-                        doctor_name=row.doctor_name,
-                        specialty_name=row.specialty_name,
-                        medical_license=row.medical_license_number,
+                        doctor_name=doctor.name if doctor else None,
+                        specialty_name=doctor.specialty_name if doctor else None,
+                        medical_license=doctor.medical_license_number if doctor else None,
                     )
                 )
         except Exception as e:
@@ -130,7 +151,7 @@ async def search_similar_chunks(
 
             for row in rows_mr:
                 chunks.append(
-                    SimilarChunk(
+                    SimilarChunk.trusted(
                         source_type="medical_record",
                         source_id=row.source_id,
                         patient_id=row.patient_id,
@@ -177,7 +198,7 @@ async def search_similar_chunks(
 
             for row in rows_diag:
                 chunks.append(
-                    SimilarChunk(
+                    SimilarChunk.trusted(
                         source_type="diagnosis",
                         source_id=row.source_id,
                         patient_id=row.patient_id,
@@ -226,7 +247,7 @@ async def search_similar_chunks(
 
             for row in rows_presc:
                 chunks.append(
-                    SimilarChunk(
+                    SimilarChunk.trusted(
                         source_type="prescription",
                         source_id=row.source_id,
                         patient_id=row.patient_id,
@@ -0,0 +1,80 @@
+"""Índices para las queries calientes de clinical_service y vector_search
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+Las tablas clínicas se crean con los scripts de la carpeta pipelines; esta
+migración solo garantiza los índices que necesitan las búsquedas por paciente.
+Se crean con CONCURRENTLY para no bloquear escrituras en producción. Si un
+build anterior se interrumpió, el índice queda INVALID con el mismo nombre e
+IF NOT EXISTS no lo reconstruiría: esos se eliminan y se crean de nuevo.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SCHEMA = "smart_health"
+
+# (nombre, tabla, columnas, condición parcial)
+HOT_PATH_INDEXES = [
+    ("ix_patients_document", "patients", ["document_type_id", "document_number"], None),
+    ("ix_appointments_patient_date", "appointments", ["patient_id", "appointment_date"], None),
+    ("ix_medical_records_patient_datetime", "medical_records", ["patient_id", "registration_datetime"], None),
+    ("ix_prescriptions_medical_record", "prescriptions", ["medical_record_id"], None),
+    ("ix_record_diagnoses_medical_record", "record_diagnoses", ["medical_record_id"], None),
+    ("ix_doctor_specialties_doctor_active", "doctor_specialties", ["doctor_id"], "is_active"),
+]
+
+
+# Índice que existe pero quedó inválido (CREATE INDEX CONCURRENTLY interrumpido)
+INVALID_INDEX_QUERY = sa.text("""
+    SELECT 1
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = :schema AND c.relname = :name AND NOT i.indisvalid
+""")
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    # CREATE INDEX CONCURRENTLY no puede ejecutarse dentro de una transacción
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in HOT_PATH_INDEXES:
+            if bind.execute(INVALID_INDEX_QUERY, {"schema": SCHEMA, "name": name}).first():
+                op.drop_index(
+                    name,
+                    table_name=table,
+                    schema=SCHEMA,
+                    postgresql_concurrently=True,
+                )
+            op.create_index(
+                name,
+                table,
+                columns,
+                schema=SCHEMA,
+                if_not_exists=True,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _columns, _where in reversed(HOT_PATH_INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                schema=SCHEMA,
+                if_exists=True,
+                postgresql_concurrently=True,
+            )
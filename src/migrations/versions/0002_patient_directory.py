@@ -0,0 +1,60 @@
+"""Directorio documento -> paciente -> shard
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+
+Tabla de la BD principal que usa app.database.sharding para ubicar el shard
+de cada paciente. Se llena con `python -m app.database.shard_rebalance backfill`.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SCHEMA = "smart_health"
+
+
+def upgrade() -> None:
+    # En desarrollo create_all puede haberla creado al arrancar la app
+    if sa.inspect(op.get_bind()).has_table("patient_directory", schema=SCHEMA):
+        return
+
+    op.create_table(
+        "patient_directory",
+        sa.Column("document_type_id", sa.Integer(), nullable=False),
+        sa.Column("document_number", sa.String(length=50), nullable=False),
+        sa.Column("patient_id", sa.Integer(), nullable=False),
+        sa.Column("shard_name", sa.String(length=64), nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("document_type_id", "document_number"),
+        schema=SCHEMA,
+    )
+    op.create_index(
+        "ix_smart_health_patient_directory_patient_id",
+        "patient_directory",
+        ["patient_id"],
+        unique=True,
+        schema=SCHEMA,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_smart_health_patient_directory_patient_id",
+        table_name="patient_directory",
+        schema=SCHEMA,
+    )
+    op.drop_table("patient_directory", schema=SCHEMA)
@@ -0,0 +1,280 @@
+"""Particionar appointments, medical_records y prescriptions por año
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+
+Convierte las tablas clínicas que crecen sin fin en tablas particionadas por
+rango de fecha (una partición por año + DEFAULT). Copia todas las filas bajo
+lock exclusivo: aplicar en ventana de mantenimiento. Ver
+app.database.partitioning para el mantenimiento (ensure / archive).
+
+La PK de medical_records pasa a ser (medical_record_id, registration_datetime)
+y una FK ya no puede apuntar solo a medical_record_id. Las FK de
+prescriptions y record_diagnoses se reemplazan por triggers con la misma
+semántica (NO ACTION): el hijo toma FOR KEY SHARE sobre el registro padre y
+borrar un registro con hijos falla con foreign_key_violation.
+
+El DDL queda congelado en esta migración (no importa código de la app): el
+esquema que produce no cambia si cambia app.database.partitioning.
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SCHEMA = "smart_health"
+
+# Particiones de años futuros que se crean al convertir
+YEARS_AHEAD = 1
+
+# (tabla, columna de fecha, columna id)
+PARTITIONED_TABLES = [
+    ("appointments", "appointment_date", "appointment_id"),
+    ("medical_records", "registration_datetime", "medical_record_id"),
+    ("prescriptions", "prescription_date", "prescription_id"),
+]
+
+# FK hacia medical_records que se reemplazan por triggers (el downgrade las restaura)
+REPLACED_FOREIGN_KEYS = [
+    ("prescriptions", "prescriptions_medical_record_id_fkey"),
+    ("record_diagnoses", "record_diagnoses_medical_record_id_fkey"),
+]
+
+REFERENCE_CHECK_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION {SCHEMA}.medical_record_reference_check() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.medical_record_id IS NULL THEN
+        RETURN NEW;
+    END IF;
+    -- El mismo lock que toma una FK sobre la fila referenciada
+    PERFORM 1 FROM {SCHEMA}.medical_records
+    WHERE medical_record_id = NEW.medical_record_id
+    FOR KEY SHARE;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'insert or update on table "%" violates reference to "medical_records"', TG_TABLE_NAME
+            USING ERRCODE = 'foreign_key_violation',
+                  DETAIL = format('Key (medical_record_id)=(%s) is not present in table "medical_records".',
+                                  NEW.medical_record_id);
+    END IF;
+    RETURN NEW;
+END
+$$
+"""
+
+RESTRICT_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION {SCHEMA}.medical_record_restrict() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND NEW.medical_record_id = OLD.medical_record_id THEN
+        RETURN NULL;
+    END IF;
+    -- Cambiar la fecha mueve la fila a otra partición (DELETE + INSERT)
+    IF EXISTS (SELECT 1 FROM {SCHEMA}.medical_records WHERE medical_record_id = OLD.medical_record_id) THEN
+        RETURN NULL;
+    END IF;
+    IF EXISTS (SELECT 1 FROM {SCHEMA}.prescriptions WHERE medical_record_id = OLD.medical_record_id)
+       OR EXISTS (SELECT 1 FROM {SCHEMA}.record_diagnoses WHERE medical_record_id = OLD.medical_record_id) THEN
+        RAISE EXCEPTION 'update or delete on table "medical_records" violates reference from prescriptions/record_diagnoses'
+            USING ERRCODE = 'foreign_key_violation',
+                  DETAIL = format('Key (medical_record_id)=(%s) is still referenced.', OLD.medical_record_id);
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# (nombre, tabla, momento y eventos, función)
+TRIGGERS = [
+    ("prescriptions_medical_record_check", "prescriptions",
+     "BEFORE INSERT OR UPDATE OF medical_record_id", "medical_record_reference_check"),
+    ("record_diagnoses_medical_record_check", "record_diagnoses",
+     "BEFORE INSERT OR UPDATE OF medical_record_id", "medical_record_reference_check"),
+    ("medical_records_restrict_references", "medical_records",
+     "AFTER DELETE OR UPDATE OF medical_record_id", "medical_record_restrict"),
+]
+
+
+# ============================================================================
+# Conversión
+# ============================================================================
+
+def _is_partitioned(conn, table: str) -> bool:
+    return bool(conn.execute(sa.text("""
+        SELECT 1
+        FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relname = :table
+    """), {"schema": SCHEMA, "table": table}).first())
+
+
+def _indexes(conn, qualified: str, date_column: str) -> list:
+    """Índices de la tabla, salvo la clave primaria (se recrea aparte)."""
+    return conn.execute(sa.text("""
+        SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition, ix.indisunique AS is_unique,
+               EXISTS (
+                   SELECT 1 FROM pg_attribute a
+                   WHERE a.attrelid = ix.indrelid AND a.attname = :date_column
+                     AND a.attnum = ANY ((ix.indkey::int2[])[0:ix.indnkeyatts - 1])
+               ) AS has_date_column
+        FROM pg_index ix
+        JOIN pg_class i ON i.oid = ix.indexrelid
+        WHERE ix.indrelid = CAST(:qualified AS regclass)
+          AND NOT ix.indisprimary
+    """), {"qualified": qualified, "date_column": date_column}).fetchall()
+
+
+def _outgoing_foreign_keys(conn, qualified: str) -> list:
+    return conn.execute(sa.text("""
+        SELECT conname AS name, pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint
+        WHERE conrelid = CAST(:qualified AS regclass) AND contype = 'f'
+    """), {"qualified": qualified}).fetchall()
+
+
+def _incoming_foreign_keys(conn, qualified: str) -> list:
+    return conn.execute(sa.text("""
+        SELECT conrelid::regclass::text AS referencing, conname AS name
+        FROM pg_constraint
+        WHERE confrelid = CAST(:qualified AS regclass) AND contype = 'f'
+          AND conrelid <> confrelid
+    """), {"qualified": qualified}).fetchall()
+
+
+def _owned_sequences(conn, qualified: str) -> list:
+    return conn.execute(sa.text("""
+        SELECT a.attname AS column_name, s.oid::regclass::text AS sequence
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.refobjid = CAST(:qualified AS regclass) AND d.deptype IN ('a', 'i')
+    """), {"qualified": qualified}).fetchall()
+
+
+def _check_convertible(conn, table: str, date_column: str) -> None:
+    qualified = f"{SCHEMA}.{table}"
+    incoming = _incoming_foreign_keys(conn, qualified)
+    if incoming:
+        names = ", ".join(f"{fk.name} ({fk.referencing})" for fk in incoming)
+        raise RuntimeError(f"{qualified} es referenciada por FK no previstas en la migración: {names}")
+
+    # Un índice único sin la columna de partición no se puede crear en la
+    # tabla particionada; agregarle la fecha cambiaría lo que garantiza
+    unique = [index.name for index in _indexes(conn, qualified, date_column)
+              if index.is_unique and not index.has_date_column]
+    if unique:
+        raise RuntimeError(
+            f"{qualified} tiene índices únicos sin {date_column}: {', '.join(unique)}. "
+            f"Redefinirlos (o reemplazarlos) antes de particionar"
+        )
+
+    nulls = conn.execute(sa.text(
+        f"SELECT COUNT(*) FROM {qualified} WHERE {date_column} IS NULL"
+    )).scalar()
+    if nulls:
+        raise RuntimeError(
+            f"{qualified} tiene {nulls} filas con {date_column} NULL; "
+            f"completarlas antes de particionar (la columna pasa a ser parte de la clave primaria)"
+        )
+
+
+def _rebuild(conn, table: str, date_column: str, key_column: str, partitioned: bool) -> None:
+    """Reemplaza la tabla por una (no) particionada con los mismos datos, índices, defaults y FK salientes."""
+    qualified = f"{SCHEMA}.{table}"
+    legacy = f"{table}_legacy"
+
+    indexes = _indexes(conn, qualified, date_column)
+    foreign_keys = _outgoing_foreign_keys(conn, qualified)
+    sequences = _owned_sequences(conn, qualified)
+
+    conn.execute(sa.text(f"ALTER TABLE {qualified} RENAME TO {legacy}"))
+
+    partition_clause = f" PARTITION BY RANGE ({date_column})" if partitioned else ""
+    conn.execute(sa.text(
+        f"CREATE TABLE {qualified} (LIKE {SCHEMA}.{legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+        f"INCLUDING STORAGE INCLUDING COMMENTS){partition_clause}"
+    ))
+
+    if partitioned:
+        first_year, last_year = conn.execute(sa.text(
+            f"SELECT EXTRACT(YEAR FROM MIN({date_column}))::int, "
+            f"EXTRACT(YEAR FROM MAX({date_column}))::int FROM {SCHEMA}.{legacy}"
+        )).one()
+        current_year = date.today().year
+        first_year = first_year or current_year
+        last_year = max(last_year or current_year, current_year) + YEARS_AHEAD
+        for year in range(first_year, last_year + 1):
+            conn.execute(sa.text(
+                f"CREATE TABLE {qualified}_y{year} PARTITION OF {qualified} "
+                f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+            ))
+        conn.execute(sa.text(f"CREATE TABLE {qualified}_default PARTITION OF {qualified} DEFAULT"))
+
+    conn.execute(sa.text(f"INSERT INTO {qualified} SELECT * FROM {SCHEMA}.{legacy}"))
+
+    # Las secuencias de los serial deben sobrevivir al DROP de la tabla vieja
+    for column, sequence in sequences:
+        conn.execute(sa.text(f"ALTER SEQUENCE {sequence} OWNED BY {qualified}.{column}"))
+
+    conn.execute(sa.text(f"DROP TABLE {SCHEMA}.{legacy}"))
+
+    primary_key = f"{key_column}, {date_column}" if partitioned else key_column
+    conn.execute(sa.text(f"ALTER TABLE {qualified} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({primary_key})"))
+
+    for index in indexes:
+        conn.execute(sa.text(index.definition.replace(" ON ONLY ", " ON ")))
+
+    for foreign_key in foreign_keys:
+        conn.execute(sa.text(f"ALTER TABLE {qualified} ADD CONSTRAINT {foreign_key.name} {foreign_key.definition}"))
+
+    conn.execute(sa.text(f"ANALYZE {qualified}"))
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+
+    for table, name in REPLACED_FOREIGN_KEYS:
+        op.execute(f"ALTER TABLE {SCHEMA}.{table} DROP CONSTRAINT IF EXISTS {name}")
+
+    for table, date_column, key_column in PARTITIONED_TABLES:
+        if _is_partitioned(conn, table):
+            continue
+        _check_convertible(conn, table, date_column)
+        _rebuild(conn, table, date_column, key_column, partitioned=True)
+
+    op.execute(REFERENCE_CHECK_FUNCTION)
+    op.execute(RESTRICT_FUNCTION)
+    for name, table, events, function in TRIGGERS:
+        op.execute(
+            f"CREATE TRIGGER {name} {events} ON {SCHEMA}.{table} "
+            f"FOR EACH ROW EXECUTE FUNCTION {SCHEMA}.{function}()"
+        )
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+
+    for name, table, _, _ in TRIGGERS:
+        op.execute(f"DROP TRIGGER IF EXISTS {name} ON {SCHEMA}.{table}")
+    op.execute(f"DROP FUNCTION IF EXISTS {SCHEMA}.medical_record_reference_check()")
+    op.execute(f"DROP FUNCTION IF EXISTS {SCHEMA}.medical_record_restrict()")
+
+    for table, date_column, key_column in reversed(PARTITIONED_TABLES):
+        if _is_partitioned(conn, table):
+            _rebuild(conn, table, date_column, key_column, partitioned=False)
+
+    for table, name in REPLACED_FOREIGN_KEYS:
+        op.execute(
+            f"ALTER TABLE {SCHEMA}.{table} ADD CONSTRAINT {name} "
+            f"FOREIGN KEY (medical_record_id) REFERENCES {SCHEMA}.medical_records (medical_record_id) NOT VALID"
+        )
@@ -0,0 +1,53 @@
+"""Resúmenes clínicos longitudinales por paciente
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+
+Tabla que mantiene app.services.patient_summary: un resumen por año y por
+condición de cada paciente, con la última fila incorporada de cada tabla
+clínica. Se llena con `python -m app.services.patient_summary run`.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SCHEMA = "smart_health"
+
+
+def upgrade() -> None:
+    # En desarrollo create_all puede haberla creado al arrancar la app
+    if sa.inspect(op.get_bind()).has_table("patient_summaries", schema=SCHEMA):
+        return
+
+    op.create_table(
+        "patient_summaries",
+        sa.Column("patient_id", sa.Integer(), nullable=False),
+        sa.Column("summary", postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column("last_appointment_id", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_medical_record_id", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_prescription_id", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_record_diagnosis_id", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("backend", sa.String(length=32), nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("patient_id"),
+        schema=SCHEMA,
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("patient_summaries", schema=SCHEMA)
@@ -0,0 +1,254 @@
+"""
+SmartHealth - Cache de Respuestas
+=================================
+Ejecutar: python test_answer_cache.py
+
+No requiere OpenAI ni base de datos: los embeddings son vectores de prueba
+con la similitud coseno que se quiere simular.
+
+Verifica:
+1. Cache exacto: la pregunta se normaliza (mayúsculas, espacios, signos) y
+   la respuesta guardada es una copia
+2. Un chart_version nuevo del paciente invalida sus respuestas; otro prompt
+   u otro formato de contexto no reutilizan la respuesta
+3. TTL y límite de entradas (LRU)
+4. Cache semántico: una pregunta reformulada con la misma firma reutiliza la
+   respuesta si la similitud alcanza el umbral configurado
+5. Preguntas casi iguales que piden otra cosa (otro número, otra fecha, otro
+   momento o una negación) no reutilizan la respuesta aunque sus embeddings
+   sean casi idénticos
+6. Una similitud que antes alcanzaba el umbral (0.93) ya no alcanza
+7. Una respuesta generada con otro nivel de modelo (fast / complex) no se
+   reutiliza
+"""
+
+import math
+import sys
+import time
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from app.database.db_config import settings
+from app.services.answer_cache import AnswerCache, SemanticAnswerCache, question_signature
+
+SCOPE = (1, "chart-v1", "prompt-v1", "markdown", 3000)
+TIER = "standard"
+
+# (pregunta guardada, pregunta nueva): embeddings casi idénticos, datos distintos
+NEAR_MISSES = [
+    ("¿Qué dosis de metformina de 500 mg toma?", "¿Qué dosis de metformina de 850 mg toma?"),
+    ("¿Tiene alergias a medicamentos?", "¿No tiene alergias a medicamentos?"),
+    ("¿Qué le recetaron en marzo?", "¿Qué le recetaron en abril?"),
+    ("¿Qué diagnósticos tuvo en 2023?", "¿Qué diagnósticos tuvo en 2024?"),
+    ("¿Cuál fue su última cita?", "¿Cuál es su próxima cita?"),
+    ("¿Toma dos medicamentos para la tensión?", "¿Toma tres medicamentos para la tensión?"),
+    ("¿Ha tenido alguna hospitalización?", "¿Nunca ha tenido hospitalizaciones?"),
+    ("¿Qué resultados tuvo el 12/03/2024?", "¿Qué resultados tuvo el 13/03/2024?"),
+]
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# UTILIDADES
+# ============================================================
+
+def embedding_with_similarity(similarity: float) -> list:
+    """Vector con la similitud coseno dada respecto de BASE."""
+    return [similarity, math.sqrt(1 - similarity ** 2), 0.0]
+
+
+BASE = [1.0, 0.0, 0.0]
+
+
+def new_semantic_cache() -> SemanticAnswerCache:
+    return SemanticAnswerCache(
+        max_patients=10, entries_per_patient=20,
+        threshold=settings.semantic_answer_cache_threshold, ttl_seconds=3600
+    )
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def test_exact_normalized_hit() -> bool:
+    print_test("Cache exacto: pregunta normalizada")
+    cache = AnswerCache(max_entries=10, ttl_seconds=3600)
+    cache.put(AnswerCache.key(1, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1"), {"answer": {"text": "Metformina"}})
+
+    payload = cache.get(AnswerCache.key(1, "chart-v1", "  qué medicamentos   TOMA ", "prompt-v1"))
+    ok = payload == {"answer": {"text": "Metformina"}}
+    if ok:
+        payload["answer"]["text"] = "modificada"
+        again = cache.get(AnswerCache.key(1, "chart-v1", "qué medicamentos toma", "prompt-v1"))
+        ok = again == {"answer": {"text": "Metformina"}}
+    if ok and cache.stats()["hits"] == 2:
+        print_pass("Misma respuesta sin distinguir mayúsculas, espacios ni signos; copia independiente")
+        return True
+    print_fail(f"payload={payload}, stats={cache.stats()}")
+    return False
+
+
+def test_exact_chart_version_invalidation() -> bool:
+    print_test("Cache exacto: invalidación por versión de la historia")
+    cache = AnswerCache(max_entries=10, ttl_seconds=3600)
+    cache.put(AnswerCache.key(1, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1"), {"answer": "v1"})
+    cache.put(AnswerCache.key(1, "chart-v1", "¿Qué diagnósticos tiene?", "prompt-v1"), {"answer": "v1"})
+    cache.put(AnswerCache.key(2, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1"), {"answer": "otro paciente"})
+
+    new_version = cache.get(AnswerCache.key(1, "chart-v2", "¿Qué medicamentos toma?", "prompt-v1"))
+    old_version = cache.get(AnswerCache.key(1, "chart-v1", "¿Qué diagnósticos tiene?", "prompt-v1"))
+    other_prompt = cache.get(AnswerCache.key(2, "chart-v1", "¿Qué medicamentos toma?", "prompt-v2"))
+    other_patient = cache.get(AnswerCache.key(2, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1"))
+
+    original_format = settings.rag_context_format
+    settings.rag_context_format = "otro-formato"
+    try:
+        other_format = cache.get(AnswerCache.key(2, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1"))
+    finally:
+        settings.rag_context_format = original_format
+
+    stats = cache.stats()
+    ok = (
+        new_version is None and old_version is None and other_prompt is None and other_format is None
+        and other_patient == {"answer": "otro paciente"}
+        and stats["invalidations"] == 1 and stats["entries"] == 1
+    )
+    if ok:
+        print_pass("chart_version nuevo descartó las 2 respuestas del paciente; prompt y formato son parte de la clave")
+    else:
+        print_fail(f"stats={stats}, otro paciente={other_patient}")
+    return ok
+
+
+def test_exact_ttl_and_lru() -> bool:
+    print_test("Cache exacto: TTL y LRU")
+    cache = AnswerCache(max_entries=10, ttl_seconds=0.05)
+    key = AnswerCache.key(1, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1")
+    cache.put(key, {"answer": "vieja"})
+    time.sleep(0.1)
+    expired = cache.get(key) is None
+
+    cache = AnswerCache(max_entries=2, ttl_seconds=3600)
+    keys = [AnswerCache.key(patient_id, "chart-v1", "¿Qué medicamentos toma?", "prompt-v1") for patient_id in (1, 2, 3)]
+    cache.put(keys[0], {"answer": 1})
+    cache.put(keys[1], {"answer": 2})
+    cache.get(keys[0])
+    cache.put(keys[2], {"answer": 3})
+    survivors = [cache.get(key) is not None for key in keys]
+
+    if expired and survivors == [True, False, True]:
+        print_pass("Entrada vencida descartada; con el límite lleno sale la menos usada")
+        return True
+    print_fail(f"vencida={expired}, sobrevivientes={survivors}")
+    return False
+
+
+def test_semantic_paraphrase_hits() -> bool:
+    print_test("Cache semántico: pregunta reformulada")
+    cache = new_semantic_cache()
+    cache.put(SCOPE, "¿Qué medicamentos toma?", BASE, {"answer": {"text": "Metformina"}}, TIER)
+    match = cache.lookup(SCOPE, "Lista de medicamentos que toma el paciente", embedding_with_similarity(0.99), TIER)
+    if match.payload == {"answer": {"text": "Metformina"}}:
+        print_pass(f"Misma firma y similitud {match.similarity:.2f}: respuesta reutilizada")
+        return True
+    print_fail(f"Sin respuesta (similitud {match.similarity})")
+    return False
+
+
+def test_semantic_near_misses() -> bool:
+    print_test("Cache semántico: preguntas casi iguales con otros datos")
+    hits = []
+    for stored, asked in NEAR_MISSES:
+        cache = new_semantic_cache()
+        cache.put(SCOPE, stored, BASE, {"answer": {"text": stored}}, TIER)
+        match = cache.lookup(SCOPE, asked, embedding_with_similarity(0.995), TIER)
+        if match.payload is not None:
+            hits.append((asked, question_signature(stored), question_signature(asked)))
+    if not hits:
+        print_pass(f"{len(NEAR_MISSES)} pares con similitud 0.995 sin reutilizar la respuesta")
+        return True
+    for asked, stored_signature, asked_signature in hits:
+        print_fail(f"{asked!r} reutilizó la respuesta ({stored_signature} / {asked_signature})")
+    return False
+
+
+def test_semantic_threshold() -> bool:
+    print_test("Cache semántico: umbral por defecto")
+    cache = new_semantic_cache()
+    cache.put(SCOPE, "¿Qué medicamentos toma?", BASE, {"answer": {"text": "Metformina"}}, TIER)
+    match = cache.lookup(SCOPE, "¿Qué medicinas toma?", embedding_with_similarity(0.93), TIER)
+    if settings.semantic_answer_cache_threshold >= 0.95 and match.payload is None:
+        print_pass(f"Umbral {settings.semantic_answer_cache_threshold}: similitud 0.93 no reutiliza la respuesta")
+        return True
+    print_fail(f"Umbral {settings.semantic_answer_cache_threshold}, respuesta: {match.payload}")
+    return False
+
+
+def test_semantic_other_tier() -> bool:
+    print_test("Cache semántico: otro nivel de modelo")
+    cache = new_semantic_cache()
+    cache.put(SCOPE, "¿Cuál es su última cita?", BASE, {"answer": {"text": "corta"}}, "fast")
+    other_tier = cache.lookup(SCOPE, "¿Cuándo fue su última cita?", embedding_with_similarity(0.99), "complex")
+    same_tier = cache.lookup(SCOPE, "¿Cuándo fue su última cita?", embedding_with_similarity(0.99), "fast")
+    if other_tier.payload is None and same_tier.payload == {"answer": {"text": "corta"}}:
+        print_pass("Respuesta de fast no servida a complex; sí a otra pregunta de fast")
+        return True
+    print_fail(f"complex={other_tier.payload}, fast={same_tier.payload}")
+    return False
+
+
+def run_tests() -> list:
+    return [
+        test_exact_normalized_hit(),
+        test_exact_chart_version_invalidation(),
+        test_exact_ttl_and_lru(),
+        test_semantic_paraphrase_hits(),
+        test_semantic_near_misses(),
+        test_semantic_threshold(),
+        test_semantic_other_tier(),
+    ]
+
+
+def main() -> int:
+    results = run_tests()
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
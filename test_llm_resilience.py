@@ -0,0 +1,505 @@
+"""
+SmartHealth - Resiliencia de las Llamadas al LLM
+================================================
+Ejecutar: python test_llm_resilience.py
+
+No requiere OpenAI ni base de datos: el cliente del gateway se reemplaza por
+uno falso que simula latencias y errores del proveedor.
+
+Verifica:
+1. Hedging: si el primer intento se demora, gana el segundo y el primero se cancela
+2. Streaming: el hedge cubre hasta el primer chunk y el stream perdedor se cierra
+3. Errores transitorios (5xx, conexión) se reintentan con backoff
+4. Errores no transitorios (400) no se reintentan ni abren el breaker
+5. Circuit breaker: se abre tras N fallos, falla al instante y se cierra
+   cuando la prueba en half_open sale bien
+6. Control de admisión: límite de concurrencia, cola acotada, rechazo
+   inmediato por deadline y espera por el presupuesto de tokens/minuto
+7. Backends: LLM_BACKENDS se interpreta con prioridad y peso, una llamada
+   pasa al siguiente backend si el primero falla y los embeddings solo van
+   a backends con el mismo modelo de embeddings
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace as NS
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+import httpx
+import openai
+
+from app.database.db_config import settings
+from app.services.llm_admission import AdmissionController, LLMAdmissionError
+from app.services.llm_gateway import LLMBackend, LLMGateway, LLMUnavailableError, build_backends
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+MESSAGES = [{"role": "user", "content": "¿Qué medicamentos toma el paciente?"}]
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# PROVEEDOR FALSO
+# ============================================================
+
+def server_error() -> openai.APIStatusError:
+    return openai.InternalServerError(
+        "falla simulada", response=httpx.Response(503, request=REQUEST), body=None
+    )
+
+
+def bad_request() -> openai.APIStatusError:
+    return openai.BadRequestError(
+        "solicitud inválida", response=httpx.Response(400, request=REQUEST), body=None
+    )
+
+
+class FakeStream:
+    """Imita AsyncStream del SDK: chunks con demora y close()."""
+
+    def __init__(self, text: str, first_delay: float):
+        self.text = text
+        self.first_delay = first_delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        await asyncio.sleep(self.first_delay)
+        for word in self.text.split():
+            yield NS(choices=[NS(delta=NS(content=word + " "))], usage=None)
+        yield NS(choices=[], usage=NS(completion_tokens=len(self.text.split())))
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeProvider:
+    """
+    Cliente falso: cada llamada toma el siguiente comportamiento del guion
+    (segundos de demora o una excepción); sin guion responde al instante.
+    """
+
+    def __init__(self, script=None):
+        self.script = list(script or [])
+        self.calls = 0
+        self.cancelled = 0
+        self.streams = []
+        self.chat = NS(completions=NS(create=self.create))
+        self.embeddings = NS(create=self.embed)
+
+    def _next(self):
+        self.calls += 1
+        return self.script.pop(0) if self.script else 0.0
+
+    async def create(self, **params):
+        behavior = self._next()
+        if isinstance(behavior, Exception):
+            raise behavior
+        if params.get("stream"):
+            # La demora se aplica al primer chunk (como la latencia del modelo)
+            stream = FakeStream(f"respuesta {self.calls} con metformina", behavior)
+            self.streams.append(stream)
+            return stream
+        try:
+            await asyncio.sleep(behavior)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return NS(
+            choices=[NS(message=NS(content=f"respuesta {self.calls}"))],
+            usage=NS(completion_tokens=2, total_tokens=10),
+            model="fake"
+        )
+
+    async def embed(self, **params):
+        behavior = self._next()
+        if isinstance(behavior, Exception):
+            raise behavior
+        return NS(data=[NS(embedding=[float(self.calls)])])
+
+
+def new_gateway(provider: FakeProvider, *fallbacks: FakeProvider, **overrides) -> LLMGateway:
+    values = {
+        "llm_hedge_enabled": True,
+        "llm_hedge_default_delay_seconds": 0.1,
+        "llm_hedge_min_delay_seconds": 0.05,
+        "llm_max_attempts": 3,
+        "llm_backoff_base_seconds": 0.01,
+        "llm_backoff_max_seconds": 0.05,
+        "llm_breaker_failure_threshold": 3,
+        "llm_breaker_reset_seconds": 0.3,
+    }
+    values.update(overrides)
+    for name, value in values.items():
+        setattr(settings, name, value)
+
+    # Un backend por proveedor falso, en orden de prioridad
+    backends = [LLMBackend(f"fake{i}", priority=i) for i in range(1 + len(fallbacks))]
+    for backend, fake in zip(backends, (provider,) + fallbacks):
+        backend._client = fake
+    return LLMGateway(backends)
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+async def test_hedge_wins() -> bool:
+    print_test("Hedging de una completion lenta")
+    provider = FakeProvider([2.0, 0.0])
+    gateway = new_gateway(provider)
+
+    started = time.perf_counter()
+    result = await gateway.chat(MESSAGES)
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0)
+
+    ok = True
+    if result.text == "respuesta 2" and elapsed < 1.0:
+        print_pass(f"Respondió el hedge en {elapsed * 1000:.0f} ms (el primero tardaba 2000 ms)")
+    else:
+        print_fail(f"Respuesta '{result.text}' en {elapsed * 1000:.0f} ms")
+        ok = False
+    if provider.cancelled == 1 and gateway.metrics["hedges_won"] == 1:
+        print_pass("El intento lento se canceló")
+    else:
+        print_fail(f"Cancelados: {provider.cancelled}, métricas: {gateway.metrics}")
+        ok = False
+    return ok
+
+
+async def test_hedge_stream() -> bool:
+    print_test("Hedging del primer chunk en streaming")
+    provider = FakeProvider([2.0, 0.0])
+    gateway = new_gateway(provider)
+
+    started = time.perf_counter()
+    chunks = await gateway.chat_stream(MESSAGES)
+    first_chunk_ms = (time.perf_counter() - started) * 1000
+    text = ""
+    async for chunk in chunks:
+        if chunk.choices:
+            text += chunk.choices[0].delta.content
+    await asyncio.sleep(0)
+
+    ok = True
+    if text.startswith("respuesta 2") and first_chunk_ms < 1000:
+        print_pass(f"Primer chunk del hedge en {first_chunk_ms:.0f} ms")
+    else:
+        print_fail(f"Texto '{text}' con primer chunk en {first_chunk_ms:.0f} ms")
+        ok = False
+    if all(stream.closed for stream in provider.streams):
+        print_pass("Los dos streams quedaron cerrados (perdedor y ganador)")
+    else:
+        print_fail(f"Streams cerrados: {[s.closed for s in provider.streams]}")
+        ok = False
+    return ok
+
+
+async def test_transient_retry() -> bool:
+    print_test("Reintento de errores transitorios")
+    provider = FakeProvider([server_error(), openai.APIConnectionError(request=REQUEST), 0.0])
+    gateway = new_gateway(provider)
+
+    try:
+        result = await gateway.chat(MESSAGES)
+    except Exception as e:
+        print_fail(f"No se recuperó: {type(e).__name__}")
+        return False
+
+    if result.text == "respuesta 3" and gateway.metrics["retries"] == 2 and gateway.backends[0].breaker.state == "closed":
+        print_pass("503 y error de conexión reintentados; el tercer intento respondió")
+        return True
+    print_fail(f"Respuesta '{result.text}', métricas: {gateway.metrics}")
+    return False
+
+
+async def test_non_transient_not_retried() -> bool:
+    print_test("Errores no transitorios")
+    provider = FakeProvider([bad_request()])
+    gateway = new_gateway(provider)
+
+    try:
+        await gateway.chat(MESSAGES)
+        print_fail("Se esperaba BadRequestError")
+        return False
+    except openai.BadRequestError:
+        pass
+
+    if provider.calls == 1 and gateway.backends[0].breaker.consecutive_failures == 0:
+        print_pass("El 400 se propagó sin reintentos y sin contar para el breaker")
+        return True
+    print_fail(f"Llamadas: {provider.calls}, fallos del breaker: {gateway.backends[0].breaker.consecutive_failures}")
+    return False
+
+
+async def test_circuit_breaker() -> bool:
+    print_test("Circuit breaker")
+    provider = FakeProvider([server_error() for _ in range(3)])
+    gateway = new_gateway(provider, llm_hedge_enabled=False)
+
+    ok = True
+    try:
+        await gateway.chat(MESSAGES)
+        print_fail("Se esperaba un error del proveedor")
+        return False
+    except openai.APIStatusError:
+        pass
+    if gateway.backends[0].breaker.state == "open":
+        print_pass(f"Abierto tras {provider.calls} fallos seguidos")
+    else:
+        print_fail(f"Estado {gateway.backends[0].breaker.state} tras {provider.calls} fallos")
+        ok = False
+
+    calls_before = provider.calls
+    started = time.perf_counter()
+    try:
+        await gateway.chat(MESSAGES)
+        print_fail("Con el breaker abierto la llamada debía fallar")
+        ok = False
+    except LLMUnavailableError:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if provider.calls == calls_before:
+            print_pass(f"Falla al instante sin llamar al proveedor ({elapsed_ms:.1f} ms)")
+        else:
+            print_fail("Con el breaker abierto se llamó al proveedor")
+            ok = False
+
+    await asyncio.sleep(settings.llm_breaker_reset_seconds + 0.05)
+    try:
+        result = await gateway.chat(MESSAGES)
+        if gateway.backends[0].breaker.state == "closed":
+            print_pass(f"La prueba en half_open respondió ('{result.text}') y el breaker se cerró")
+        else:
+            print_fail(f"Estado {gateway.backends[0].breaker.state} tras una prueba exitosa")
+            ok = False
+    except Exception as e:
+        print_fail(f"La prueba en half_open falló: {type(e).__name__}")
+        ok = False
+
+    print_info(f"Métricas: {gateway.status()}")
+    return ok
+
+
+async def test_admission_concurrency() -> bool:
+    print_test("Admisión: concurrencia y cola acotada")
+    controller = AdmissionController(
+        max_concurrency=2, tokens_per_minute=0, queue_size=1, min_service_seconds=0.05
+    )
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with controller.admit(100):
+            peak = max(peak, controller.active)
+            await asyncio.sleep(0.1)
+
+    first = [asyncio.ensure_future(call()) for _ in range(3)]
+    await asyncio.sleep(0.01)
+
+    ok = True
+    try:
+        await controller.acquire(100)
+        print_fail("Con la cola llena se esperaba un rechazo")
+        ok = False
+    except LLMAdmissionError as e:
+        if e.reason == "queue_full":
+            print_pass(f"Cola llena: rechazo inmediato ({e})")
+        else:
+            print_fail(f"Motivo inesperado: {e.reason}")
+            ok = False
+
+    await asyncio.gather(*first)
+    if peak == 2 and controller.active == 0 and controller.metrics["queued"] == 1:
+        print_pass("Nunca hubo más de 2 llamadas simultáneas; la tercera esperó su turno")
+    else:
+        print_fail(f"Pico {peak}, estado {controller.status()}")
+        ok = False
+    return ok
+
+
+async def test_admission_deadline() -> bool:
+    print_test("Admisión: deadline y presupuesto de tokens")
+    loop = asyncio.get_running_loop()
+    controller = AdmissionController(
+        max_concurrency=1, tokens_per_minute=1000, queue_size=10, min_service_seconds=0.2
+    )
+    ok = True
+
+    holder = await controller.acquire(100)
+    started = time.perf_counter()
+    try:
+        await controller.acquire(100, deadline=loop.time() + 0.1)
+        print_fail("Sin tiempo para completar la llamada se esperaba un rechazo")
+        ok = False
+    except LLMAdmissionError as e:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if e.reason == "deadline" and elapsed_ms < 50:
+            print_pass(f"Rechazo inmediato por deadline ({elapsed_ms:.1f} ms)")
+        else:
+            print_fail(f"Motivo {e.reason} tras {elapsed_ms:.0f} ms")
+            ok = False
+
+    started = time.perf_counter()
+    try:
+        await controller.acquire(100, deadline=loop.time() + 0.5)
+        print_fail("Sin turno antes del deadline se esperaba un rechazo")
+        ok = False
+    except LLMAdmissionError as e:
+        elapsed = time.perf_counter() - started
+        if e.reason == "deadline" and 0.25 < elapsed < 0.45:
+            print_pass(f"Esperó el turno hasta deadline - servicio mínimo ({elapsed * 1000:.0f} ms)")
+        else:
+            print_fail(f"Motivo {e.reason} tras {elapsed * 1000:.0f} ms")
+            ok = False
+    holder.release()
+    await asyncio.sleep(0)
+
+    # El presupuesto (1000 tokens/min) ya tiene 100 reservados: 950 no entran
+    # hasta que la reserva salga de la ventana de 60 s
+    try:
+        await controller.acquire(950, deadline=loop.time() + 5)
+        print_fail("Sin presupuesto de tokens se esperaba un rechazo")
+        ok = False
+    except LLMAdmissionError as e:
+        if e.reason == "token_budget":
+            print_pass("Rechazo inmediato: el presupuesto de tokens no se libera a tiempo")
+        else:
+            print_fail(f"Motivo inesperado: {e.reason}")
+            ok = False
+
+    ticket = await controller.acquire(800, deadline=loop.time() + 5)
+    ticket.release()
+    if controller.status()["tokens_in_window"] == 900:
+        print_pass("Una solicitud que cabe en el presupuesto se admite de inmediato")
+    else:
+        print_fail(f"Estado {controller.status()}")
+        ok = False
+
+    print_info(f"Métricas: {controller.status()}")
+    return ok
+
+
+async def test_backend_fallback() -> bool:
+    print_test("Cambio de backend y LLM_BACKENDS")
+    ok = True
+
+    backends = build_backends(
+        "onprem=http://10.0.0.5:8000/v1;model=qwen2.5-7b-instruct;timeout=20;weight=3,"
+        "onprem2=http://10.0.0.6:8000/v1;priority=0, openai="
+    )
+    parsed = [(b.name, b.base_url, b.model, b.timeout, b.priority, b.weight) for b in backends]
+    expected = [
+        ("onprem", "http://10.0.0.5:8000/v1", "qwen2.5-7b-instruct", 20.0, 0, 3.0),
+        ("onprem2", "http://10.0.0.6:8000/v1", None, float(settings.llm_timeout), 0, 1.0),
+        ("openai", None, None, float(settings.llm_timeout), 2, 1.0),
+    ]
+    try:
+        build_backends("onprem=http://10.0.0.5:8000/v1;modelo=x")
+        rejected = False
+    except ValueError:
+        rejected = True
+    if parsed == expected and rejected:
+        print_pass("LLM_BACKENDS: URL, modelo, timeout, prioridad y peso; opciones desconocidas rechazadas")
+    else:
+        print_fail(f"Backends {parsed}, opción inválida rechazada: {rejected}")
+        ok = False
+
+    firsts = [LLMGateway(backends)._candidates("chat")[0].name for _ in range(2000)]
+    share = firsts.count("onprem") / len(firsts)
+    if 0.68 < share < 0.82 and all(name != "openai" for name in firsts):
+        print_pass(f"Con igual prioridad y pesos 3:1 el primero es onprem el {share:.0%} de las veces")
+    else:
+        print_fail(f"onprem primero el {share:.0%} de las veces")
+        ok = False
+
+    primary = FakeProvider([server_error(), server_error(), server_error()])
+    secondary = FakeProvider()
+    gateway = new_gateway(primary, secondary, llm_hedge_enabled=False)
+    result = await gateway.chat(MESSAGES)
+    if result.backend == "fake1" and gateway.metrics["backend_fallbacks"] == 1:
+        print_pass(f"Tras {primary.calls} fallos del primero respondió el segundo backend")
+    else:
+        print_fail(f"Respondió {result.backend}, métricas: {gateway.metrics}")
+        ok = False
+
+    calls_before = primary.calls
+    await gateway.chat(MESSAGES)
+    if gateway.backends[0].breaker.state == "open" and primary.calls == calls_before:
+        print_pass("Con su breaker abierto el primer backend ni se intenta")
+    else:
+        print_fail(f"Breaker {gateway.backends[0].breaker.state}, llamadas {primary.calls}")
+        ok = False
+
+    chat_only, embedder = FakeProvider(), FakeProvider()
+    gateway = new_gateway(chat_only, embedder)
+    gateway.backends[0].embedding_model = "otro-modelo"
+    await gateway.embed("metformina")
+    if chat_only.calls == 0 and embedder.calls == 1:
+        print_pass("Los embeddings saltan al backend con otro modelo de embeddings")
+    else:
+        print_fail(f"Llamadas de embeddings: {chat_only.calls} y {embedder.calls}")
+        ok = False
+
+    return ok
+
+
+async def run_tests() -> list:
+    tests = [
+        test_hedge_wins,
+        test_hedge_stream,
+        test_transient_retry,
+        test_non_transient_not_retried,
+        test_circuit_breaker,
+        test_admission_concurrency,
+        test_admission_deadline,
+        test_backend_fallback,
+    ]
+    return [await test() for test in tests]
+
+
+def main() -> int:
+    results = asyncio.run(run_tests())
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+SmartHealth - Enrutamiento de Modelos por Pregunta
+==================================================
+Ejecutar: python test_model_router.py
+
+No requiere OpenAI ni base de datos: solo se evalúa route_question con la
+configuración por defecto.
+
+Verifica:
+1. fast: consultas puntuales cortas y sin síntesis
+2. standard: preguntas que no son puntuales ni de síntesis, y síntesis sobre
+   un contexto chico
+3. complex: síntesis sobre muchos registros o un contexto grande, y
+   preguntas muy largas
+4. Cada nivel usa su modelo y su tope de tokens; con
+   LLM_ROUTING_ENABLED=false todo va a standard
+"""
+
+import sys
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from app.database.db_config import settings
+from app.services.model_router import route_question
+
+# Contexto chico (pocos registros) y grande (según los umbrales configurados)
+SMALL_CONTEXT = (400, 5)
+LARGE_CONTEXT = (settings.llm_route_complex_context_tokens, 5)
+MANY_RECORDS = (400, settings.llm_route_complex_min_records)
+
+# (pregunta, (tokens de contexto, registros en contexto), nivel esperado)
+CASES = [
+    ("¿Cuándo fue su última cita?", SMALL_CONTEXT, "fast"),
+    ("¿Qué dosis de metformina toma?", SMALL_CONTEXT, "fast"),
+    ("¿Tiene alergias?", LARGE_CONTEXT, "fast"),
+    ("¿Cuál es su grupo sanguíneo?", MANY_RECORDS, "fast"),
+    ("Háblame de la diabetes del paciente", SMALL_CONTEXT, "standard"),
+    ("¿Cómo está controlada su tensión arterial?", LARGE_CONTEXT, "standard"),
+    ("Resume la historia clínica del paciente", SMALL_CONTEXT, "standard"),
+    ("¿Cuál fue su glucosa en 2023?", SMALL_CONTEXT, "standard"),
+    ("Resume la historia clínica del paciente", LARGE_CONTEXT, "complex"),
+    ("¿Cómo evolucionó su hemoglobina glicosilada?", MANY_RECORDS, "complex"),
+    ("Compara sus diagnósticos entre 2019 y 2024", MANY_RECORDS, "complex"),
+    (
+        "Necesito que me digas con detalle qué medicamentos le recetaron al paciente en cada una "
+        "de las consultas de cardiología, quién se los recetó, con qué dosis y si hubo algún efecto "
+        "adverso registrado después",
+        SMALL_CONTEXT,
+        "complex",
+    ),
+]
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def test_tier(tier: str) -> bool:
+    print_test(f"Nivel {tier}")
+    cases = [(question, context) for question, context, expected in CASES if expected == tier]
+    wrong = []
+    for question, (context_tokens, records) in cases:
+        route = route_question(question, context_tokens, records)
+        if route.tier != tier:
+            wrong.append(f"{question[:50]!r} ({context_tokens} tokens, {records} registros) -> {route.tier} {route.reasons}")
+    if not wrong:
+        print_pass(f"{len(cases)} preguntas enrutadas a {tier}")
+        return True
+    for line in wrong:
+        print_fail(line)
+    return False
+
+
+def test_route_settings() -> bool:
+    print_test("Modelo y tope de tokens por nivel")
+    fast = route_question("¿Tiene alergias?", *SMALL_CONTEXT)
+    standard = route_question("Háblame de la diabetes del paciente", *SMALL_CONTEXT)
+    complex_route = route_question("Resume la historia clínica del paciente", *LARGE_CONTEXT)
+    ok = (
+        (fast.model, fast.max_tokens) == (settings.llm_fast_model, settings.llm_fast_max_tokens)
+        and (standard.model, standard.max_tokens) == (settings.llm_model, settings.rag_answer_max_tokens)
+        and (complex_route.model, complex_route.max_tokens) == (settings.llm_complex_model, settings.llm_complex_max_tokens)
+        and "large_context" in complex_route.reasons
+    )
+    if ok:
+        print_pass(f"fast={fast.model}, standard={standard.model}, complex={complex_route.model}")
+    else:
+        print_fail(f"fast={fast}, standard={standard}, complex={complex_route}")
+    return ok
+
+
+def test_routing_disabled() -> bool:
+    print_test("LLM_ROUTING_ENABLED=false")
+    original = settings.llm_routing_enabled
+    settings.llm_routing_enabled = False
+    try:
+        tiers = {route_question(question, *context).tier for question, context, _ in CASES}
+    finally:
+        settings.llm_routing_enabled = original
+    if tiers == {"standard"}:
+        print_pass(f"Las {len(CASES)} preguntas usan standard")
+        return True
+    print_fail(f"Niveles: {tiers}")
+    return False
+
+
+def run_tests() -> list:
+    return [
+        test_tier("fast"),
+        test_tier("standard"),
+        test_tier("complex"),
+        test_route_settings(),
+        test_routing_disabled(),
+    ]
+
+
+def main() -> int:
+    results = run_tests()
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
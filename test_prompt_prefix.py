@@ -0,0 +1,308 @@
+"""
+SmartHealth - Prefijo Estable del Prompt
+========================================
+Ejecutar: python test_prompt_prefix.py
+
+No requiere OpenAI ni base de datos: la historia clínica es sintética y el
+cliente del gateway se reemplaza por uno falso.
+
+Verifica:
+1. Con la misma historia, el prefijo del prompt (system + bloque del
+   paciente) es idéntico byte a byte entre preguntas con distintos chunks de
+   búsqueda semántica, en ambos formatos y con el presupuesto desbordado
+2. El prefijo no depende del cache de fragmentos (renderizar de nuevo da
+   los mismos bytes)
+3. Si la historia cambia, el prefijo cambia
+4. La pregunta y los chunks van solo en el último mensaje
+5. cached_tokens del uso informado por el proveedor llega a LLMResponse
+   (con y sin streaming)
+"""
+
+import asyncio
+import json
+import sys
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from types import SimpleNamespace as NS
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from app.schemas.clinical import (
+    AppointmentDTO, ClinicalRecords, DiagnosisDTO, MedicalRecordDTO,
+    PatientInfo, PatientSummaryDTO, PrescriptionDTO
+)
+from app.schemas.rag import SimilarChunk
+from app.services.llm_gateway import llm_gateway
+from app.services.llm_service import SYSTEM_PROMPT, llm_service
+from app.services.rag_context import CONTEXT_FORMATS, build_context
+
+# Presupuesto chico para que las secciones del paciente no entren completas
+TIGHT_BUDGET = 1200
+CHART_VERSION = "v1"
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# DATOS SINTÉTICOS
+# ============================================================
+
+def make_patient() -> PatientInfo:
+    return PatientInfo(
+        patient_id=900001, first_name="Ana", first_surname="Prueba",
+        birth_date=date(1970, 5, 17), gender="F", email="ana@example.com",
+        document_type_id=2, document_number="90000001"
+    )
+
+
+def make_records(extra_prescription: bool = False) -> ClinicalRecords:
+    base = datetime(2025, 6, 30, 9, 0)
+    appointments = [
+        AppointmentDTO(
+            appointment_id=100 + i, patient_id=900001, doctor_id=1,
+            appointment_date=(base - timedelta(days=7 * i)).date(), start_time=time(9, 0),
+            appointment_type="Control", status="Completada", reason=f"Control de seguimiento {i}",
+            doctor_name="Dr. Pérez", specialty_name="Medicina Interna"
+        )
+        for i in range(12)
+    ]
+    records = [
+        MedicalRecordDTO(
+            medical_record_id=200 + i, patient_id=900001, doctor_id=1,
+            registration_datetime=base - timedelta(days=7 * i), record_type="Consulta",
+            summary_text=f"Paciente estable, glucemia controlada (visita {i})"
+        )
+        for i in range(12)
+    ]
+    prescriptions = [
+        PrescriptionDTO(
+            prescription_id=300 + i, medical_record_id=200 + i, medication_id=i,
+            dosage="850 mg", frequency="Cada 12 horas", duration="30 días",
+            instruction="Tomar con las comidas", prescription_date=(base - timedelta(days=7 * i)).date(),
+            medication_name=f"Medicamento {i}"
+        )
+        for i in range(15)
+    ]
+    if extra_prescription:
+        prescriptions.insert(0, PrescriptionDTO(
+            prescription_id=399, medical_record_id=200, medication_id=99,
+            dosage="10 mg", frequency="Cada 24 horas", prescription_date=base.date(),
+            medication_name="Atorvastatina"
+        ))
+    diagnoses = [
+        DiagnosisDTO(
+            record_diagnosis_id=400 + i, diagnosis_id=i, icd_code=f"E1{i % 10}",
+            description=f"Diagnóstico {i}", diagnosis_type="Principal",
+            diagnosis_date=base - timedelta(days=7 * i)
+        )
+        for i in range(15)
+    ]
+    summary = PatientSummaryDTO(
+        years={str(year): {"text": f"Resumen del año {year}: controles trimestrales."} for year in range(2015, 2025)},
+        conditions={"I10": {"description": "Hipertensión", "last_date": "2023-01-10", "count": 8,
+                            "text": "Hipertensión esencial en tratamiento"}}
+    )
+    return ClinicalRecords(
+        appointments=appointments, medical_records=records,
+        prescriptions=prescriptions, diagnoses=diagnoses, summary=summary
+    )
+
+
+def make_chunks(n: int, topic: str) -> list:
+    return [
+        SimilarChunk(
+            source_type="medical_record", source_id=500 + i, patient_id=900001,
+            chunk_text=f"{topic}: hallazgo relevante número {i} para la pregunta",
+            date=date(2024, 1, 1 + i), relevance_score=0.9 - i * 0.05
+        )
+        for i in range(n)
+    ]
+
+
+QUESTIONS = [
+    ("¿Qué medicamentos toma?", make_chunks(0, "")),
+    ("¿Cómo evolucionó su glucemia?", make_chunks(5, "Glucemia")),
+    ("¿Tuvo problemas de presión arterial?", make_chunks(2, "Presión arterial")),
+]
+
+
+def prefix_bytes(messages: list) -> bytes:
+    return json.dumps(messages[:-1], ensure_ascii=False).encode("utf-8")
+
+
+def prompt_for(question: str, chunks: list, records: ClinicalRecords, context_format: str,
+               chart_version=CHART_VERSION) -> list:
+    context = build_context(
+        make_patient(), records, chunks, TIGHT_BUDGET, context_format, chart_version=chart_version
+    )
+    return llm_service._messages(question, context.patient_text, context.question_text)
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def test_prefix_stable_across_questions() -> bool:
+    print_test("Prefijo idéntico entre preguntas con la misma historia")
+    ok = True
+    for context_format in CONTEXT_FORMATS:
+        records = make_records()
+        prompts = [prompt_for(q, chunks, records, context_format) for q, chunks in QUESTIONS]
+        prefixes = {prefix_bytes(messages) for messages in prompts}
+        context = build_context(make_patient(), records, QUESTIONS[1][1], TIGHT_BUDGET, context_format)
+        if not context.items_dropped:
+            print_fail(f"[{context_format}] El presupuesto no se desbordó; el test no prueba nada")
+            ok = False
+        elif len(prefixes) == 1:
+            print_pass(
+                f"[{context_format}] {len(prompts)} preguntas, prefijo de "
+                f"{len(next(iter(prefixes)))} bytes idéntico (descartados: {context.items_dropped})"
+            )
+        else:
+            print_fail(f"[{context_format}] {len(prefixes)} prefijos distintos")
+            ok = False
+    return ok
+
+
+def test_prefix_without_fragment_cache() -> bool:
+    print_test("Prefijo determinista sin cache de fragmentos")
+    question, chunks = QUESTIONS[1]
+    cached = prompt_for(question, chunks, make_records(), "markdown")
+    rendered = prompt_for(question, chunks, make_records(), "markdown", chart_version=None)
+    if prefix_bytes(cached) == prefix_bytes(rendered):
+        print_pass("Renderizar la misma historia de nuevo da los mismos bytes")
+        return True
+    print_fail("El prefijo cambió al renderizar de nuevo")
+    return False
+
+
+def test_prefix_changes_with_chart() -> bool:
+    print_test("El prefijo cambia si cambia la historia")
+    question, chunks = QUESTIONS[0]
+    before = prompt_for(question, chunks, make_records(), "markdown", chart_version=None)
+    after = prompt_for(question, chunks, make_records(extra_prescription=True), "markdown", chart_version=None)
+    if prefix_bytes(before) != prefix_bytes(after) and "Atorvastatina" in after[1]["content"]:
+        print_pass("Una prescripción nueva cambia el bloque del paciente")
+        return True
+    print_fail("El prefijo no refleja el cambio de la historia")
+    return False
+
+
+def test_question_last() -> bool:
+    print_test("Pregunta y chunks solo en el último mensaje")
+    question, chunks = QUESTIONS[1]
+    messages = prompt_for(question, chunks, make_records(), "markdown")
+    ok = True
+    if messages[0] != {"role": "system", "content": SYSTEM_PROMPT}:
+        print_fail("El mensaje de sistema no es SYSTEM_PROMPT")
+        ok = False
+    prefix = "".join(m["content"] for m in messages[:-1])
+    if question in prefix or chunks[0].chunk_text in prefix:
+        print_fail("La pregunta o los chunks aparecen en el prefijo")
+        ok = False
+    last = messages[-1]["content"]
+    if question not in last or chunks[0].chunk_text not in last:
+        print_fail("El último mensaje no trae la pregunta y los chunks")
+        ok = False
+    if ok:
+        print_pass(f"{len(messages)} mensajes: system, paciente, chunks + pregunta")
+    return ok
+
+
+async def test_cached_tokens_captured() -> bool:
+    print_test("cached_tokens del proveedor en LLMResponse")
+    usage = NS(completion_tokens=12, total_tokens=2012, prompt_tokens=2000,
+               prompt_tokens_details=NS(cached_tokens=1792))
+    text = "El paciente toma metformina 850 mg cada 12 horas."
+
+    async def create(**kwargs):
+        if not kwargs.get("stream"):
+            return NS(choices=[NS(message=NS(content=text))], model=kwargs["model"], usage=usage)
+
+        async def chunks():
+            yield NS(choices=[NS(delta=NS(content=text))], usage=None)
+            yield NS(choices=[], usage=usage)
+
+        class Stream:
+            def __init__(self):
+                self._chunks = chunks()
+
+            def __aiter__(self):
+                return self._chunks
+
+            async def close(self):
+                pass
+
+        return Stream()
+
+    backend = llm_gateway.backends[0]
+    original = backend._client
+    backend._client = NS(chat=NS(completions=NS(create=create)))
+    try:
+        response = await llm_service.run_llm("¿Qué toma?", "contexto")
+        stream = await llm_service.run_llm("¿Qué toma?", "contexto", stream=True)
+        async for _ in stream:
+            pass
+    finally:
+        backend._client = original
+
+    results = {"chat": response, "stream": stream.response}
+    ok = all(r.cached_tokens == 1792 and r.prompt_tokens == 2000 for r in results.values())
+    if ok:
+        print_pass("Con y sin streaming: 1792/2000 tokens del prompt desde el cache del proveedor")
+    else:
+        print_fail({name: (r.prompt_tokens, r.cached_tokens) for name, r in results.items()})
+    return ok
+
+
+async def run_tests() -> list:
+    results = [
+        test_prefix_stable_across_questions(),
+        test_prefix_without_fragment_cache(),
+        test_prefix_changes_with_chart(),
+        test_question_last(),
+    ]
+    results.append(await test_cached_tokens_captured())
+    return results
+
+
+def main() -> int:
+    results = asyncio.run(run_tests())
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""
+SmartHealth - Cancelación por Desconexión del Cliente
+=====================================================
+Ejecutar: python test_query_cancellation.py
+
+Requisitos:
+- PostgreSQL local y .env configurado (solo se usa pg_sleep, no hacen falta
+  datos); no se llama a OpenAI
+
+Verifica:
+1. run_until_disconnected retorna el resultado si el cliente sigue conectado
+2. Si el cliente se desconecta, cancela el trabajo y lanza ClientDisconnected
+3. CancelScope cancela las conexiones con statements en curso y rechaza
+   los siguientes; una conexión no se libera mientras se la cancela
+4. LLMStream.aclose cierra el streaming del proveedor a mitad de respuesta
+   y el iterador que entregó __aiter__
+5. run_cancellable corta en PostgreSQL un statement en curso al cancelarse
+   la espera, y la conexión vuelve al pool utilizable
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace as NS
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from sqlalchemy import text
+
+from app.database import cancellation
+from app.database.cancellation import CancelScope, QueryCancelledError, run_cancellable
+from app.database.database import engine, SessionLocal
+from app.routers.query import ClientDisconnected, run_until_disconnected
+from app.services.llm_gateway import ChatStream
+from app.services.llm_service import LLMStream
+
+# Duración del statement que se cancela y margen para considerarlo cortado
+SLEEP_SECONDS = 10
+CANCEL_AFTER_SECONDS = 0.3
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+async def test_completes_while_connected() -> bool:
+    print_test("Cliente conectado: se obtiene el resultado")
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "respuesta"
+
+    never = asyncio.Event()
+    result = await run_until_disconnected(work(), never.wait)
+    if result == "respuesta":
+        print_pass("run_until_disconnected retornó el resultado del trabajo")
+        return True
+    print_fail(f"Resultado inesperado: {result!r}")
+    return False
+
+
+async def test_cancels_on_disconnect() -> bool:
+    print_test("Cliente desconectado: el trabajo se cancela")
+    state = {"cleaned_up": False}
+
+    async def work():
+        try:
+            await asyncio.sleep(SLEEP_SECONDS)
+        finally:
+            state["cleaned_up"] = True
+
+    disconnected = asyncio.Event()
+    asyncio.get_running_loop().call_later(CANCEL_AFTER_SECONDS, disconnected.set)
+    before = time.perf_counter()
+    try:
+        await run_until_disconnected(work(), disconnected.wait)
+    except ClientDisconnected:
+        elapsed = time.perf_counter() - before
+        if state["cleaned_up"] and elapsed < 1:
+            print_pass(f"ClientDisconnected a los {elapsed * 1000:.0f} ms, limpieza del trabajo terminada")
+            return True
+        print_fail(f"Limpieza: {state['cleaned_up']}, tiempo: {elapsed:.2f}s")
+        return False
+    print_fail("No se lanzó ClientDisconnected")
+    return False
+
+
+def test_cancel_scope() -> bool:
+    print_test("CancelScope con conexiones falsas")
+    cancelled = []
+
+    class FakeConnection:
+        def __init__(self, name: str):
+            self.name = name
+
+        def cancel(self):
+            cancelled.append(self.name)
+
+    busy, idle = FakeConnection("busy"), FakeConnection("idle")
+
+    scope = CancelScope()
+    scope.started(busy)
+    scope.started(idle)
+    scope.finished(idle)
+    count = scope.cancel()
+
+    ok = count == 1 and cancelled == ["busy"]
+    try:
+        scope.started(idle)
+        ok = False
+        print_fail("Se aceptó un statement después de cancelar")
+    except QueryCancelledError:
+        pass
+    if ok:
+        print_pass("Solo se canceló la conexión ocupada y el scope rechaza statements nuevos")
+    else:
+        print_fail(f"Canceladas: {cancelled}, count={count}")
+    return ok
+
+
+def test_cancel_blocks_connection_release() -> bool:
+    print_test("CancelScope: la conexión no se libera mientras se cancela")
+    scope = CancelScope()
+    released = threading.Event()
+
+    class RacingConnection:
+        """El statement termina justo mientras se envía la cancelación."""
+
+        def cancel(self):
+            threading.Thread(target=release, daemon=True).start()
+            # Si finished() no espera al lock, la conexión ya volvió al pool
+            self.released_during_cancel = released.wait(CANCEL_AFTER_SECONDS)
+
+    def release():
+        scope.finished(connection)
+        released.set()
+
+    connection = RacingConnection()
+    scope.started(connection)
+    scope.cancel()
+    released.wait(1)
+
+    if not connection.released_during_cancel and released.is_set():
+        print_pass("finished() esperó a que terminara cancel()")
+        return True
+    print_fail(f"Liberada durante cancel: {connection.released_during_cancel}")
+    return False
+
+
+async def test_llm_stream_aclose() -> bool:
+    print_test("LLMStream.aclose cierra el streaming del proveedor")
+    state = {"closed": False, "sent": 0}
+
+    async def chunks():
+        try:
+            for word in ["El", " paciente", " toma", " metformina", " 850", " mg"]:
+                state["sent"] += 1
+                yield NS(choices=[NS(delta=NS(content=word))], usage=None)
+        finally:
+            state["closed"] = True
+
+    stream = LLMStream(ChatStream(chunks(), "fake", "fake-model"), time.perf_counter())
+    deltas = stream.__aiter__()
+    await deltas.__anext__()
+    await stream.aclose()
+
+    iterator_closed = deltas.ag_frame is None
+    if state["closed"] and iterator_closed and state["sent"] == 1 and stream.response is None:
+        print_pass("Conexión e iterador cerrados después del primer chunk, sin respuesta parcial")
+        return True
+    print_fail({**state, "iterator_closed": iterator_closed})
+    return False
+
+
+async def test_database_statement_cancelled() -> bool:
+    print_test("Statement en PostgreSQL cancelado al cancelarse la espera")
+    outcome = {}
+    finished = threading.Event()
+
+    def slow_query():
+        db = SessionLocal()
+        started = time.perf_counter()
+        try:
+            db.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": SLEEP_SECONDS})
+            outcome["first"] = "completó"
+        except Exception as e:
+            outcome["first"] = type(getattr(e, "orig", e)).__name__
+        outcome["elapsed"] = time.perf_counter() - started
+        try:
+            db.execute(text("SELECT 1"))
+            outcome["second"] = "ejecutó"
+        except QueryCancelledError:
+            outcome["second"] = "rechazado"
+        finally:
+            db.close()
+            finished.set()
+
+    before = dict(cancellation.metrics)
+    try:
+        await asyncio.wait_for(run_cancellable(slow_query), timeout=CANCEL_AFTER_SECONDS)
+        print_fail("El statement terminó antes del timeout")
+        return False
+    except asyncio.TimeoutError:
+        pass
+
+    await asyncio.to_thread(finished.wait, SLEEP_SECONDS)
+
+    def select_42():
+        with SessionLocal() as db:
+            return db.execute(text("SELECT 42")).scalar()
+
+    reusable = await run_cancellable(select_42)
+
+    ok = (
+        outcome.get("first") == "QueryCanceled"
+        and outcome.get("elapsed", SLEEP_SECONDS) < 1
+        and outcome.get("second") == "rechazado"
+        and reusable == 42
+        and cancellation.metrics["statements_cancelled"] == before["statements_cancelled"] + 1
+    )
+    if ok:
+        print_pass(
+            f"pg_sleep({SLEEP_SECONDS}) cortado a los {outcome['elapsed'] * 1000:.0f} ms, "
+            f"statement siguiente rechazado, pool utilizable"
+        )
+    else:
+        print_fail(outcome)
+    return ok
+
+
+async def run_tests() -> list:
+    results = [
+        await test_completes_while_connected(),
+        await test_cancels_on_disconnect(),
+        test_cancel_scope(),
+        test_cancel_blocks_connection_release(),
+        await test_llm_stream_aclose(),
+    ]
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        print_info(f"PostgreSQL no disponible ({type(e).__name__}), se omite la prueba de BD")
+        return results
+    results.append(await test_database_statement_cancelled())
+    return results
+
+
+def main() -> int:
+    engine.echo = False
+    results = asyncio.run(run_tests())
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
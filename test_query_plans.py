@@ -0,0 +1,259 @@
+"""
+SmartHealth - Regresión de Planes de Ejecución
+==============================================
+Ejecutar: python test_query_plans.py
+
+Requisitos:
+- PostgreSQL local con datos de prueba cargados (scripts de pipelines)
+- Migraciones aplicadas: cd src && alembic upgrade head
+- .env configurado (no se llama a OpenAI: el embedding de la pregunta es sintético)
+
+Verifica:
+1. Captura las sentencias SQL reales que ejecutan clinical_service y vector_search
+2. Ejecuta EXPLAIN (FORMAT JSON) sobre cada una con sus mismos parámetros
+3. Falla si aparece un Seq Scan sobre una tabla grande
+
+Variables opcionales:
+- PLAN_TEST_MIN_ROWS: filas a partir de las cuales una tabla es "grande" (default 10000)
+- PLAN_TEST_PATIENT_ID: paciente a usar (default: uno con la mediana de citas)
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from sqlalchemy import event, text
+
+from app.database.database import engine, SessionLocal
+from app.services import clinical_service, vector_search
+
+MIN_LARGE_TABLE_ROWS = int(os.getenv("PLAN_TEST_MIN_ROWS", "10000"))
+TEST_PATIENT_ID = os.getenv("PLAN_TEST_PATIENT_ID")
+EMBEDDING_DIMENSIONS = 1536
+SCHEMA = "smart_health"
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# CAPTURA DE SENTENCIAS
+# ============================================================
+
+class StatementRecorder:
+    """Registra (sql, parámetros) de cada SELECT ejecutado por el engine."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(engine, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(engine, "before_cursor_execute", self)
+
+
+async def fake_embedding(question: str) -> list:
+    """Embedding determinista para no depender de OpenAI."""
+    rng = random.Random(question)
+    return [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+
+# ============================================================
+# ANÁLISIS DE PLANES
+# ============================================================
+
+def get_large_tables() -> set:
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT c.relname
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema
+              AND c.relkind IN ('r', 'p')
+              AND c.reltuples >= :min_rows
+        """), {"schema": SCHEMA, "min_rows": MIN_LARGE_TABLE_ROWS}).fetchall()
+    return {row.relname for row in rows}
+
+
+def find_seq_scans(plan_node: dict, large_tables: set) -> list:
+    """Recorre el plan y devuelve las tablas grandes leídas con Seq Scan."""
+    found = []
+    if plan_node.get("Node Type") == "Seq Scan" and plan_node.get("Relation Name") in large_tables:
+        found.append(plan_node["Relation Name"])
+    for child in plan_node.get("Plans", []):
+        found.extend(find_seq_scans(child, large_tables))
+    return found
+
+
+def explain(statement: str, parameters) -> dict:
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+    finally:
+        raw.close()
+
+
+def pick_patient():
+    """
+    Usa un paciente con la mediana de citas: el plan debe ser bueno para el
+    caso típico. Para un paciente atípico (miles de registros) un Seq Scan
+    con hash join puede ser la elección correcta del planner.
+    """
+    with engine.connect() as conn:
+        if TEST_PATIENT_ID:
+            return conn.execute(text(f"""
+                SELECT patient_id, document_type_id, document_number
+                FROM {SCHEMA}.patients
+                WHERE patient_id = :patient_id
+            """), {"patient_id": int(TEST_PATIENT_ID)}).first()
+
+        return conn.execute(text(f"""
+            WITH totals AS (
+                SELECT patient_id, COUNT(*) AS total
+                FROM {SCHEMA}.appointments
+                GROUP BY patient_id
+            ),
+            median AS (
+                SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY total) AS total
+                FROM totals
+            )
+            SELECT p.patient_id, p.document_type_id, p.document_number
+            FROM {SCHEMA}.patients p
+            JOIN totals t ON t.patient_id = p.patient_id
+            JOIN median m ON m.total = t.total
+            ORDER BY p.patient_id
+            LIMIT 1
+        """)).first()
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def capture_clinical_statements(patient) -> list:
+    db = SessionLocal()
+    try:
+        with StatementRecorder() as recorder:
+            clinical_service.fetch_patient_and_records(
+                db, patient.document_type_id, patient.document_number
+            )
+            clinical_service.fetch_patient_and_records(
+                db, patient.document_type_id, patient.document_number, full_history=True
+            )
+        return recorder.statements
+    finally:
+        db.close()
+
+
+def capture_vector_statements(patient) -> list:
+    vector_search.get_embedding = fake_embedding
+    with StatementRecorder() as recorder:
+        asyncio.run(vector_search.search_similar_chunks(
+            patient_id=patient.patient_id,
+            question="¿Qué medicamentos toma actualmente el paciente?"
+        ))
+    return recorder.statements
+
+
+def check_statements(label: str, statements: list, large_tables: set) -> int:
+    print_test(label)
+    failures = 0
+
+    if not statements:
+        print_fail("No se capturó ninguna sentencia")
+        return 1
+
+    for statement, parameters in statements:
+        summary = " ".join(statement.split())[:90]
+        try:
+            plan = explain(statement, parameters)
+        except Exception as e:
+            print_fail(f"EXPLAIN falló ({type(e).__name__}: {e}) -> {summary}")
+            failures += 1
+            continue
+
+        seq_scans = find_seq_scans(plan, large_tables)
+        if seq_scans:
+            print_fail(f"Seq Scan sobre {', '.join(sorted(set(seq_scans)))} -> {summary}")
+            failures += 1
+        else:
+            print_pass(summary)
+
+    return failures
+
+
+def main() -> int:
+    engine.echo = False
+
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"ANALYZE {SCHEMA}.patients, {SCHEMA}.appointments, {SCHEMA}.medical_records, "
+            f"{SCHEMA}.prescriptions, {SCHEMA}.record_diagnoses, {SCHEMA}.doctor_specialties"
+        ))
+
+    large_tables = get_large_tables()
+    print_info(f"Tablas grandes (>= {MIN_LARGE_TABLE_ROWS} filas): {', '.join(sorted(large_tables)) or 'ninguna'}")
+    if not large_tables:
+        print_info("La BD no tiene tablas grandes: cargue más datos para que el test sea significativo")
+
+    patient = pick_patient()
+    if patient is None:
+        print_fail("No hay pacientes con citas en la BD")
+        return 1
+    print_info(f"Paciente de prueba: {patient.patient_id}")
+
+    failures = 0
+    failures += check_statements("clinical_service", capture_clinical_statements(patient), large_tables)
+    failures += check_statements("vector_search", capture_vector_statements(patient), large_tables)
+
+    print()
+    if failures:
+        print_fail(f"{failures} sentencia(s) con planes inaceptables")
+        return 1
+    print_pass("Ninguna sentencia hace Seq Scan sobre tablas grandes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
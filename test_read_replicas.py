@@ -0,0 +1,322 @@
+"""
+SmartHealth - Test de Ruteo a Réplicas de Lectura
+=================================================
+Ejecutar: python test_read_replicas.py
+
+Requisitos (dos instancias locales de PostgreSQL):
+- Primario configurado en .env (DB_HOST, DB_PORT, ...)
+- Réplica de streaming del primario, por ejemplo:
+    pg_basebackup -h localhost -p 5432 -U postgres -D /tmp/replica -R -X stream
+    pg_ctl -D /tmp/replica -o "-p 5433" start
+- DB_REPLICA_HOSTS=localhost:5433 en el .env o en el entorno
+
+Verifica:
+1. Las lecturas van a la réplica y las escrituras al primario
+2. max_staleness=0 fuerza la lectura en el primario
+3. Una réplica caída sale de la rotación y se lee del primario
+4. Una réplica con más atraso que el tolerado se salta
+5. Round-robin entre réplicas sanas
+6. clinical_service y vector_search funcionan sobre la réplica
+7. Una réplica desconectada del primario no cuenta como "al día" (cambia
+   primary_conninfo de la réplica durante la prueba y lo restaura)
+"""
+
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from sqlalchemy import create_engine, text
+
+from app.database.database import (
+    engine,
+    SessionLocal,
+    ReplicaRouter,
+    ReplicaState,
+    replica_router,
+    open_read_session,
+)
+from app.services import clinical_service, vector_search
+
+EMBEDDING_DIMENSIONS = 1536
+# Puerto donde no escucha nadie: simula una réplica caída
+DEAD_REPLICA_URL = "postgresql://postgres:x@127.0.0.1:1/postgres"
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+def server_of(session) -> tuple:
+    """(puerto, está en recovery) del servidor al que está conectada la sesión."""
+    row = session.execute(text("SELECT inet_server_port() AS port, pg_is_in_recovery() AS standby")).one()
+    return row.port, row.standby
+
+
+async def fake_embedding(question: str) -> list:
+    """Embedding determinista para no depender de OpenAI."""
+    rng = random.Random(question)
+    return [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def test_reads_and_writes() -> bool:
+    print_test("TEST 1: Lecturas a réplica, escrituras a primario")
+
+    read_db = open_read_session()
+    write_db = SessionLocal()
+    try:
+        read_port, read_standby = server_of(read_db)
+        write_port, write_standby = server_of(write_db)
+    finally:
+        read_db.close()
+        write_db.close()
+
+    ok = read_standby and not write_standby and read_port != write_port
+    if ok:
+        print_pass(f"Lectura en réplica :{read_port}, escritura en primario :{write_port}")
+    else:
+        print_fail(f"Lectura :{read_port} (standby={read_standby}), escritura :{write_port} (standby={write_standby})")
+    return ok
+
+
+def test_zero_staleness_uses_primary() -> bool:
+    print_test("TEST 2: max_staleness=0 lee del primario")
+
+    db = open_read_session(max_staleness=0)
+    try:
+        port, standby = server_of(db)
+    finally:
+        db.close()
+
+    if not standby:
+        print_pass(f"Lectura estricta servida por el primario :{port}")
+        return True
+    print_fail(f"Lectura estricta servida por la réplica :{port}")
+    return False
+
+
+def test_dead_replica_is_skipped() -> bool:
+    print_test("TEST 3: Réplica caída fuera de rotación")
+
+    dead = ReplicaState("caída", create_engine(DEAD_REPLICA_URL, connect_args={"connect_timeout": 1}))
+    router = ReplicaRouter(engine, [dead], health_check_interval=60, default_max_staleness=10)
+
+    start = time.perf_counter()
+    chosen = router.engine_for_read()
+    first_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    router.engine_for_read()
+    second_ms = (time.perf_counter() - start) * 1000
+
+    ok = chosen is engine and not dead.healthy
+    if ok:
+        print_pass("Con la única réplica caída se usa el primario")
+    else:
+        print_fail("Se eligió una réplica caída")
+
+    # El segundo intento no debe volver a pagar el timeout de conexión
+    if second_ms < 50:
+        print_pass(f"Estado cacheado: 1er intento {first_ms:.0f}ms, 2do {second_ms:.1f}ms")
+    else:
+        print_fail(f"Se re-chequeó la réplica caída ({second_ms:.0f}ms)")
+        ok = False
+    return ok
+
+
+def test_lagging_replica_is_skipped() -> bool:
+    print_test("TEST 4: Réplica atrasada se salta según tolerancia")
+
+    replica = replica_router.replicas[0]
+    router = ReplicaRouter(engine, [ReplicaState(replica.name, replica.engine)], 60, 10)
+    state = router.replicas[0]
+    router.check(state)
+    measured_lag = state.lag_seconds
+    print_info(f"Atraso medido de {state.name}: {measured_lag:.3f}s")
+
+    # Simular 30s de atraso sin esperar a que la réplica realmente se atrase
+    state.lag_seconds = 30.0
+    strict = router.engine_for_read(max_staleness=5)
+    lenient = router.engine_for_read(max_staleness=60)
+
+    ok = strict is engine and lenient is state.engine
+    if ok:
+        print_pass("Tolerancia 5s -> primario, tolerancia 60s -> réplica")
+    else:
+        print_fail("La tolerancia de atraso por llamada no se respetó")
+    return ok
+
+
+def test_round_robin() -> bool:
+    print_test("TEST 5: Round-robin entre réplicas sanas")
+
+    # Dos entradas apuntando a la misma réplica alcanzan para ver la rotación
+    replica = replica_router.replicas[0]
+    first = ReplicaState("r1", replica.engine)
+    second = ReplicaState("r2", create_engine(replica.engine.url))
+    router = ReplicaRouter(engine, [first, second], 60, 10)
+
+    picks = [router.engine_for_read() for _ in range(6)]
+    sequence = ["r1" if chosen is first.engine else "r2" for chosen in picks]
+    ok = sequence.count("r1") == 3 and sequence.count("r2") == 3 and sequence[0] != sequence[1]
+    if ok:
+        print_pass(f"Rotación: {' → '.join(sequence)}")
+    else:
+        print_fail(f"Rotación desbalanceada: {sequence}")
+    return ok
+
+
+def test_services_on_replica() -> bool:
+    print_test("TEST 6: clinical_service y vector_search sobre la réplica")
+
+    db = open_read_session()
+    try:
+        patient = db.execute(text(
+            "SELECT patient_id, document_type_id, document_number FROM smart_health.patients LIMIT 1"
+        )).first()
+        if patient is None:
+            print_fail("No hay pacientes en la BD")
+            return False
+
+        port, standby = server_of(db)
+        _, result = clinical_service.fetch_patient_and_records(
+            db, patient.document_type_id, patient.document_number
+        )
+    finally:
+        db.close()
+
+    ok = standby and result.patient is not None
+    if ok:
+        print_pass(f"Historia clínica leída desde la réplica :{port}")
+    else:
+        print_fail("clinical_service no leyó de la réplica")
+
+    vector_search.get_embedding = fake_embedding
+    try:
+        chunks = asyncio.run(vector_search.search_similar_chunks(
+            patient_id=patient.patient_id,
+            question="¿Qué medicamentos toma el paciente?",
+            min_score=-1000
+        ))
+        print_pass(f"Búsqueda semántica en réplica: {len(chunks)} chunks")
+    except Exception as e:
+        print_fail(f"vector_search falló: {e}")
+        ok = False
+    return ok
+
+
+def _wait_for(conn, condition: str, timeout: float = 15) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if conn.execute(text(f"SELECT {condition}")).scalar():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+STREAMING = "EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')"
+
+
+def test_disconnected_replica_is_not_fresh() -> bool:
+    print_test("TEST 7: Réplica desconectada del primario no cuenta como al día")
+
+    replica = replica_router.replicas[0]
+    router = ReplicaRouter(engine, [ReplicaState(replica.name, replica.engine)], 60, 10)
+    state = router.replicas[0]
+    admin = replica.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    # Se restaura con el mismo valor (pg_basebackup -R lo deja en postgresql.auto.conf)
+    conninfo = admin.execute(text("SHOW primary_conninfo")).scalar()
+    try:
+        # Una transacción reciente replicada, para que el atraso parta de ~0
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE IF NOT EXISTS public.replica_lag_probe (t timestamptz)"))
+            conn.execute(text("INSERT INTO public.replica_lag_probe VALUES (now())"))
+        _wait_for(admin, "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()")
+
+        admin.execute(text("ALTER SYSTEM SET primary_conninfo = ''"))
+        admin.execute(text("SELECT pg_reload_conf()"))
+        if not _wait_for(admin, f"NOT {STREAMING}"):
+            print_fail("El WAL receiver no se detuvo")
+            return False
+        time.sleep(2)
+
+        router.check(state)
+        print_info(f"Atraso medido sin WAL receiver: {state.lag_seconds:.3f}s")
+        ok = state.lag_seconds >= 2 and router.engine_for_read(max_staleness=1) is engine
+        if ok:
+            print_pass("Sin streaming el atraso crece y una lectura con tolerancia 1s va al primario")
+        else:
+            print_fail("La réplica desconectada se reportó al día")
+        return ok
+    finally:
+        quoted = conninfo.replace("'", "''")
+        admin.execute(text(f"ALTER SYSTEM SET primary_conninfo = '{quoted}'"))
+        admin.execute(text("SELECT pg_reload_conf()"))
+        if not _wait_for(admin, STREAMING, timeout=30):
+            print_info("La réplica todavía no volvió a conectarse al primario")
+        admin.close()
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS public.replica_lag_probe"))
+
+
+def main() -> int:
+    engine.echo = False
+
+    if not replica_router.replicas:
+        print_fail("DB_REPLICA_HOSTS no está configurado")
+        return 1
+    for replica in replica_router.replicas:
+        replica.engine.echo = False
+    print_info(f"Réplicas configuradas: {', '.join(r.name for r in replica_router.replicas)}")
+
+    tests = [
+        test_reads_and_writes,
+        test_zero_staleness_uses_primary,
+        test_dead_replica_is_skipped,
+        test_lagging_replica_is_skipped,
+        test_round_robin,
+        test_services_on_replica,
+        test_disconnected_replica_is_not_fresh,
+    ]
+    passed = sum(1 for test in tests if test())
+
+    print()
+    if passed == len(tests):
+        print_pass(f"{passed}/{len(tests)} tests pasaron")
+        return 0
+    print_fail(f"{len(tests) - passed}/{len(tests)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""
+SmartHealth - Test de Movimiento de Pacientes entre Shards
+==========================================================
+Ejecutar: python test_shard_rebalance.py
+
+Requisitos (dos bases de datos locales con el esquema de smart_health):
+- BD principal configurada en .env (tiene patient_directory)
+- Un segundo shard vacío con el mismo esquema, por ejemplo:
+    CREATE DATABASE smarthdb_s2 TEMPLATE smarthdb;
+    -- y en smarthdb_s2: TRUNCATE de patients y sus tablas clínicas
+- DB_SHARDS=shard1=localhost:5432/smarthdb,shard2=localhost:5432/smarthdb_s2
+  en el .env o en el entorno
+
+El paciente de prueba es una copia de uno real del primer shard con los ids
+desplazados en FIXTURE_ID_OFFSET; se borra de todos los shards al terminar.
+
+Verifica:
+1. Un documento sin entrada en patient_directory no se busca en los shards
+   (se cuenta como fallo del directorio); después de register() se encuentra
+2. move_patient copia todas las filas al destino, las borra del origen y
+   actualiza el directorio
+3. Durante el movimiento las filas del paciente están bloqueadas: un
+   diagnóstico nuevo para uno de sus registros espera
+4. Si entra una fila sin pasar por los locks, el movimiento no borra nada,
+   el directorio vuelve al origen y repetirlo termina el movimiento
+"""
+
+import sys
+import threading
+import time
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app.database.database import engine
+from app.database.shard_rebalance import (
+    PATIENT_TABLES,
+    SCHEMA,
+    _counts,
+    _delete_patient_rows,
+    _directory_shard,
+    move_patient,
+)
+from app.database.sharding import PatientLocation, open_document_session, shard_router
+
+FIXTURE_ID_OFFSET = 900_000_000
+FIXTURE_DOCUMENT_PREFIX = "SHARDTEST-"
+# Columnas id que se desplazan al copiar el paciente de prueba
+ID_COLUMNS = {"patient_id", "appointment_id", "medical_record_id", "prescription_id", "record_diagnosis_id"}
+
+# Espera entre cambiar el directorio y borrar del origen en las pruebas concurrentes
+GRACE_SECONDS = 1.5
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# PACIENTE DE PRUEBA
+# ============================================================
+
+class Fixture:
+    def __init__(self, source: str, target: str, template_id: int):
+        self.source = source
+        self.target = target
+        self.patient_id = template_id + FIXTURE_ID_OFFSET
+        self.template_id = template_id
+        self.document_type_id = None
+        self.document_number = None
+        self.expected = {}
+
+
+def _copy_expression(table: str, column: str) -> str:
+    if column in ID_COLUMNS:
+        return f"{column} + {FIXTURE_ID_OFFSET}"
+    if table == "patients" and column == "document_number":
+        return f"'{FIXTURE_DOCUMENT_PREFIX}' || document_number"
+    if table == "patients" and column == "email":
+        return "NULL"
+    return column
+
+
+def create_fixture(fixture: Fixture) -> None:
+    """Copia al paciente plantilla (con sus filas clínicas) como paciente de prueba."""
+    with shard_router.shards[fixture.source].begin() as conn:
+        for table, where in PATIENT_TABLES:
+            columns = conn.execute(text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = :schema AND table_name = :table ORDER BY ordinal_position"
+            ), {"schema": SCHEMA, "table": table}).scalars().all()
+            conn.execute(text(
+                f"INSERT INTO {SCHEMA}.{table} ({', '.join(columns)}) "
+                f"SELECT {', '.join(_copy_expression(table, column) for column in columns)} "
+                f"FROM {SCHEMA}.{table} WHERE {where}"
+            ), {"patient_id": fixture.template_id})
+        # Sin resumen: la prueba 4 lo agrega durante un movimiento
+        conn.execute(text(f"DELETE FROM {SCHEMA}.patient_summaries WHERE patient_id = :patient_id"),
+                     {"patient_id": fixture.patient_id})
+        fixture.document_type_id, fixture.document_number = conn.execute(text(
+            f"SELECT document_type_id, document_number FROM {SCHEMA}.patients WHERE patient_id = :patient_id"
+        ), {"patient_id": fixture.patient_id}).one()
+        fixture.expected = _counts(conn, fixture.patient_id)
+
+
+def remove_fixture(patient_id: int) -> None:
+    for shard_engine in shard_router.shards.values():
+        with shard_engine.begin() as conn:
+            _delete_patient_rows(conn, patient_id)
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {SCHEMA}.patient_directory WHERE patient_id = :patient_id"),
+                     {"patient_id": patient_id})
+    shard_router.forget(patient_id)
+
+
+def counts_in(shard_name: str, patient_id: int) -> dict:
+    with shard_router.shards[shard_name].connect() as conn:
+        return _counts(conn, patient_id)
+
+
+def find_template() -> tuple:
+    """(shard, patient_id) de un paciente con prescripciones y diagnósticos."""
+    for shard_name, shard_engine in shard_router.shards.items():
+        with shard_engine.connect() as conn:
+            patient_id = conn.execute(text(f"""
+                SELECT m.patient_id
+                FROM {SCHEMA}.medical_records m
+                WHERE m.patient_id < :offset
+                  AND EXISTS (SELECT 1 FROM {SCHEMA}.prescriptions p WHERE p.medical_record_id = m.medical_record_id)
+                  AND EXISTS (SELECT 1 FROM {SCHEMA}.record_diagnoses d WHERE d.medical_record_id = m.medical_record_id)
+                LIMIT 1
+            """), {"offset": FIXTURE_ID_OFFSET}).scalar()
+        if patient_id is not None:
+            return shard_name, patient_id
+    return None, None
+
+
+class MoveInBackground(threading.Thread):
+    """move_patient en otro hilo; guarda el resultado o la excepción."""
+
+    def __init__(self, patient_id: int, target: str, grace_seconds: float):
+        super().__init__(daemon=True)
+        self.args_ = (patient_id, target, grace_seconds)
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = move_patient(*self.args_)
+        except Exception as e:
+            self.error = e
+
+
+def wait_for_directory(patient_id: int, shard_name: str, timeout: float = 30) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if _directory_shard(patient_id) == shard_name:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def test_directory_is_authoritative(fixture: Fixture) -> bool:
+    print_test("Documento sin entrada en el directorio")
+    misses = shard_router.metrics["directory_misses"]
+    unregistered = open_document_session(fixture.document_type_id, fixture.document_number)
+    if unregistered is not None:
+        unregistered.close()
+        print_fail("Se abrió una sesión para un documento sin entrada en el directorio")
+        return False
+    if shard_router.metrics["directory_misses"] != misses + 1:
+        print_fail(f"Fallos del directorio: {misses} -> {shard_router.metrics['directory_misses']}")
+        return False
+
+    shard_router.register(
+        PatientLocation(fixture.patient_id, fixture.source),
+        fixture.document_type_id, fixture.document_number
+    )
+    db = open_document_session(fixture.document_type_id, fixture.document_number)
+    if db is None:
+        print_fail("open_document_session devolvió None después de register()")
+        return False
+    try:
+        database = db.execute(text("SELECT current_database()")).scalar()
+    finally:
+        db.close()
+
+    expected_database = shard_router.shards[fixture.source].url.database
+    registered = _directory_shard(fixture.patient_id)
+    if database == expected_database and registered == fixture.source:
+        print_pass(f"Sin entrada: None y un fallo contado; registrado: {fixture.source} ({database})")
+        return True
+    print_fail(f"BD: {database}, directorio: {registered}")
+    return False
+
+
+def test_move_patient(fixture: Fixture) -> bool:
+    print_test(f"Mover paciente {fixture.source} -> {fixture.target}")
+    moved = move_patient(fixture.patient_id, fixture.target, grace_seconds=0)
+
+    in_target = counts_in(fixture.target, fixture.patient_id)
+    in_source = counts_in(fixture.source, fixture.patient_id)
+    directory = _directory_shard(fixture.patient_id)
+    db = open_document_session(fixture.document_type_id, fixture.document_number)
+    try:
+        database = db.execute(text("SELECT current_database()")).scalar()
+    finally:
+        db.close()
+
+    ok = (
+        moved
+        and in_target == fixture.expected
+        and not any(in_source.values())
+        and directory == fixture.target
+        and database == shard_router.shards[fixture.target].url.database
+    )
+    if ok:
+        print_pass(f"Filas en {fixture.target}: {in_target}; ninguna en {fixture.source}")
+    else:
+        print_fail(f"esperadas={fixture.expected}, destino={in_target}, origen={in_source}, directorio={directory}")
+    return ok
+
+
+def test_writes_blocked_during_move(fixture: Fixture) -> bool:
+    source, target = fixture.target, fixture.source
+    print_test(f"Escrituras bloqueadas durante el movimiento {source} -> {target}")
+
+    with shard_router.shards[source].connect() as conn:
+        medical_record_id, diagnosis_id = conn.execute(text(f"""
+            SELECT d.medical_record_id, d.diagnosis_id
+            FROM {SCHEMA}.record_diagnoses d
+            JOIN {SCHEMA}.medical_records m ON m.medical_record_id = d.medical_record_id
+            WHERE m.patient_id = :patient_id
+            LIMIT 1
+        """), {"patient_id": fixture.patient_id}).one()
+
+    mover = MoveInBackground(fixture.patient_id, target, GRACE_SECONDS)
+    mover.start()
+    blocked = False
+    if wait_for_directory(fixture.patient_id, target):
+        with shard_router.shards[source].connect() as conn:
+            conn.begin()
+            conn.execute(text("SET LOCAL lock_timeout = '300ms'"))
+            try:
+                conn.execute(text(f"""
+                    INSERT INTO {SCHEMA}.record_diagnoses (record_diagnosis_id, medical_record_id, diagnosis_id)
+                    VALUES (:record_diagnosis_id, :medical_record_id, :diagnosis_id)
+                """), {
+                    "record_diagnosis_id": FIXTURE_ID_OFFSET * 2,
+                    "medical_record_id": medical_record_id,
+                    "diagnosis_id": diagnosis_id,
+                })
+            except OperationalError as e:
+                blocked = type(e.orig).__name__ == "LockNotAvailable"
+            conn.rollback()
+    mover.join()
+
+    in_target = counts_in(target, fixture.patient_id)
+    ok = blocked and mover.error is None and mover.result and in_target == fixture.expected
+    if ok:
+        print_pass("El diagnóstico nuevo esperó el lock; el movimiento terminó con las mismas filas")
+    else:
+        print_fail(f"bloqueado={blocked}, error={mover.error!r}, destino={in_target}")
+    return ok
+
+
+def test_move_aborts_on_new_rows(fixture: Fixture) -> bool:
+    source, target = fixture.source, fixture.target
+    print_test(f"Fila nueva durante el movimiento {source} -> {target}")
+
+    mover = MoveInBackground(fixture.patient_id, target, GRACE_SECONDS)
+    mover.start()
+    inserted = False
+    if wait_for_directory(fixture.patient_id, target):
+        # patient_summaries no referencia a patients: el insert no espera ningún lock
+        with shard_router.shards[source].begin() as conn:
+            conn.execute(text(f"""
+                INSERT INTO {SCHEMA}.patient_summaries (patient_id, summary, backend)
+                VALUES (:patient_id, '{{}}', 'test')
+            """), {"patient_id": fixture.patient_id})
+            inserted = True
+    mover.join()
+
+    expected = dict(fixture.expected, patient_summaries=1)
+    aborted = (
+        inserted
+        and isinstance(mover.error, RuntimeError)
+        and _directory_shard(fixture.patient_id) == source
+        and counts_in(source, fixture.patient_id) == expected
+    )
+    if not aborted:
+        print_fail(f"insertado={inserted}, error={mover.error!r}, directorio={_directory_shard(fixture.patient_id)}")
+        return False
+    print_info(f"Movimiento abortado: {mover.error}")
+
+    move_patient(fixture.patient_id, target, grace_seconds=0)
+    in_target = counts_in(target, fixture.patient_id)
+    in_source = counts_in(source, fixture.patient_id)
+    if in_target == expected and not any(in_source.values()):
+        print_pass("No se borró nada del origen; al repetirlo se movió también el resumen")
+        return True
+    print_fail(f"destino={in_target}, origen={in_source}")
+    return False
+
+
+def main() -> int:
+    engine.echo = False
+    if len(shard_router.shards) < 2:
+        print_fail("DB_SHARDS debe tener al menos dos shards")
+        return 1
+    for shard_engine in shard_router.shards.values():
+        shard_engine.echo = False
+
+    source, template_id = find_template()
+    if source is None:
+        print_fail("Ningún shard tiene un paciente con prescripciones y diagnósticos para copiar")
+        return 1
+    target = next(name for name in shard_router.shards if name != source)
+    fixture = Fixture(source, target, template_id)
+    print_info(f"Paciente de prueba {fixture.patient_id} (copia de {template_id}) en {source}")
+
+    remove_fixture(fixture.patient_id)
+    create_fixture(fixture)
+    try:
+        tests = [
+            test_directory_is_authoritative,
+            test_move_patient,
+            test_writes_blocked_during_move,
+            test_move_aborts_on_new_rows,
+        ]
+        passed = 0
+        for test in tests:
+            if not test(fixture):
+                break
+            passed += 1
+    finally:
+        remove_fixture(fixture.patient_id)
+
+    print()
+    if passed == len(tests):
+        print_pass(f"{passed}/{len(tests)} tests pasaron")
+        return 0
+    print_fail(f"{len(tests) - passed}/{len(tests)} tests fallaron o no se ejecutaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
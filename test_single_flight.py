@@ -0,0 +1,221 @@
+"""
+SmartHealth - Single-Flight de Consultas
+========================================
+Ejecutar: python test_single_flight.py
+
+No requiere OpenAI ni base de datos: la consulta compartida es un generador
+de eventos de prueba.
+
+Verifica:
+1. Una solicitud con la misma clave que otra en curso se une a ella: la
+   consulta corre una sola vez y ambas reciben todos los eventos en orden
+2. Si el cliente que inició la consulta se desconecta, sigue para los demás
+3. Cuando se va el último suscriptor la consulta se cancela (su finally se
+   ejecuta) y la clave queda libre para una ejecución nueva
+4. Un error de la consulta llega a todos los suscriptores
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+from typing import Optional
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from app.services.single_flight import SingleFlight
+
+KEY = (1, "chart-v1", "¿qué medicamentos toma?")
+EVENT_INTERVAL_SECONDS = 0.02
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# CONSULTA FALSA
+# ============================================================
+
+class FakeQuery:
+    """Emite count eventos espaciados; registra ejecuciones y cierre."""
+
+    def __init__(self, count: int = 5, fail_after: Optional[int] = None):
+        self.count = count
+        self.fail_after = fail_after
+        self.runs = 0
+        self.finished = False
+        self.cancelled = False
+
+    async def events(self):
+        self.runs += 1
+        try:
+            for i in range(self.count):
+                if self.fail_after is not None and i == self.fail_after:
+                    raise RuntimeError("falla simulada")
+                await asyncio.sleep(EVENT_INTERVAL_SECONDS)
+                yield {"type": "token", "index": i}
+            yield {"type": "complete"}
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        finally:
+            self.finished = True
+
+
+async def collect(subscription, limit: Optional[int] = None) -> list:
+    """Eventos del suscriptor (hasta limit); siempre cierra la suscripción."""
+    received = []
+    try:
+        async for event in subscription:
+            received.append(event)
+            if limit is not None and len(received) == limit:
+                break
+    finally:
+        await subscription.aclose()
+    return received
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+async def test_follower_gets_same_events() -> bool:
+    print_test("Seguidor recibe los mismos eventos")
+    group = SingleFlight()
+    query = FakeQuery()
+
+    leader = group.join(KEY, query.events)
+    leader_task = asyncio.ensure_future(collect(leader))
+    await asyncio.sleep(EVENT_INTERVAL_SECONDS * 2.5)
+    follower = group.join(KEY, query.events)
+    leader_events, follower_events = await asyncio.gather(leader_task, collect(follower))
+
+    ok = (
+        query.runs == 1
+        and leader.leader and not follower.leader
+        and leader_events == follower_events and len(leader_events) == 6
+        and group.status() == {"in_flight": 0, "leaders": 1, "followers": 1, "cancelled": 0}
+    )
+    if ok:
+        print_pass("Una ejecución; el seguidor recibió los eventos ya emitidos y los nuevos, en orden")
+    else:
+        print_fail(f"runs={query.runs}, líder={len(leader_events)}, seguidor={len(follower_events)}, {group.status()}")
+    return ok
+
+
+async def test_leader_disconnect_keeps_flight() -> bool:
+    print_test("El líder se desconecta, el seguidor sigue")
+    group = SingleFlight()
+    query = FakeQuery()
+
+    leader = group.join(KEY, query.events)
+    follower = group.join(KEY, query.events)
+    leader_events = await collect(leader, limit=1)
+    follower_events = await collect(follower)
+
+    ok = (
+        len(leader_events) == 1
+        and follower_events[-1] == {"type": "complete"} and len(follower_events) == 6
+        and not query.cancelled and group.metrics["cancelled"] == 0
+    )
+    if ok:
+        print_pass("La consulta terminó para el seguidor sin cancelarse")
+    else:
+        print_fail(f"seguidor={follower_events}, cancelada={query.cancelled}")
+    return ok
+
+
+async def test_last_subscriber_cancels() -> bool:
+    print_test("El último suscriptor se va: la consulta se cancela")
+    group = SingleFlight()
+    query = FakeQuery(count=50)
+
+    first = group.join(KEY, query.events)
+    second = group.join(KEY, query.events)
+    await collect(first, limit=1)
+    running_after_first = not query.finished
+    await collect(second, limit=2)
+    await asyncio.sleep(EVENT_INTERVAL_SECONDS)
+
+    replacement_query = FakeQuery(count=1)
+    replacement = group.join(KEY, replacement_query.events)
+    replacement_events = await collect(replacement)
+
+    ok = (
+        running_after_first
+        and query.cancelled and query.finished
+        and group.metrics["cancelled"] == 1
+        and replacement.leader and replacement_query.runs == 1 and len(replacement_events) == 2
+    )
+    if ok:
+        print_pass("Cancelada al cerrar el segundo suscriptor; la clave inició una ejecución nueva")
+    else:
+        print_fail(
+            f"seguía tras el primero={running_after_first}, cancelada={query.cancelled}, "
+            f"{group.status()}, nueva líder={replacement.leader}"
+        )
+    return ok
+
+
+async def test_error_reaches_all() -> bool:
+    print_test("Un error llega a todos los suscriptores")
+    group = SingleFlight()
+    query = FakeQuery(fail_after=2)
+    subscriptions = [group.join(KEY, query.events) for _ in range(3)]
+    results = await asyncio.gather(*(collect(subscription) for subscription in subscriptions), return_exceptions=True)
+
+    ok = query.runs == 1 and all(isinstance(result, RuntimeError) for result in results)
+    if ok:
+        print_pass("Los 3 suscriptores recibieron RuntimeError de una sola ejecución")
+    else:
+        print_fail(f"runs={query.runs}, resultados={results}")
+    return ok
+
+
+async def run_tests() -> list:
+    return [
+        await test_follower_gets_same_events(),
+        await test_leader_disconnect_keeps_flight(),
+        await test_last_subscriber_cancels(),
+        await test_error_reaches_all(),
+    ]
+
+
+def main() -> int:
+    results = asyncio.run(run_tests())
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+SmartHealth - Respuestas por Plantilla
+======================================
+Ejecutar: python test_template_answers.py
+
+No requiere OpenAI ni base de datos: las respuestas se construyen desde un
+ClinicalRecords de prueba.
+
+Verifica:
+1. Las preguntas puramente estructuradas se detectan (con o sin tildes,
+   signos y referencia al paciente)
+2. Las preguntas con cualquier calificador adicional no usan plantilla
+3. La última cita ignora las citas futuras, canceladas y sin asistencia
+4. La próxima cita lista solo las citas pendientes, en orden de fecha
+5. Medicamentos y diagnósticos: un ítem por medicamento / código, el más
+   reciente
+"""
+
+import sys
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+
+# Agregar el directorio src al path
+root_dir = Path(__file__).parent
+sys.path.insert(0, str(root_dir / "src"))
+
+from app.schemas.clinical import AppointmentDTO, ClinicalRecords, DiagnosisDTO, PrescriptionDTO
+from app.services.template_answers import answer_from_template, detect_intent
+
+TODAY = date.today()
+
+
+# Colores para output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+
+def print_test(name: str):
+    print(f"\n{Colors.BLUE}{Colors.BOLD}━━━ {name} ━━━{Colors.RESET}")
+
+
+def print_pass(message: str):
+    print(f"{Colors.GREEN} PASS:{Colors.RESET} {message}")
+
+
+def print_fail(message: str):
+    print(f"{Colors.RED} FAIL:{Colors.RESET} {message}")
+
+
+def print_info(message: str):
+    print(f"{Colors.YELLOW}ℹ  INFO:{Colors.RESET} {message}")
+
+
+# ============================================================
+# REGISTROS DE PRUEBA
+# ============================================================
+
+def appointment(appointment_id: int, days: int, status: str, reason: str) -> AppointmentDTO:
+    return AppointmentDTO(
+        appointment_id=appointment_id, patient_id=1, doctor_id=7,
+        appointment_date=TODAY + timedelta(days=days), start_time=time(9, 30),
+        status=status, reason=reason,
+        doctor_name="Dra. Ana Gómez", specialty_name="Medicina Interna",
+    )
+
+
+def prescription(prescription_id: int, medication: str, dosage: str, prescribed: date) -> PrescriptionDTO:
+    return PrescriptionDTO(
+        prescription_id=prescription_id, medical_record_id=prescription_id, medication_id=prescription_id,
+        dosage=dosage, frequency="cada 12 horas", prescription_date=prescribed, medication_name=medication,
+    )
+
+
+def diagnosis(record_diagnosis_id: int, icd_code: str, description: str, diagnosed: datetime) -> DiagnosisDTO:
+    return DiagnosisDTO(
+        record_diagnosis_id=record_diagnosis_id, diagnosis_id=record_diagnosis_id,
+        icd_code=icd_code, description=description, diagnosis_date=diagnosed,
+    )
+
+
+# Como los devuelve ClinicalRecords: de la más reciente a la más antigua
+RECORDS = ClinicalRecords(
+    appointments=[
+        appointment(1, 20, "Programada", "control de tensión"),
+        appointment(2, 5, "Cancelada", "control anual"),
+        appointment(3, 0, "No asistió", "toma de muestras"),
+        appointment(4, -3, "Cancelada", "dolor de cabeza"),
+        appointment(5, -30, "Completada", "control de diabetes"),
+        appointment(6, -90, "Completada", "chequeo general"),
+    ],
+    prescriptions=[
+        prescription(11, "Metformina", "850 mg", date(2024, 3, 1)),
+        prescription(12, "Losartán", "50 mg", date(2023, 8, 15)),
+        prescription(13, "Metformina", "500 mg", date(2022, 1, 10)),
+    ],
+    diagnoses=[
+        diagnosis(21, "E11", "Diabetes mellitus tipo 2", datetime(2024, 3, 1, 10)),
+        diagnosis(22, "I10", "Hipertensión esencial", datetime(2023, 8, 15, 11)),
+        diagnosis(23, "E11", "Diabetes mellitus tipo 2", datetime(2022, 1, 10, 9)),
+    ],
+)
+
+MATCHED = {
+    "¿Cuál fue su última cita?": "last_appointment",
+    "cuando fue la ultima cita medica del paciente": "last_appointment",
+    "Última cita": "last_appointment",
+    "¿Tiene citas programadas?": "next_appointment",
+    "¿Cuál es la próxima cita del paciente?": "next_appointment",
+    "¿Qué medicamentos tiene recetados?": "medications",
+    "Medicamentos actuales del paciente": "medications",
+    "¿Qué diagnósticos tiene?": "diagnoses",
+    "Diagnósticos principales": "diagnoses",
+}
+
+UNMATCHED = [
+    "¿Qué medicamentos tiene recetados y en qué dosis?",
+    "¿Cuál fue su última cita de cardiología?",
+    "¿Qué diagnósticos tiene desde 2020?",
+    "¿Por qué le recetaron metformina?",
+    "¿Tiene citas programadas para diciembre?",
+    "¿Qué medicamentos no toma el paciente?",
+    "Resume la historia clínica del paciente",
+]
+
+
+# ============================================================
+# TESTS
+# ============================================================
+
+def test_matched_questions() -> bool:
+    print_test("Preguntas estructuradas detectadas")
+    wrong = {question: detect_intent(question) for question, intent in MATCHED.items()
+             if detect_intent(question) != intent}
+    if not wrong:
+        print_pass(f"{len(MATCHED)} preguntas con la intención esperada")
+        return True
+    print_fail(f"Intención incorrecta: {wrong}")
+    return False
+
+
+def test_unmatched_questions() -> bool:
+    print_test("Preguntas con calificadores siguen al LLM")
+    answered = [question for question in UNMATCHED if answer_from_template(question, RECORDS) is not None]
+    if not answered:
+        print_pass(f"{len(UNMATCHED)} preguntas sin plantilla")
+        return True
+    print_fail(f"Respondidas por plantilla: {answered}")
+    return False
+
+
+def test_last_appointment() -> bool:
+    print_test("Última cita: solo citas realizadas")
+    answer = answer_from_template("¿Cuál fue su última cita?", RECORDS)
+    cited = [apt.appointment_id for apt in answer.records.appointments]
+    if cited == [5] and "control de diabetes" in answer.text:
+        print_pass("Se ignoraron la cita futura, la cancelada y la de inasistencia")
+        return True
+    print_fail(f"Citas citadas: {cited}\n{answer.text}")
+    return False
+
+
+def test_last_appointment_none_held() -> bool:
+    print_test("Última cita: sin citas realizadas")
+    records = ClinicalRecords(appointments=[
+        appointment(4, -3, "Cancelada", "dolor de cabeza"),
+        appointment(3, -1, "No asistió", "toma de muestras"),
+    ])
+    answer = answer_from_template("Última cita", records)
+    if not answer.records.appointments and "No hay citas anteriores" in answer.text:
+        print_pass("Sin citas realizadas no se cita ninguna")
+        return True
+    print_fail(answer.text)
+    return False
+
+
+def test_next_appointment() -> bool:
+    print_test("Próxima cita: solo citas pendientes")
+    answer = answer_from_template("¿Tiene citas programadas?", RECORDS)
+    cited = [apt.appointment_id for apt in answer.records.appointments]
+    if cited == [1]:
+        print_pass("Solo la cita programada; la cancelada y la de inasistencia se omiten")
+        return True
+    print_fail(f"Citas citadas: {cited}\n{answer.text}")
+    return False
+
+
+def test_medications_and_diagnoses() -> bool:
+    print_test("Medicamentos y diagnósticos")
+    medications = answer_from_template("¿Qué medicamentos tiene recetados?", RECORDS)
+    diagnoses = answer_from_template("¿Qué diagnósticos tiene?", RECORDS)
+    prescribed = [presc.prescription_id for presc in medications.records.prescriptions]
+    diagnosed = [diag.record_diagnosis_id for diag in diagnoses.records.diagnoses]
+    ok = (
+        prescribed == [11, 12]
+        and "850 mg" in medications.text and "500 mg" not in medications.text
+        and diagnosed == [21, 22]
+    )
+    if ok:
+        print_pass("Un ítem por medicamento y por código ICD, con el registro más reciente")
+    else:
+        print_fail(f"Prescripciones: {prescribed}, diagnósticos: {diagnosed}\n{medications.text}")
+    return ok
+
+
+def run_tests() -> list:
+    return [
+        test_matched_questions(),
+        test_unmatched_questions(),
+        test_last_appointment(),
+        test_last_appointment_none_held(),
+        test_next_appointment(),
+        test_medications_and_diagnoses(),
+    ]
+
+
+def main() -> int:
+    results = run_tests()
+    passed = sum(results)
+
+    print()
+    if passed == len(results):
+        print_pass(f"{passed}/{len(results)} tests pasaron")
+        return 0
+    print_fail(f"{len(results) - passed}/{len(results)} tests fallaron")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -127,6 +127,7 @@ async def test_websocket():
                         print(f"⏱️  Tiempo total: {elapsed:.2f}s")
                         print(f"📚 Registros analizados: {data['metadata']['total_records_analyzed']}")
                         print(f"🔍 Chunks vectoriales: {data['metadata']['vector_chunks_used']}")
+                        print(f"⚡ Primer token: {data['metadata'].get('time_to_first_token_ms')} ms")
                         print(f"🤖 Modelo: {data['answer']['model_used']}")
                         print(f"📊 Confianza: {data['answer']['confidence']:.2%}")
                         print()